@@ -11,6 +11,10 @@ parser.add_argument("-cv_folds", action="store", default=5, type=int,
                     help="Number of crossvalidation folds")
 parser.add_argument("-cv_splits", action="store", default=5, type=int, 
                     help="Number of hyperparameters to test")
+parser.add_argument("-cv_path", action="store_true", 
+                    help="Warm-start crossvalidation along the regularization path and the final fit from its fit on the full data")
+parser.add_argument("-cv_halving", action="store_true", 
+                    help="Select the hyperparameter by successive halving instead of fitting every hyperparameter fully")
 parser.add_argument("-pm_ratio", action="store", type=float, default=None, 
                     help="Expected ratio of PTs to MTs")
 parser.add_argument("-lam", action="store", default=1e-04, type=float, 
@@ -19,12 +23,30 @@ parser.add_argument("-logs", action="store", default="./inf.dat", type=str,
                     help="relative path to log-file destination")
 parser.add_argument("-seed", action="store", default=42, type=int, 
                     help="Seed for random number generator")
+parser.add_argument("-cache_dir", action="store", default=None, type=str, 
+                    help="Directory of a persistent compilation cache")
+parser.add_argument("-n_threads", action="store", default=1, type=int, 
+                    help="Number of threads used to compile kernels before inference")
+parser.add_argument("-n_devices", action="store", default=None, type=int, 
+                    help="Number of XLA host devices to shard the likelihood evaluation across")
+parser.add_argument("-checkpoint", action="store", default=None, type=str, 
+                    help="Snapshot file of the final fit, the fit resumes from it if it exists")
+parser.add_argument("-telemetry", action="store", default=None, type=str, 
+                    help="JSONL file for per iteration records of the final fit")
+parser.add_argument("-active_set", action="store_true", default=False, 
+                    help="Freeze parameters of the final fit at 0, that satisfy the L1 optimality conditions")
 parser.add_argument("source-annot", help="Relative path to the data annotation file")
 parser.add_argument("source-data", help="Relative path to the data file")
 parser.add_argument("dest", help="Relative path to file save destination")
 args = parser.parse_args()
 config = vars(args)
 
+import os
+if config["n_devices"] is not None:
+    # The number of host devices has to be fixed before jax is initialized
+    os.environ["XLA_FLAGS"] = (os.environ.get("XLA_FLAGS", "") + 
+                               f" --xla_force_host_platform_device_count={config['n_devices']}")
+
 import metmhn.regularized_optimization as reg_opt
 import metmhn.Utilityfunctions as utils
 
@@ -47,28 +69,7 @@ logging.basicConfig(filename=config['logs'],
                     )
 
 # Read in raw data
-annot_data = pd.read_csv(config['source-annot'])
-mut_data = pd.read_csv(config['source-data'])
-mut_data.rename(columns={"Unnamed: 0":"patientID"}, inplace = True)
-dat = pd.merge(mut_data, annot_data.loc[:, ['patientID', 'metaStatus']], 
-               on=["patientID", "patientID"])
-muts = list(dat.columns[1:-4])
-
-# Label each datapoint with a numeric value according to its sequencetype
-dat["type"] = dat.apply(utils.categorize, axis=1)
-# Add the seeding event
-dat["Seeding"] = dat["type"].apply(lambda x: pd.NA if pd.isna(x) else 0 if x == 0 else 1)
-dat["M.AgeAtSeqRep"] = pd.to_numeric(dat["M.AgeAtSeqRep"], errors='coerce')
-dat["P.AgeAtSeqRep"] = pd.to_numeric(dat["P.AgeAtSeqRep"], errors='coerce')
-# Define the order of diagnosis for paired datapoints
-dat["diag_order"] = dat["M.AgeAtSeqRep"] - dat["P.AgeAtSeqRep"]
-dat["diag_order"] = dat["diag_order"].apply(lambda x: pd.NA if pd.isna(x) else 2 if x < 0 else 1 if x > 0 else 0) 
-dat["diag_order"] = dat["diag_order"].astype(pd.Int64Dtype())
-
-events_data = muts+["Seeding"]
-
-# Only use datapoints where the state of the seeding is known
-cleaned = dat.loc[~pd.isna(dat["type"]), muts+["Seeding", "diag_order", "type"]]
+cleaned = utils.read_data(config['source-annot'], config['source-data'])
 dat = jnp.array(cleaned.to_numpy(dtype=np.int8, na_value=-99))
 
 events_plot = []
@@ -82,34 +83,58 @@ if config["pm_ratio"] is None:
 else:
     perc_met = config["pm_ratio"]
 
+# Bucket the datapoints once and reuse the plan for all likelihood evaluations
+if config["cache_dir"] is not None:
+    reg_opt.enable_compilation_cache(config["cache_dir"])
+plan = reg_opt.DatasetPlan(dat, n_devices=config["n_devices"])
+reg_opt.warm_up(plan, lik=False, n_threads=config["n_threads"])
+
 if config['cv']:
     # Perform crossvalidation
     log_lams = np.linspace(np.log10(config['cv_start']), 
                            np.log10(config['cv_end']), 
                            config['cv_splits'])
     lams = 10**log_lams
-    penal_weights = utils.cross_val(dat=dat, 
-                                penal_fun=reg_opt.symmetric_penal, 
-                                splits=lams, 
-                                n_folds=config['cv_folds'], 
-                                m_p_corr=perc_met, 
-                                seed=jrp.PRNGKey(config['seed']))
-
-    # The cross_val function returns a n_folds x log_lams.size shaped dataframe
-    penal = lams[np.argmax(np.mean(penal_weights, axis=0))]
+    if config['cv_halving']:
+        penal_weights, penal = utils.successive_halving(dat=plan, 
+                                                        penal_fun=reg_opt.symmetric_penal, 
+                                                        splits=lams, 
+                                                        n_folds=config['cv_folds'], 
+                                                        m_p_corr=perc_met, 
+                                                        key=jrp.PRNGKey(config['seed']))
+    else:
+        penal_weights = utils.cross_val(dat=plan, 
+                                    penal_fun=reg_opt.symmetric_penal, 
+                                    splits=lams, 
+                                    n_folds=config['cv_folds'], 
+                                    m_p_corr=perc_met, 
+                                    key=jrp.PRNGKey(config['seed']),
+                                    path=config['cv_path'])
+        if config['cv_path']:
+            penal_weights, fits = penal_weights
+
+        # The cross_val function returns a n_folds x log_lams.size shaped dataframe
+        penal = lams[np.argmax(np.mean(penal_weights, axis=0))]
 else:
     penal = config['lam']
 
 
-# Learn the actual model
-th_init, dp_init, dm_init = utils.indep(dat)
+# Learn the actual model, warm-started from its fit along the regularization path if available
+if config['cv'] and config['cv_path'] and not config['cv_halving']:
+    th_init, dp_init, dm_init = fits[float(penal)]
+else:
+    th_init, dp_init, dm_init = utils.indep(dat)
 theta, d_p, d_m= reg_opt.learn_mhn(th_init=th_init, 
                                    dp_init=dp_init,
                                    dm_init=dm_init,
-                                   dat=dat,
+                                   dat=plan,
                                    perc_met=perc_met,
                                    penal=reg_opt.symmetric_penal,
-                                   w_penal=penal
+                                   w_penal=penal,
+                                   cache_dir=config["cache_dir"],
+                                   checkpoint=config["checkpoint"],
+                                   telemetry=config["telemetry"],
+                                   active_set=config["active_set"]
                                    )
 
 th_plot = np.row_stack((d_p.reshape((1,-1)), 
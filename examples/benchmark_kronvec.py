@@ -0,0 +1,81 @@
+import argparse
+
+parser = argparse.ArgumentParser(description="Compare kronvec with the fused single pass kronvec_fused, or the sequential with the "
+                                 "parallel evaluation of the summands of kronvec, kronvec_fused and kron_diag",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-kernel", action="store", default="fused", choices=["fused", "parallel"],
+                    help="fused: kronvec against kronvec_fused, parallel: sequential against parallel summands")
+parser.add_argument("-k_min", action="store", default=10, type=int,
+                    help="Smallest number of active bits in the restricted state space")
+parser.add_argument("-k_max", action="store", default=22, type=int,
+                    help="Largest number of active bits in the restricted state space")
+parser.add_argument("-n_absent", action="store", default=2, type=int,
+                    help="Number of events of the model, that are absent in the state")
+parser.add_argument("-n_evals", action="store", default=5, type=int,
+                    help="Number of timed evaluations per kernel and state size")
+parser.add_argument("-diag", action="store_true",
+                    help="Include the diagonal of Q in the products, by default only the off-diagonal part used by the solvers is applied")
+parser.add_argument("-seed", action="store", default=42, type=int,
+                    help="Seed of the random parameters and vectors")
+args = parser.parse_args()
+config = vars(args)
+
+from metmhn.jx.kronvec import kronvec, kronvec_fused, kron_diag
+
+import time
+import pandas as pd
+import jax.numpy as jnp
+import numpy as np
+import jax as jax
+jax.config.update("jax_enable_x64", True)
+
+
+def timed(fun):
+    start = time.perf_counter()
+    out = fun().block_until_ready()
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(config["n_evals"]):
+        fun().block_until_ready()
+    return out, compile_time, (time.perf_counter() - start)/config["n_evals"]
+
+
+def rel_dev(x, ref):
+    return float(jnp.max(jnp.abs(x - ref))/jnp.max(jnp.abs(ref)))
+
+
+rng = np.random.default_rng(config["seed"])
+rows = []
+for k in range(config["k_min"], config["k_max"]+1):
+    # Events in both tumors, the seeding bit is set if k is odd
+    n_pair = k // 2
+    n = n_pair + config["n_absent"]
+    state = jnp.array([1]*(2*n_pair) + [0]*(2*config["n_absent"]) + [k % 2])
+    log_theta = jnp.array(rng.normal(-1, 1, size=(n+1, n+1)))
+    p = jnp.array(rng.random(2**k))
+    res = {"k": k, "entries": n * 2**k}
+    if config["kernel"] == "fused":
+        out = {}
+        for name, fun in (("kronvec", kronvec), ("fused", kronvec_fused)):
+            for transpose in (False, True):
+                col = name + ("_T" if transpose else "")
+                out[col], res[f"{col}_compile"], res[f"{col}_time"] = timed(
+                    lambda: fun(log_theta, p, state, config["diag"], transpose, False))
+        res["max_rel_dev"] = max(rel_dev(out[f"fused{t}"], out[f"kronvec{t}"]) for t in ("", "_T"))
+        res["speedup"] = res["kronvec_time"]/res["fused_time"]
+        res["speedup_T"] = res["kronvec_T_time"]/res["fused_T_time"]
+    else:
+        kernels = {"kronvec": lambda parallel: kronvec(log_theta, p, state, config["diag"], False, parallel),
+                   "fused": lambda parallel: kronvec_fused(log_theta, p, state, config["diag"], False, parallel),
+                   "diag": lambda parallel: kron_diag(log_theta, state, k, parallel)}
+        for name, fun in kernels.items():
+            out = {}
+            for parallel in (False, True):
+                col = name + ("_par" if parallel else "_seq")
+                out[parallel], _, res[f"{col}_time"] = timed(lambda: fun(parallel))
+            res[f"{name}_dev"] = rel_dev(out[True], out[False])
+            res[f"{name}_speedup"] = res[f"{name}_seq_time"]/res[f"{name}_par_time"]
+    rows.append(res)
+    print(f"k = {k} done", flush=True)
+
+print(pd.DataFrame(rows).to_string(index=False))
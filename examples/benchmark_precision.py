@@ -0,0 +1,65 @@
+import argparse
+
+parser = argparse.ArgumentParser(description="Compare the single and double precision kernels on the LUAD data",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-n_events", action="store", default=10, type=int,
+                    help="Number of events, the first n_events events of the data file are used")
+parser.add_argument("-n_evals", action="store", default=10, type=int,
+                    help="Number of timed evaluations of the likelihood and its gradient")
+parser.add_argument("-fit", action="store_true",
+                    help="Additionally fit a model in both precisions and compare the parameters")
+parser.add_argument("-lam", action="store", default=1e-04, type=float,
+                    help="Weight of penalization for inference")
+parser.add_argument("-source_annot", action="store", default="../data/luad/G14_LUAD_sampleSelection.csv", type=str,
+                    help="Relative path to the data annotation file")
+parser.add_argument("-source_data", action="store", default="../data/luad/G14_LUAD_Events.csv", type=str,
+                    help="Relative path to the data file")
+args = parser.parse_args()
+config = vars(args)
+
+import metmhn.regularized_optimization as reg_opt
+import metmhn.Utilityfunctions as utils
+
+import time
+import numpy as np
+import jax as jax
+jax.config.update("jax_enable_x64", True)
+
+cleaned = utils.read_data(config['source_annot'], config['source_data'])
+# Keep the first n_events events, the seeding, the order of diagnosis and the type
+cleaned = cleaned.iloc[:, list(range(2*config["n_events"])) + [-3, -2, -1]]
+dat = np.array(cleaned.to_numpy(dtype=np.int8, na_value=-99))
+perc_met = dat[:,-3].sum()/(dat.shape[0] - dat[:,-3].sum())
+th_init, dp_init, dm_init = utils.indep(dat)
+params = np.concatenate((th_init.flatten(), dp_init, dm_init))
+
+results = {}
+for dtype in (np.float64, np.float32):
+    plan = reg_opt.DatasetPlan(dat, dtype=dtype)
+    compile_time = reg_opt.warm_up(plan, lik=False)
+    start = time.perf_counter()
+    for _ in range(config["n_evals"]):
+        score, grad = reg_opt.score_and_grad_reg(params, plan, perc_met, reg_opt.symmetric_penal, config["lam"])
+    eval_time = (time.perf_counter() - start)/config["n_evals"]
+    results[dtype] = {"compile": compile_time, "eval": eval_time, "score": score, "grad": grad}
+    if config["fit"]:
+        start = time.perf_counter()
+        fit = reg_opt.learn_mhn(th_init, dp_init, dm_init, plan, perc_met, reg_opt.symmetric_penal, config["lam"],
+                                opt_v=False)
+        results[dtype]["fit_time"] = time.perf_counter() - start
+        results[dtype]["fit"] = np.concatenate([np.array(p).flatten() for p in fit])
+
+ref, single = results[np.float64], results[np.float32]
+print(f"{dat.shape[0]} datapoints, {config['n_events']} events")
+print(f"{'':<10}{'compile [s]':>14}{'eval [s]':>14}")
+for name, res in (("float64", ref), ("float32", single)):
+    print(f"{name:<10}{res['compile']:>14.2f}{res['eval']:>14.4f}")
+print(f"Speed-up of score_and_grad: {ref['eval']/single['eval']:.2f}")
+print(f"Deviation of the objective: {abs(single['score'] - ref['score']):.2e}")
+print(f"Max. deviation of the gradient: {np.max(np.abs(single['grad'] - ref['grad'])):.2e}")
+if config["fit"]:
+    print(f"Fit time float64: {ref['fit_time']:.1f}s, float32: {single['fit_time']:.1f}s")
+    print(f"Max. deviation of the fitted parameters: {np.max(np.abs(single['fit'] - ref['fit'])):.2e}")
+    objective = [reg_opt.score_reg(res["fit"], dat, perc_met, reg_opt.symmetric_penal, config["lam"])
+                 for res in (ref, single)]
+    print(f"Objective at the fits in double precision, float64: {objective[0]:.8f}, float32: {objective[1]:.8f}")
@@ -0,0 +1,80 @@
+import argparse
+
+parser = argparse.ArgumentParser(description="Compare the Jacobi, the level-by-level and the dense solvers for the restricted resolvent",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-k_min", action="store", default=4, type=int,
+                    help="Smallest number of active bits in the restricted state space")
+parser.add_argument("-k_max", action="store", default=24, type=int,
+                    help="Largest number of active bits in the restricted state space")
+parser.add_argument("-n_evals", action="store", default=5, type=int,
+                    help="Number of timed solves per method and state size")
+parser.add_argument("-dense_max", action="store", default=12, type=int,
+                    help="Largest number of active bits, for which the dense solver is benchmarked")
+parser.add_argument("-joint", action="store_true",
+                    help="Benchmark the joint PT/MT solver instead of the one for single tumors")
+parser.add_argument("-seed", action="store", default=42, type=int,
+                    help="Seed of the random parameters and right hand sides")
+args = parser.parse_args()
+config = vars(args)
+
+import metmhn.jx.likelihood as ssr
+import metmhn.jx.vanilla as mhn
+
+import time
+import pandas as pd
+import jax.numpy as jnp
+import numpy as np
+import jax as jax
+jax.config.update("jax_enable_x64", True)
+
+
+def make_problem(k: int, rng: np.random.Generator) -> tuple:
+    if config["joint"]:
+        # k = 2*n_paired + 1 active bits, events of the pair are in both tumors and the seeding happened
+        n_pair = (k - 1)//2
+        n = n_pair + 2
+        state = jnp.array([1]*(2*n_pair) + [0, 0] + [1])
+        k = 2*n_pair + 1
+    else:
+        n = k + 2
+        state = jnp.array([1]*k + [0, 0])
+    theta = jnp.array(rng.normal(-1, 1, size=(n, n)))
+    d_p = jnp.array(rng.normal(0, 1, size=n))
+    d_m = jnp.array(rng.normal(0, 1, size=n))
+    x = jnp.array(rng.random(2**k))
+    return k, theta, d_p, d_m, state, x
+
+
+def solve(method: str, k: int, theta, d_p, d_m, state, x) -> jnp.ndarray:
+    if config["joint"]:
+        return ssr.R_i_inv_vec(theta, d_p, d_m, x, state, k, False, method)
+    return mhn.R_inv_vec(theta, x, state, 1., False, method)
+
+
+rng = np.random.default_rng(config["seed"])
+rows = []
+done = set()
+for k in range(config["k_min"], config["k_max"]+1):
+    k, *problem = make_problem(k, rng)
+    if k in done:
+        continue
+    done.add(k)
+    res = {"k": k}
+    methods = ["jacobi", "levels"] + (["dense"] if k <= config["dense_max"] else [])
+    for method in methods:
+        start = time.perf_counter()
+        y = solve(method, k, *problem).block_until_ready()
+        res[f"{method}_compile"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(config["n_evals"]):
+            solve(method, k, *problem).block_until_ready()
+        res[f"{method}_solve"] = (time.perf_counter() - start)/config["n_evals"]
+        if method == "jacobi":
+            y_jac = y
+        else:
+            res[f"{method}_dev"] = float(jnp.max(jnp.abs(y - y_jac)/jnp.abs(y_jac)))
+            res[f"{method}_speedup"] = res["jacobi_solve"]/res[f"{method}_solve"]
+    rows.append(res)
+    print(f"k = {k} done", flush=True)
+
+print(pd.DataFrame(rows).to_string(index=False))
@@ -1,5 +1,5 @@
-from metmhn.regularized_optimization import learn_mhn, score
-from itertools import chain, combinations
+from metmhn.regularized_optimization import learn_mhn, score, score_reg, DatasetPlan
+from itertools import chain, combinations, repeat
 import numpy as np
 import jax
 import jax.numpy as jnp
@@ -8,7 +8,10 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import logging
-from typing import Callable, Any
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Any, Iterable
 jax.config.update("jax_enable_x64", True)
 
 
@@ -111,7 +114,43 @@ def categorize(x: pd.Series) -> int:
         return 3
     else:
         return pd.NA
-    
+
+
+def read_data(source_annot: str, source_data: str) -> pd.DataFrame:
+    """Reads the event and annotation files of a cohort and prepares its datapoints in the layout expected by learn_mhn
+
+    Args:
+        source_annot (str): Path to the annotation file, with the columns patientID and metaStatus
+        source_data (str): Path to the event file, with a column per event and tumor, followed by the columns paired,
+            P.AgeAtSeqRep and M.AgeAtSeqRep
+
+    Returns:
+        pd.DataFrame: Datapoints, whose type is known, with the columns of the events, Seeding, diag_order and type.
+            Missing entries are pd.NA
+    """
+    annot_data = pd.read_csv(source_annot)
+    mut_data = pd.read_csv(source_data)
+    mut_data.rename(columns={"Unnamed: 0":"patientID"}, inplace = True)
+    dat = pd.merge(mut_data, annot_data.loc[:, ['patientID', 'metaStatus']],
+                   on=["patientID", "patientID"])
+    muts = list(dat.columns[1:-4])
+
+    # Label each datapoint with a numeric value according to its sequencetype
+    dat["type"] = dat.apply(categorize, axis=1)
+    # Add the seeding event
+    dat["Seeding"] = dat["type"].apply(lambda x: pd.NA if pd.isna(x) else 0 if x == 0 else 1)
+    dat["M.AgeAtSeqRep"] = pd.to_numeric(dat["M.AgeAtSeqRep"], errors='coerce')
+    dat["P.AgeAtSeqRep"] = pd.to_numeric(dat["P.AgeAtSeqRep"], errors='coerce')
+    # Define the order of diagnosis for paired datapoints
+    dat["diag_order"] = dat["M.AgeAtSeqRep"] - dat["P.AgeAtSeqRep"]
+    dat["diag_order"] = dat["diag_order"].apply(lambda x: pd.NA if pd.isna(x) else 2 if x < 0 else 1 if x > 0 else 0)
+    dat["diag_order"] = dat["diag_order"].astype(pd.Int64Dtype())
+    # Paired datapoints without ages of sequencing were observed in unknown order
+    dat.loc[(dat["paired"] == 1) & pd.isna(dat["diag_order"]), "diag_order"] = 0
+
+    # Only use datapoints where the state of the seeding is known
+    return dat.loc[~pd.isna(dat["type"]), muts+["Seeding", "diag_order", "type"]]
+
 
 def marg_frequs(dat: jnp.ndarray,  events: list) -> pd.DataFrame:
     """This calculates the empirical marginal frequencies of mutations in the stratified datasets
@@ -183,12 +222,97 @@ def indep(dat: jnp.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     return theta, np.zeros(n+1), np.zeros(n+1)
 
 
-def cross_val(dat: jnp.ndarray, penal_fun: Callable, splits: jnp.ndarray, n_folds: int, 
-              m_p_corr: float, key: jrp.PRNGKey = jrp.PRNGKey(42)) -> pd.DataFrame:
+class _CVFolds:
+    """Train and test splits of a shuffled dataset for a cross validation. Each split is 
+    planned lazily and at most once, such that the compiled kernels and plans are reused 
+    for all penalization weights.
+
+    Args:
+        shuffled (np.ndarray): Shuffled matrix of observations dimension (n_dat x (2n+3))
+        n_folds (int): Number of folds to split the data into
+        plan (DatasetPlan, optional): Plan of the full dataset. Defaults to None.
+        n_devices (int, optional): Number of devices to shard the plans across, see DatasetPlan. Defaults to None.
+        dtype (np.dtype, optional): Floating point type of the kernels, see DatasetPlan. Defaults to np.float64.
+    """
+    def __init__(self, shuffled: np.ndarray, n_folds: int, plan: DatasetPlan | None = None, 
+                 n_devices: int | None = None, dtype: np.dtype = np.float64):
+        self.shuffled = shuffled
+        self.n_folds = n_folds
+        self.plan = plan
+        self.n_devices = n_devices
+        self.dtype = dtype
+        self.batch_size = int(np.ceil(shuffled.shape[0]/n_folds))
+        self._folds = {}
+
+    def __getitem__(self, fold_index: int) -> tuple[tuple[np.ndarray, np.ndarray, np.ndarray], DatasetPlan, DatasetPlan]:
+        if fold_index not in self._folds:
+            start = self.batch_size * fold_index
+            stop = min(self.batch_size * (fold_index + 1), self.shuffled.shape[0])
+            train = np.concatenate((self.shuffled[:start], self.shuffled[stop:]))
+            self._folds[fold_index] = (indep(train), DatasetPlan(train, n_devices=self.n_devices, dtype=self.dtype), 
+                                       DatasetPlan(self.shuffled[start:stop], n_devices=self.n_devices, dtype=self.dtype))
+        return self._folds[fold_index]
+
+    def full(self) -> tuple[tuple[np.ndarray, np.ndarray, np.ndarray], DatasetPlan]:
+        if self.plan is None:
+            self.plan = DatasetPlan(self.shuffled, n_devices=self.n_devices, dtype=self.dtype)
+        return indep(self.plan.dat), self.plan
+
+
+def _fit_fold(folds: _CVFolds, fold_index: int, inds: list[int], splits: np.ndarray, penal_fun: Callable, 
+              m_p_corr: float) -> list[float]:
+    """Fits the penalization weights splits[inds] in the given order on the training split of a fold,
+    each fit is warm-started from the previous one. Returns the scores on the test split"""
+    params, train, test = folds[fold_index]
+    scores = []
+    for i in inds:
+        params = learn_mhn(*params, train, m_p_corr, penal_fun, splits[i], opt_v=False)
+        scores.append(float(score(*params, test, m_p_corr)))
+    return scores
+
+
+def _fit_full(folds: _CVFolds, inds: list[int], splits: np.ndarray, penal_fun: Callable, 
+              m_p_corr: float) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Fits the regularization path splits[inds] on the full dataset"""
+    params, plan = folds.full()
+    fits = []
+    for i in inds:
+        params = learn_mhn(*params, plan, m_p_corr, penal_fun, splits[i], opt_v=False)
+        fits.append(params)
+    return fits
+
+
+# State of a cross validation worker process, set up once by _init_cv_worker
+_cv_worker = {}
+
+
+def _init_cv_worker(shm_name: str, shape: tuple[int, int], n_folds: int, n_devices: int | None, dtype: np.dtype, 
+                    splits: np.ndarray, penal_fun: Callable, m_p_corr: float):
+    """Attaches a worker process to the shared shuffled dataset"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shuffled = np.ndarray(shape, dtype=np.int8, buffer=shm.buf)
+    shuffled.flags.writeable = False
+    _cv_worker.update(shm=shm, folds=_CVFolds(shuffled, n_folds, n_devices=n_devices, dtype=dtype), splits=splits, 
+                      penal_fun=penal_fun, m_p_corr=m_p_corr)
+
+
+def _cv_worker_fold(fold_index: int, inds: list[int]) -> list[float]:
+    w = _cv_worker
+    return _fit_fold(w["folds"], fold_index, inds, w["splits"], w["penal_fun"], w["m_p_corr"])
+
+
+def _cv_worker_full(inds: list[int]) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    w = _cv_worker
+    return _fit_full(w["folds"], inds, w["splits"], w["penal_fun"], w["m_p_corr"])
+
+
+def cross_val(dat: jnp.ndarray | DatasetPlan, penal_fun: Callable, splits: jnp.ndarray, n_folds: int, 
+              m_p_corr: float, key: jrp.PRNGKey = jrp.PRNGKey(42), path: bool = False, n_jobs: int = 1
+              ) -> pd.DataFrame | tuple[pd.DataFrame, dict[float, tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]]:
     """Perform a n_folds cross validation for hyperparameter search
 
     Args:
-        dat (jnp.ndarray): dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), 
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, 
             rows correspond to patients and columns to events.
             The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, 
             the next column contains the observation order 
@@ -201,34 +325,275 @@ def cross_val(dat: jnp.ndarray, penal_fun: Callable, splits: jnp.ndarray, n_fold
         n_folds (int): Number of folds to split the data into
         m_p_corr (float):  Expected percentage of metastasizing tumor in the Dataset
         key (int, optional): Jax random prng key. Defaults to jrp.PRNGKey(42).
+        path (bool, optional): Fit a regularization path. The penalization weights are visited from the largest to the smallest 
+            and each fit is warm-started from the solution for the previous weight. Additionally the path is fitted on the 
+            full dataset. Defaults to False.
+        n_jobs (int, optional): Number of worker processes. The (weight, fold) pairs, or the folds if path is set, are 
+            distributed over a pool of spawned processes, which share the shuffled dataset read-only and keep their 
+            compiled kernels across tasks. Scripts using n_jobs > 1 need an `if __name__ == "__main__":` guard. 
+            Defaults to 1.
 
     Returns:
-        pd.DataFrame: n_folds x splits.size sized array of scores
+        pd.DataFrame | tuple[pd.DataFrame, dict[float, tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]]: n_folds x splits.size sized 
+            array of scores. If path is set, additionally the estimated log. theta, log. d_p and log. d_m on the full dataset 
+            for each penalization weight
     """
-    shuffled =  jrp.permutation(key, dat, axis=0)
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be positive, got {n_jobs}")
+    plan, n_devices, dtype = None, None, np.float64
+    if isinstance(dat, DatasetPlan):
+        plan = dat
+        dat = dat.dat
+        # The folds are sharded and evaluated in the precision of the full dataset
+        dtype = plan.dtype
+        if plan.mesh is not None:
+            n_devices = plan.mesh.size
+    shuffled = np.asarray(jrp.permutation(key, dat, axis=0), dtype=np.int8)
+    splits_np = np.asarray(splits)
     runs_constrained = np.zeros((n_folds, splits.shape[0]))
-    batch_size = jnp.ceil(dat.shape[0]/n_folds)
-    
+
+    if path:
+        # Strong penalization yields sparse models, which are good starting points for weaker penalizations
+        order = [int(i) for i in np.argsort(splits_np)[::-1]]
+        tasks = [(fold_index, order) for fold_index in range(n_folds)]
+    else:
+        tasks = [(fold_index, [i]) for i in range(splits.size) for fold_index in range(n_folds)]
+
     logging.info(f"Crossvalidation started")
-    for i in range(splits.size):
-        for fold_index in range(n_folds):
-            n_dat = shuffled.shape[0]
-            start = int(batch_size * fold_index)
-
-            stop = int(jnp.min(jnp.array([batch_size*(fold_index + 1), n_dat])))
-            train_inds = jnp.concatenate((jnp.arange(start, dtype=jnp.int32), 
-                                      jnp.arange(stop, n_dat, dtype=jnp.int32)))
-            train = shuffled[train_inds,:]
-            th_init, fd_init, sd_init = indep(train)
-            th, dp, dm = learn_mhn(th_init, fd_init, sd_init, train, m_p_corr, penal_fun, splits[i], opt_v=False)
-        
-            test_inds = jnp.arange(start, stop, dtype=jnp.int32)
-            
-            test = shuffled[test_inds, :]
-            runs_constrained[fold_index, i] = score(th, dp, dm, test, m_p_corr)
-            logging.info(f"Lambda: {splits[i]} Fold: {fold_index} Test Score: {runs_constrained[fold_index, i]}")
+    full_fits = []
+    if n_jobs == 1:
+        # The folds are identical for all penalization weights, plan them only once
+        folds = _CVFolds(shuffled, n_folds, plan, n_devices, dtype)
+        results = (_fit_fold(folds, f, inds, splits_np, penal_fun, m_p_corr) for f, inds in tasks)
+        _collect_cv(tasks, results, splits, runs_constrained)
+        if path:
+            full_fits = _fit_full(folds, order, splits_np, penal_fun, m_p_corr)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=shuffled.nbytes)
+        try:
+            np.ndarray(shuffled.shape, dtype=np.int8, buffer=shm.buf)[:] = shuffled
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context("spawn"), 
+                                     initializer=_init_cv_worker, 
+                                     initargs=(shm.name, shuffled.shape, n_folds, n_devices, dtype, splits_np, penal_fun, m_p_corr)
+                                     ) as pool:
+                results = pool.map(_cv_worker_fold, *zip(*tasks))
+                if path:
+                    full_future = pool.submit(_cv_worker_full, order)
+                # Results are consumed in submission order, which keeps the log identical to the sequential run
+                _collect_cv(tasks, results, splits, runs_constrained)
+                if path:
+                    full_fits = full_future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
     runs_constrained = pd.DataFrame(runs_constrained, columns=splits, index=np.arange(n_folds))
-    return runs_constrained
+    if not path:
+        return runs_constrained
+
+    fits = {}
+    for i, params in zip(order, full_fits):
+        fits[float(splits[i])] = params
+        logging.info(f"Lambda: {splits[i]} Full dataset fitted")
+    return runs_constrained, fits
+
+
+def _collect_cv(tasks: list[tuple[int, list[int]]], results: Iterable[list[float]], splits: jnp.ndarray, 
+                runs_constrained: np.ndarray):
+    """Writes the test scores of the cross validation tasks into runs_constrained in task order"""
+    for (fold_index, inds), scores in zip(tasks, results):
+        for i, sc in zip(inds, scores):
+            runs_constrained[fold_index, i] = sc
+            logging.info(f"Lambda: {splits[i]} Fold: {fold_index} Test Score: {runs_constrained[fold_index, i]}")
+
+
+def _continue_fold(folds: _CVFolds, fold_index: int, params: tuple[np.ndarray, np.ndarray, np.ndarray], w_penal: float, 
+                   penal_fun: Callable, m_p_corr: float, n_iter: int
+                   ) -> tuple[tuple[np.ndarray, np.ndarray, np.ndarray], float]:
+    """Continues a fit on the training split of a fold for at most n_iter iterations. Returns its parameters 
+    and the score on the test split"""
+    _, train, test = folds[fold_index]
+    params = learn_mhn(*params, train, m_p_corr, penal_fun, w_penal, opt_iter=n_iter, opt_v=False)
+    return params, float(score(*params, test, m_p_corr))
+
+
+def successive_halving(dat: jnp.ndarray | DatasetPlan, penal_fun: Callable, splits: jnp.ndarray, n_folds: int, 
+                       m_p_corr: float, key: jrp.PRNGKey = jrp.PRNGKey(42), min_iter: int = 50, eta: int = 3
+                       ) -> tuple[pd.DataFrame, float]:
+    """Successive halving search for the penalization weight. In the first rung all weights are fitted for min_iter 
+    iterations on the training split of every fold and scored on its test split. Only the best 1/eta of the weights, 
+    by their mean test score, advance to the next rung, which continues their fits up to eta times as many iterations. 
+    The search stops once a single weight is left
+
+    Args:
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, see cross_val
+        penal_fun Callable[[np.ndarray, int], tuple[np.ndarray, np.ndaray]]): Penalization function, see cross_val
+        splits (jnp.ndarray): Vector of penalization weights to test
+        n_folds (int): Number of folds to split the data into
+        m_p_corr (float):  Expected percentage of metastasizing tumor in the Dataset
+        key (int, optional): Jax random prng key. Defaults to jrp.PRNGKey(42).
+        min_iter (int, optional): Number of iterations of the first rung. Defaults to 50.
+        eta (int, optional): Factor by which the number of weights shrinks and the number of iterations grows per rung. 
+            Defaults to 3.
+
+    Returns:
+        tuple[pd.DataFrame, float]: n_folds x splits.size sized array of the test scores each weight achieved in the 
+            last rung it took part in and the selected penalization weight
+    """
+    if eta < 2:
+        raise ValueError(f"eta must be at least 2, got {eta}")
+    plan, n_devices, dtype = None, None, np.float64
+    if isinstance(dat, DatasetPlan):
+        plan = dat
+        dat = dat.dat
+        dtype = plan.dtype
+        if plan.mesh is not None:
+            n_devices = plan.mesh.size
+    shuffled = np.asarray(jrp.permutation(key, dat, axis=0), dtype=np.int8)
+    splits_np = np.asarray(splits)
+    folds = _CVFolds(shuffled, n_folds, plan, n_devices, dtype)
+    runs_constrained = np.zeros((n_folds, splits_np.shape[0]))
+    params = {(i, f): folds[f][0] for i in range(splits_np.shape[0]) for f in range(n_folds)}
+
+    candidates = list(range(splits_np.shape[0]))
+    n_iter, budget = min_iter, min_iter
+    logging.info(f"Successive halving started")
+    while True:
+        for i in candidates:
+            for f in range(n_folds):
+                params[i, f], runs_constrained[f, i] = _continue_fold(folds, f, params[i, f], splits_np[i], penal_fun, 
+                                                                      m_p_corr, n_iter)
+            logging.info(f"Lambda: {splits_np[i]} Iterations: {budget} Mean Test Score: {runs_constrained[:, i].mean()}")
+        # Larger scores are better
+        ranked = sorted(candidates, key=lambda i: runs_constrained[:, i].mean(), reverse=True)
+        candidates = ranked[:max(1, len(candidates)//eta)]
+        if len(candidates) == 1:
+            break
+        n_iter = budget*(eta - 1)
+        budget *= eta
+
+    best = float(splits_np[candidates[0]])
+    logging.info(f"Successive halving selected Lambda: {best}")
+    return pd.DataFrame(runs_constrained, columns=splits, index=np.arange(n_folds)), best
+
+
+def _unflatten(params: np.ndarray, n_total: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return (params[:n_total**2].reshape((n_total, n_total)), params[n_total**2:n_total*(n_total+1)], 
+            params[n_total*(n_total+1):])
+
+
+def _fit_stage(plan: DatasetPlan, params: np.ndarray, penal_fun: Callable, w_penal: float, m_p_corr: float, 
+               stage_iter: int, opt_ftol: float) -> tuple[np.ndarray, float]:
+    """Continues a fit for at most stage_iter iterations, returns its parameters and penalized objective"""
+    fit = learn_mhn(*_unflatten(params, plan.n_total), plan, m_p_corr, penal_fun, w_penal, opt_iter=stage_iter, 
+                    opt_ftol=opt_ftol, opt_v=False)
+    params = np.concatenate([np.asarray(p).flatten() for p in fit])
+    return params, float(score_reg(params, plan, m_p_corr, penal_fun, w_penal))
+
+
+# State of a multi-start worker process, set up once by _init_ms_worker
+_ms_worker = {}
+
+
+def _init_ms_worker(shm_name: str, shape: tuple[int, int], n_devices: int | None, dtype: np.dtype, 
+                    penal_fun: Callable, w_penal: float, m_p_corr: float):
+    """Attaches a worker process to the shared dataset and plans it"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    dat = np.ndarray(shape, dtype=np.int8, buffer=shm.buf)
+    dat.flags.writeable = False
+    _ms_worker.update(shm=shm, plan=DatasetPlan(dat, n_devices=n_devices, dtype=dtype), penal_fun=penal_fun, 
+                      w_penal=w_penal, m_p_corr=m_p_corr)
+
+
+def _ms_worker_stage(params: np.ndarray, stage_iter: int, opt_ftol: float) -> tuple[np.ndarray, float]:
+    w = _ms_worker
+    return _fit_stage(w["plan"], params, w["penal_fun"], w["w_penal"], w["m_p_corr"], stage_iter, opt_ftol)
+
+
+def multi_start(dat: jnp.ndarray | DatasetPlan, penal_fun: Callable, w_penal: float, m_p_corr: float, n_starts: int, 
+                scale: float = 0.1, key: jrp.PRNGKey = jrp.PRNGKey(42), n_jobs: int = 1, stage_iter: int = 100, 
+                margin: float = 0.05, opt_ftol: float = 1e-04
+                ) -> tuple[tuple[np.ndarray, np.ndarray, np.ndarray], pd.DataFrame]:
+    """Fits a metMHN from several perturbed initial estimates and returns the best fit. The fits advance in stages of 
+    stage_iter iterations. After each stage, fits whose penalized objective exceeds the one of the current leader 
+    by more than margin (relative) are terminated. A fit is finished once a stage reduces its objective by at most 
+    opt_ftol (relative)
+
+    Args:
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, 
+            rows correspond to patients and columns to events, see cross_val
+        penal_fun (Callable[[np.ndarray, int], tuple[np.ndarray, np.ndaray]]): Penalization function, see cross_val
+        w_penal (float): Weight of the penalization
+        m_p_corr (float): Expected percentage of metastasizing tumor in the Dataset
+        n_starts (int): Number of fits. The first one starts from indep(dat), the others from indep(dat) plus 
+            independent normal noise on all parameters
+        scale (float, optional): Standard deviation of the noise. Defaults to 0.1.
+        key (int, optional): Jax random prng key. Defaults to jrp.PRNGKey(42).
+        n_jobs (int, optional): Number of worker processes, the fits of a stage are distributed over a pool of 
+            spawned processes, see cross_val. Defaults to 1.
+        stage_iter (int, optional): Number of iterations per stage. Defaults to 100.
+        margin (float, optional): Relative margin to the leading objective, beyond which fits are terminated. Defaults to 0.05.
+        opt_ftol (float, optional): Tolerance of the optimizer and of the reduction per stage. Defaults to 1e-04.
+
+    Returns:
+        tuple[tuple[np.ndarray, np.ndarray, np.ndarray], pd.DataFrame]: Estimated log. theta, log. d_p and log. d_m of the 
+            best fit and per start its final objective, number of stages and whether it was terminated early
+    """
+    if n_starts < 1:
+        raise ValueError(f"n_starts must be positive, got {n_starts}")
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be positive, got {n_jobs}")
+    plan = dat if isinstance(dat, DatasetPlan) else DatasetPlan(dat)
+    n_total = plan.n_total
+    init = np.concatenate([np.asarray(p).flatten() for p in indep(plan.dat)])
+    noise = np.array(jrp.normal(key, (n_starts, init.shape[0])))
+    noise[0] = 0.
+    # Events that never occur keep their vanishing base rate
+    noise[:, init <= -1e09] = 0.
+    params = init + scale*noise
+    objective = np.full(n_starts, np.inf)
+    n_stages = np.zeros(n_starts, dtype=int)
+    terminated = np.zeros(n_starts, dtype=bool)
+
+    def advance(run_stage: Callable[[list[np.ndarray]], Iterable[tuple[np.ndarray, float]]]) -> None:
+        running = list(range(n_starts))
+        while running:
+            finished = []
+            for i, (params_i, obj) in zip(running, run_stage([params[i] for i in running])):
+                # Before the first stage the objective is inf, which never counts as converged
+                if np.isfinite(objective[i]) and objective[i] - obj <= opt_ftol * max(abs(objective[i]), abs(obj), 1.):
+                    finished.append(i)
+                params[i], objective[i] = params_i, obj
+                n_stages[i] += 1
+            leader = np.min(objective)
+            for i in running:
+                if objective[i] - leader > margin * max(abs(leader), 1.):
+                    terminated[i] = True
+                    logging.info(f"Start {i} terminated after {n_stages[i]} stages, objective: {objective[i]}")
+            running = [i for i in running if i not in finished and not terminated[i]]
+
+    logging.info(f"Multi-start with {n_starts} starts started")
+    if n_jobs == 1:
+        advance(lambda ps: [_fit_stage(plan, p, penal_fun, w_penal, m_p_corr, stage_iter, opt_ftol) for p in ps])
+    else:
+        n_devices = None if plan.mesh is None else plan.mesh.size
+        dat_np = np.asarray(plan.dat, dtype=np.int8)
+        shm = shared_memory.SharedMemory(create=True, size=dat_np.nbytes)
+        try:
+            np.ndarray(dat_np.shape, dtype=np.int8, buffer=shm.buf)[:] = dat_np
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context("spawn"), 
+                                     initializer=_init_ms_worker, 
+                                     initargs=(shm.name, dat_np.shape, n_devices, plan.dtype, penal_fun, w_penal, m_p_corr)
+                                     ) as pool:
+                advance(lambda ps: pool.map(_ms_worker_stage, ps, repeat(stage_iter), repeat(opt_ftol)))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    best = int(np.argmin(objective))
+    logging.info(f"Multi-start finished, best start: {best}, objective: {objective[best]}")
+    scores = pd.DataFrame({"objective": objective, "n_stages": n_stages, "terminated": terminated})
+    return _unflatten(params[best], n_total), scores
 
 
 def plot_theta(ax1: plt.Axes, ax2: plt.Axes, model: np.ndarray, events: list,
@@ -2,5 +2,4 @@ from metmhn.jx import kronvec
 from metmhn.jx import likelihood
 from metmhn.jx import vanilla
 from metmhn.jx import one_event
-
-
+from metmhn.jx import optimizers
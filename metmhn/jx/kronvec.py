@@ -1,7 +1,9 @@
-from functools import partial
-from jax import jit, lax
+from functools import partial, lru_cache
+from jax import jit, lax, vmap
+from typing import Callable
 import jax.numpy as jnp
 import jax
+import numpy as np
 
 
 def diagnosis_theta(log_theta: jnp.ndarray, log_diag_rates: jnp.ndarray) -> jnp.ndarray:
@@ -496,9 +498,48 @@ def kronvec_seed(
         )
 
 
-@partial(jit, static_argnames=["diag", "transpose"])
+# Largest number of entries n * 2**n_state of the stacked summands, that kronvec, kronvec_fused and kron_diag
+# evaluate at once if parallel=None
+_PARALLEL_MAX_ENTRIES = 2**22
+
+
+def set_parallel_max_entries(n_entries: int) -> None:
+    """Sets the largest number of entries n * 2**n_state of the summands of all n events, that kronvec,
+    kronvec_fused and kron_diag evaluate at once if parallel=None. Larger problems accumulate the summands one
+    event after another. The batched kernels of regularized_optimization evaluate all datapoints of a bucket at 
+    once, there the threshold bounds the entries of the whole batch. Clears the caches of jax, such that kernels 
+    traced with the previous threshold are recompiled.
+
+    Args:
+        n_entries (int): Number of entries, 0 disables the parallel evaluation
+    """
+    global _PARALLEL_MAX_ENTRIES
+    _PARALLEL_MAX_ENTRIES = n_entries
+    jax.clear_caches()
+
+
+def _use_parallel(parallel: bool | None, n: int, n_state: int, n_batch: int = 1) -> bool:
+    # n_batch is the number of products evaluated at once by an enclosing vmap
+    if parallel is None:
+        return n_batch * n * 2**n_state <= _PARALLEL_MAX_ENTRIES
+    return parallel
+
+
+def _sum_events(event: Callable, seed: jnp.ndarray, n: int, parallel: bool) -> jnp.ndarray:
+    # seed + sum_i event(i, 0), event(i, y) adds the summand of the i-th event to y
+    if parallel:
+        return jnp.sum(vmap(event, (0, None))(jnp.arange(n), jnp.zeros_like(seed)), axis=0) + seed
+    return lax.fori_loop(
+        lower=0,
+        upper=n,
+        body_fun=event,
+        init_val=seed
+    )
+
+
+@partial(jit, static_argnames=["diag", "transpose", "parallel"])
 def kronvec(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray,
-            diag: bool = True, transpose: bool = False
+            diag: bool = True, transpose: bool = False, parallel: bool | None = None
             ) -> jnp.ndarray:
     """
     This computes the restricted version of the product of the rate matrix Q with a vector p.
@@ -510,10 +551,18 @@ def kronvec(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray,
         state (jnp.ndarray): Binary state vector, representing the current sample's events.
         diag (bool, optional): Whether to use the diagonal of Q (and not set it to 0). Defaults to True.
         transpose (bool, optional): Whether to transpose Q before multiplying. Defaults to False.
+        parallel (bool | None, optional): Whether to evaluate the summands of all events at once instead of
+            accumulating the Kronecker products one event after another. The parallel summands are the ones of
+            kronvec_fused. None decides by the number of entries n * 2**n_state, see set_parallel_max_entries.
+            Defaults to None.
 
     Returns:
         jnp.array: Q p
     """
+    n = log_theta.shape[0]-1
+    if _use_parallel(parallel, n, int(np.log2(p.shape[0]))):
+        return _sum_events(*_fused_terms(log_theta, p, state, diag, True, transpose), n, True)
+
     def body_fun(i, val):
 
         val += kronvec_sync(log_theta=log_theta, p=p, i=i,
@@ -525,7 +574,6 @@ def kronvec(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray,
 
         return val
 
-    n = log_theta.shape[0]-1
     y = lax.fori_loop(
         lower=0,
         upper=n,
@@ -539,6 +587,102 @@ def kronvec(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray,
     return y
 
 
+@lru_cache(maxsize=None)
+def _bit_halves(n_state: int) -> tuple[int, np.ndarray, np.ndarray]:
+    # Bits of the indices of the lower h and of the upper n_state-h bits of a restricted state space
+    h = n_state // 2
+    lo = (np.arange(2**h)[:, None] >> np.arange(h)) & 1
+    hi = (np.arange(2**(n_state - h))[:, None] >> np.arange(n_state - h)) & 1
+    return h, lo, hi
+
+
+def _fused_terms(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray, diag: bool, off_diag: bool,
+                 transpose: bool) -> tuple[Callable, jnp.ndarray]:
+    # Summands of kronvec_fused: event(i, y) adds the one of the i-th event to y, the second entry is the one of the
+    # seeding. off_diag=False only keeps the diagonal, i.e. diag(Q) * p.
+    n = log_theta.shape[0] - 1
+    n_state = int(np.log2(p.shape[0]))
+    h, lo, hi = _bit_halves(n_state)
+    lo, hi = jnp.asarray(lo, dtype=p.dtype), jnp.asarray(hi, dtype=p.dtype)
+    s = jnp.arange(p.shape[0], dtype=jnp.int32)
+    # Event and tumor of each bit of the restricted state space, the seeding bit belongs to neither tumor
+    q = jnp.where(state == 1, size=n_state)[0]
+    ev = jnp.minimum(q // 2, n)
+    is_p = ((q % 2 == 0) & (q < 2*n)).astype(p.dtype)
+    is_m = (q % 2 == 1).astype(p.dtype)
+    # Restricted bit of each position of the full state, 0 if it is not in state
+    fmask = jnp.where(state == 1, 1 << (jnp.cumsum(state) - 1), 0).astype(jnp.int32)
+    m_p, m_m, m_s = fmask[0:2*n:2], fmask[1:2*n:2], fmask[2*n]
+    both = jnp.sum(jnp.where((m_p > 0) & (m_m > 0), m_p, 0))
+    single = jnp.sum(jnp.where((m_p > 0) != (m_m > 0), m_p | m_m, 0))
+    # PT and MT agree in a state, if the bits of events in both are equal and the bits of all other events are unset
+    pure = (((s ^ (s >> 1)) & both) == 0) & ((s & single) == 0)
+    seeded = (s & m_s) > 0
+
+    def rates(log_base: jnp.ndarray, coef: jnp.ndarray) -> jnp.ndarray:
+        # exp(log_base + sum_r bit_r(s) coef_r) for all states s
+        if p.dtype == jnp.float32:
+            # The rates of the halves can overflow or underflow in single precision, although their product does not
+            return jnp.exp((hi @ coef[h:] + log_base)[:, None] + (lo @ coef[:h])[None, :]).reshape(-1)
+        r_hi = jnp.exp(hi @ coef[h:] + log_base)
+        r_lo = jnp.exp(lo @ coef[:h])
+        return (r_hi[:, None] * r_lo[None, :]).reshape(-1)
+
+    def transition(y: jnp.ndarray, r: jnp.ndarray, m: jnp.ndarray, in_space: jnp.ndarray) -> jnp.ndarray:
+        # r: Rate of the transition that adds the bits m in the state it leaves, 0 if it is impossible. 
+        # It leaves the restricted state space, unless in_space is true.
+        if diag:
+            y = y - r * p
+        if not off_diag:
+            return y
+        if transpose:
+            return y + jnp.where(in_space, r * p[s | m], 0.)
+        return y + jnp.where(in_space & ((s & m) == m), (r * p)[s ^ m], 0.)
+
+    def event(i, y):
+        lt_i = log_theta[i, ev]
+        no_p, no_m = (s & m_p[i]) == 0, (s & m_m[i]) == 0
+        r = rates(log_theta[i, i], lt_i * is_p)
+        y = transition(y, jnp.where(pure & ~seeded & no_p & no_m, r, 0.), m_p[i] | m_m[i], (m_p[i] > 0) & (m_m[i] > 0))
+        y = transition(y, jnp.where(seeded & no_p, r, 0.), m_p[i], m_p[i] > 0)
+        r = rates(log_theta[i, i] + log_theta[i, n], lt_i * is_m)
+        return transition(y, jnp.where(seeded & no_m, r, 0.), m_m[i], m_m[i] > 0)
+
+    r = rates(log_theta[n, n], log_theta[n, ev] * is_p)
+    return event, transition(jnp.zeros_like(p), jnp.where(pure & ~seeded, r, 0.), m_s, m_s > 0)
+
+
+@partial(jit, static_argnames=["diag", "transpose", "parallel"])
+def kronvec_fused(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray,
+                  diag: bool = True, transpose: bool = False, parallel: bool | None = None
+                  ) -> jnp.ndarray:
+    """
+    This computes the same product Q p as kronvec in a single pass over the events. Instead of applying the n+1 
+    Kronecker factors of each of the 3n+1 summands, the rates of the sync, prim and met transitions of an event and 
+    of the seeding are evaluated for all states at once. The log. rates are sums over the bits of a state, hence 
+    their exponentials factor into the products of two vectors of length 2**(n_state/2), one for the lower and one 
+    for the upper half of the bits. In single precision the factors can leave the range of float32, hence there the 
+    summed log. rates are exponentiated at once.
+
+    Args:
+        log_theta (jnp.ndarray): theta matrix with log. entries
+        p (jnp.ndarray): Vector to multiply with from the right. Length must equal the number of
+            nonzero entries in the state vector.
+        state (jnp.ndarray): Binary state vector, representing the current sample's events.
+        diag (bool, optional): Whether to use the diagonal of Q (and not set it to 0). Defaults to True.
+        transpose (bool, optional): Whether to transpose Q before multiplying. Defaults to False.
+        parallel (bool | None, optional): Whether to evaluate the summands of all events at once instead of one
+            after another. None decides by the number of entries n * 2**n_state, see set_parallel_max_entries.
+            Defaults to None.
+
+    Returns:
+        jnp.array: Q p
+    """
+    n = log_theta.shape[0] - 1
+    return _sum_events(*_fused_terms(log_theta, p, state, diag, True, transpose), n, 
+                       _use_parallel(parallel, n, int(np.log2(p.shape[0]))))
+
+
 @partial(jit, static_argnames=["diag", "transpose"])
 def mto_kronvec(log_theta: jnp.ndarray, p: jnp.ndarray, state: jnp.ndarray,
             diag: bool = True, transpose: bool = False
@@ -961,18 +1105,26 @@ def kron_seed_diag(
 
     return diag
 
-@partial(jit, static_argnames=["n_state"])
-def kron_diag(log_theta: jnp.ndarray, state: jnp.ndarray, n_state: int) -> jnp.ndarray:
+@partial(jit, static_argnames=["n_state", "parallel"])
+def kron_diag(log_theta: jnp.ndarray, state: jnp.ndarray, n_state: int, parallel: bool | None = None
+              ) -> jnp.ndarray:
     """This computes diagonal of the rate matrix Q.
 
     Args:
         log_theta (jnp.ndarray): Theta matrix with log entries
         state (jnp.ndarray): Binary state vector, representing the current sample's events.
         n_state (int): Number of non zero bits in state
+        parallel (bool | None, optional): Whether to evaluate the summands of all events at once instead of
+            accumulating the Kronecker products one event after another. The parallel summands are the diagonals
+            of the ones of kronvec_fused. None decides by the number of entries n * 2**n_state, see 
+            set_parallel_max_entries. Defaults to None.
 
     Returns:
         jnp.ndarray: diag(Q)
     """
+    n = log_theta.shape[0] - 1
+    if _use_parallel(parallel, n, n_state):
+        return _sum_events(*_fused_terms(log_theta, jnp.ones(2**n_state), state, True, False, False), n, True)
 
     def body_fun(i, val):
 
@@ -985,7 +1137,6 @@ def kron_diag(log_theta: jnp.ndarray, state: jnp.ndarray, n_state: int) -> jnp.n
 
         return val
 
-    n = log_theta.shape[0] - 1
     y = jnp.zeros(2**n_state)
     y = lax.fori_loop(
         lower=0,
@@ -1028,6 +1179,25 @@ def mto_kron_diag(log_theta: jnp.ndarray, state: jnp.ndarray, n_state: int) -> j
 
     return y
 
+@lru_cache(maxsize=None)
+def popcount_levels(n_state: int) -> tuple[np.ndarray, ...]:
+    """Groups the indices of a restricted state space of size 2**n_state by their number of set bits. 
+    Transitions only ever add a bit, hence a rate matrix restricted to this space is triangular with 
+    respect to this ordering and states in the same level do not interact.
+
+    Args:
+        n_state (int): Number of non zero bits in state
+
+    Returns:
+        tuple[np.ndarray, ...]: n_state+1 arrays, the l-th one holds the indices with l set bits
+    """
+    idx = np.arange(2**n_state, dtype=np.int32)
+    pop = np.zeros_like(idx)
+    for j in range(n_state):
+        pop += (idx >> j) & 1
+    return tuple(idx[pop == l] for l in range(n_state+1))
+
+
 def shuffle_stride2(p: jnp.ndarray) -> jnp.ndarray:
     p = p.reshape((-1, 2), order="C")
     return p.ravel(order="F")
@@ -3,7 +3,7 @@ from metmhn.jx.kronvec import (
                         kronvec_met, 
                         kronvec_prim, 
                         kronvec_seed, 
-                        kronvec,
+                        kronvec_fused,
                         kron_diag,
                         diag_scal_p,
                         diag_scal_m, 
@@ -12,14 +12,17 @@ from metmhn.jx.kronvec import (
                         partial_diag_scal_p,
                         partial_diag_scal_m,
                         mto_kronvec,
-                        mto_kron_diag
+                        mto_kron_diag,
+                        popcount_levels
                         )
 
 from metmhn.jx import vanilla as mhn
 from metmhn.jx import one_event as one
 import jax.numpy as jnp
-from jax import jit, lax
+import numpy as np
+from jax import jit, lax, custom_vjp
 from functools import partial
+from jax.scipy.linalg import solve_triangular
 
 
 def f0(s: jnp.ndarray, p: jnp.ndarray, m: jnp.ndarray
@@ -228,31 +231,95 @@ def x_partial_D_y(log_d_m: jnp.ndarray, log_d_p: jnp.ndarray, state: jnp.ndarray
     return d_dp, d_dm
 
 
-@partial(jit, static_argnames=["transpose", "state_size"])
-def R_i_inv_vec(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, x: jnp.ndarray, 
-                state: jnp.ndarray, state_size: int, transpose: bool = False) -> jnp.ndarray:
-    """This computes The inverse of the resolvent of Q times a vector x: (D-Q)^{-1}x
+def _joint_transitions(log_theta: jnp.ndarray, state: jnp.ndarray, state_size: int, idx: np.ndarray, 
+                       dtype: jnp.dtype, transpose: bool) -> tuple[jnp.ndarray, jnp.ndarray]:
+    # rates[s, c]: Rate of the transition c between the restricted state idx[s] and its predecessor nbrs[s, c] 
+    # (or its successor, if transposed). Rates of impossible transitions are 0. There are four kinds of transitions:
+    # prim_i/met_i: Event i in the PT/MT after the seeding, sync_i: Event i in both before the seeding, seed
+    n = log_theta.shape[0] - 1
+    q = jnp.where(state == 1, size=state_size)[0]
+    events = jnp.arange(n)
+    is_p = ((q[:, None] // 2) == events) & (q[:, None] % 2 == 0)
+    is_m = ((q[:, None] // 2) == events) & (q[:, None] % 2 == 1)
+    is_s = q == 2*n
+    # Restricted bit of each position of the full state, 0 if it is not in state
+    fmask = jnp.where(state == 1, 1 << (jnp.cumsum(state) - 1), 0)
+    m_p, m_m, m_s = fmask[0:2*n:2], fmask[1:2*n:2], fmask[2*n]
+    m_sync = m_p | m_m
+    seeded = state[2*n] == 1
+    en_p = (state[0:2*n:2] == 1) & seeded
+    en_m = (state[1:2*n:2] == 1) & seeded
+    en_sync = (state[0:2*n:2] == 1) & (state[1:2*n:2] == 1)
+    lt = log_theta[:n, :n]
+    dg = jnp.diagonal(lt)
+    bits = 1 << np.arange(state_size, dtype=np.int32)
+    
+    b = ((idx[:, None] & bits) > 0).astype(dtype)
+    P = b @ is_p.astype(dtype)
+    M = b @ is_m.astype(dtype)
+    s = (b @ is_s.astype(dtype)) > 0
+    pure = jnp.all(P == M, axis=1)
+    ii = idx[:, None]
+    # Log-rates are evaluated in the state that is entered, the diagonal entry is missing from the 
+    # target's perspective as event i is already in it and has to be added from the source's perspective
+    l_p, l_m, l_s = P @ lt.T, M @ lt.T + log_theta[:n, n], P @ log_theta[n, :n] + log_theta[n, n]
+    if transpose:
+        l_p, l_m = l_p + dg, l_m + dg
+        ok = lambda m: (ii & m) == 0
+        nbr = lambda m: ii | m
+        ok_s = (idx & m_s) == 0
+    else:
+        ok = lambda m: (ii & m) == m
+        nbr = lambda m: ii ^ m
+        ok_s = (idx & m_s) == m_s
+    # The seed and the sync events only happen in states, where PT and MT agree
+    valid = jnp.concatenate([en_p & ok(m_p) & s[:, None], 
+                             en_m & ok(m_m) & s[:, None], 
+                             en_sync & ok(m_sync) & ~s[:, None] & pure[:, None], 
+                             (seeded & ok_s & pure)[:, None]], axis=1)
+    rates = jnp.where(valid, jnp.exp(jnp.concatenate([l_p, l_m, l_p, l_s[:, None]], axis=1)), 0.)
+    nbrs = jnp.concatenate([nbr(m_p), nbr(m_m), nbr(m_sync), nbr(m_s)], axis=1)
+    return rates, nbrs
+
+
+def _r_i_levels(log_theta: jnp.ndarray, x: jnp.ndarray, state: jnp.ndarray, state_size: int, 
+                lidg: jnp.ndarray, transpose: bool) -> jnp.ndarray:
+    # Forward substitution over the levels of the restricted state space, a state with l bits only 
+    # receives mass from states with fewer bits (or sends it to states with more bits if transposed)
+    levels = popcount_levels(state_size)
+    y = jnp.zeros_like(x)
+    for idx in (levels[::-1] if transpose else levels):
+        rates, nbrs = _joint_transitions(log_theta, state, state_size, idx, x.dtype, transpose)
+        y = y.at[idx].set(lidg[idx] * (x[idx] + jnp.sum(rates * y[nbrs], axis=1)))
+    return y
 
-    Args:
-        log_theta (jnp.ndarray): Theta matrix with logarithmic entries
-        log_d_p (jnp.ndarray): Log. effects of muts in PT on PT-diagnosis
-        log_d_m (jnp.ndarray): Log. effects of muts in MT on MT-diagnosis
-        x (jnp.ndarray): Vector of size 2**state_size
-        state (jnp.ndarray): Bitstring, genotype of observation
-        state_size (int): Number of nonzero entries in state
-        transpose (bool, optional): If true calculate vec^T (I - Q)^{-1}. Defaults to False.
 
-    Returns:
-        jnp.ndarray: (D-Q)^{-1}x
-    """
+def _r_i_dense(log_theta: jnp.ndarray, x: jnp.ndarray, state: jnp.ndarray, state_size: int, 
+               lidg: jnp.ndarray, transpose: bool) -> jnp.ndarray:
+    # Builds D-Q explicitly, it is lower triangular as transitions only add events
+    idx = np.arange(2**state_size, dtype=np.int32)
+    rates, nbrs = _joint_transitions(log_theta, state, state_size, idx, x.dtype, False)
+    r = jnp.diag(1/lidg).at[idx[:, None], nbrs].add(-rates)
+    return solve_triangular(r, x, lower=True, trans=int(transpose))
+
+
+@partial(custom_vjp, nondiff_argnums=(5, 6, 7, 8))
+def _r_i_solve(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, x: jnp.ndarray, 
+               state: jnp.ndarray, state_size: int, transpose: bool, method: str, parallel: bool | None) -> jnp.ndarray:
     y = jnp.ones_like(x)
-    lidg = -1. / (kron_diag(log_theta=log_theta, state=state, n_state=state_size) - 
+    lidg = -1. / (kron_diag(log_theta=log_theta, state=state, n_state=state_size, parallel=parallel) - 
                   (diag_scal_p(log_d_p, state, y) + diag_scal_m(log_d_m, state, y)))
+    if method == "levels":
+        return _r_i_levels(log_theta, x, state, state_size, lidg, transpose)
+    if method == "dense":
+        return _r_i_dense(log_theta, x, state, state_size, lidg, transpose)
+    
     y = lidg * x
     
     def body_fun(index, carry):
-       return lidg * (kronvec(log_theta=log_theta, p=carry, state=state, 
-                              diag=False, transpose=transpose) + x)
+       return lidg * (kronvec_fused(log_theta=log_theta, p=carry, state=state, 
+                                    diag=False, transpose=transpose, parallel=parallel) + x)
+    # Q without its diagonal is nilpotent, hence the iteration is exact after state_size+1 steps
     y = lax.fori_loop(
         lower=0,
         upper=state_size+1,
@@ -262,6 +329,58 @@ def R_i_inv_vec(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarr
     return y
 
 
+def _r_i_solve_fwd(log_theta, log_d_p, log_d_m, x, state, state_size, transpose, method, parallel):
+    y = _r_i_solve(log_theta, log_d_p, log_d_m, x, state, state_size, transpose, method, parallel)
+    return y, (log_theta, log_d_p, log_d_m, state, y)
+
+
+def _r_i_solve_bwd(state_size, transpose, method, parallel, res, y_bar):
+    # With y = (D-Q)^{-1}x the adjoint is one solve with the transposed resolvent, x_bar = (D-Q)^{-T} y_bar, 
+    # and the parameters receive x_bar^T \partial(Q-D) y, with x_bar and y swapped if the resolvent was transposed
+    log_theta, log_d_p, log_d_m, state, y = res
+    x_bar = _r_i_solve(log_theta, log_d_p, log_d_m, y_bar, state, state_size, not transpose, method, parallel)
+    left, right = (y, x_bar) if transpose else (x_bar, y)
+    th_bar = x_partial_Q_y(log_theta, left, right, state)
+    dp_bar, dm_bar = x_partial_D_y(log_d_m, log_d_p, state, left, right)
+    return th_bar, -dp_bar, -dm_bar, x_bar, None
+
+
+_r_i_solve.defvjp(_r_i_solve_fwd, _r_i_solve_bwd)
+
+
+@partial(jit, static_argnames=["transpose", "state_size", "method", "parallel"])
+def R_i_inv_vec(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, x: jnp.ndarray, 
+                state: jnp.ndarray, state_size: int, transpose: bool = False, method: str = "auto", 
+                parallel: bool | None = None) -> jnp.ndarray:
+    """This computes The inverse of the resolvent of Q times a vector x: (D-Q)^{-1}x. 
+    Its derivative is defined by a custom VJP, that costs a single solve with the transposed resolvent, 
+    such that jax.grad does not store the iterates of the solver.
+
+    Args:
+        log_theta (jnp.ndarray): Theta matrix with logarithmic entries
+        log_d_p (jnp.ndarray): Log. effects of muts in PT on PT-diagnosis
+        log_d_m (jnp.ndarray): Log. effects of muts in MT on MT-diagnosis
+        x (jnp.ndarray): Vector of size 2**state_size
+        state (jnp.ndarray): Bitstring, genotype of observation
+        state_size (int): Number of nonzero entries in state
+        transpose (bool, optional): If true calculate vec^T (I - Q)^{-1}. Defaults to False.
+        method (str, optional): "jacobi" applies state_size+1 sweeps with the full Kronecker product, 
+            "levels" substitutes once through the states grouped by their number of events, "dense" solves 
+            the explicit triangular matrix. "auto" uses "dense" for state spaces up to the size set by 
+            vanilla.set_dense_max_state and "jacobi" otherwise. Defaults to "auto".
+        parallel (bool | None, optional): Whether kron_diag and the sweeps of "jacobi" evaluate the summands of all 
+            events at once, see kronvec.kronvec_fused. Defaults to None.
+
+    Returns:
+        jnp.ndarray: (D-Q)^{-1}x
+    """
+    if method not in ("auto", "jacobi", "levels", "dense"):
+        raise ValueError(f"Unknown solver method {method}, use 'auto', 'jacobi', 'levels' or 'dense'")
+    if method == "auto":
+        method = "dense" if state_size <= mhn._DENSE_MAX_STATE else "jacobi"
+    return _r_i_solve(log_theta, log_d_p, log_d_m, x, state, state_size, transpose, method, parallel)
+
+
 def cond_p_obs(pTh1_joint: jnp.ndarray, state_joint: jnp.ndarray, n_joint: int, n_single: int, pt_first: bool) -> jnp.ndarray:
     """Calculate the distribution of primary tumors/metastases conditioned on the observed genotype of 
     the other tumor at first observation
@@ -284,7 +403,8 @@ def cond_p_obs(pTh1_joint: jnp.ndarray, state_joint: jnp.ndarray, n_joint: int,
 
 
 def _lp_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-                  state_joint:jnp.ndarray, n_prim:int, n_met:int) -> jnp.ndarray:
+                  state_joint:jnp.ndarray, n_prim:int, n_met:int, log_scale: float = 0., 
+                  parallel: bool | None = None) -> jnp.ndarray:
     """This computes the log. prob to observe a PT and a PT in the same patient at the same time
 
     Args:
@@ -294,14 +414,18 @@ def _lp_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nda
         state_joint (jnp.ndarray): Bitstring, genotypes of PT and MT
         n_prim (jnp.ndarray): Number of nonzero bits in PT-part of state_joint
         n_met (jnp.ndarray): Number of nonzero bit in MT-part of state_joint
+        log_scale (float, optional): Log. of the initial probability mass, that keeps small probabilities 
+            in the range of the floating point type. It is subtracted from the result. Defaults to 0.
+        parallel (bool | None, optional): Whether the joint resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
 
     Returns:
         jnp.ndarray: log(P(state_joint|Theta, d_p, d_m))
     """
     n_joint = n_prim + n_met - 1
     p0 = jnp.zeros(2**n_joint)
-    p0 = p0.at[0].set(1.)
-    pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p0, state_joint, n_joint)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
+    pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p0, state_joint, n_joint, parallel=parallel)
     pf_pTh1_cond_obs = cond_p_obs(diag_scal_p(log_d_p, state_joint, pTh1_joint), state_joint, n_joint, n_met, True)
     mf_pTh1_cond_obs = cond_p_obs(diag_scal_m(log_d_m, state_joint, pTh1_joint), state_joint, n_joint, n_prim, False)
     
@@ -313,12 +437,13 @@ def _lp_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nda
     theta_pt = log_theta.at[:-1,-1].set(0.)
     theta_pt = diagnosis_theta(theta_pt, log_d_p)
     mf_pTh2 = mhn.R_inv_vec(theta_pt, mf_pTh1_cond_obs, prim)
-    return jnp.log(pf_pTh2[-1] + mf_pTh2[-1])
+    return jnp.log(pf_pTh2[-1] + mf_pTh2[-1]) - log_scale
 
 
 
 def _lp_coupled_1(log_theta:jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-                  state_joint: jnp.ndarray, n_prim: int, n_met: int) -> jnp.ndarray:
+                  state_joint: jnp.ndarray, n_prim: int, n_met: int, log_scale: float = 0., 
+                  parallel: bool | None = None) -> jnp.ndarray:
     """This computes the log. prob to first observe a PT and later a MT in the same patient
 
     Args:
@@ -328,14 +453,18 @@ def _lp_coupled_1(log_theta:jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
         state_joint (jnp.ndarray): Bitstring, genotypes of PT and MT
         n_prim (jnp.ndarray): Number of nonzero bits in PT-part of state_joint
         n_met (jnp.ndarray): Number of nonzero bit in MT-part of state_joint
+        log_scale (float, optional): Log. of the initial probability mass, that keeps small probabilities 
+            in the range of the floating point type. It is subtracted from the result. Defaults to 0.
+        parallel (bool | None, optional): Whether the joint resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
 
     Returns:
         jnp.ndarray: log(P(state_joint|Theta, d_p, d_m))
     """
     joint_size = n_prim + n_met - 1
     p0 = jnp.zeros(2**joint_size)
-    p0 = p0.at[0].set(1.)
-    pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p0, state_joint, joint_size)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
+    pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p0, state_joint, joint_size, parallel=parallel)
     pTh1_joint = diag_scal_p(log_d_p, state_joint, pTh1_joint)
     
     compatible_states = obs_states(n_joint=joint_size, state=state_joint, pt_first=True)
@@ -347,11 +476,12 @@ def _lp_coupled_1(log_theta:jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
     met = jnp.append(state_joint[1::2], 1)
     log_theta_scal = diagnosis_theta(log_theta, log_d_m)
     pTh2 = mhn.R_inv_vec(log_theta_scal, pTh1_cond_obs, met)
-    return jnp.log(pTh2[-1])
+    return jnp.log(pTh2[-1]) - log_scale
 
 
 def _lp_coupled_2(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-                  state_joint: jnp.ndarray, n_prim: int, n_met: int) -> jnp.ndarray:
+                  state_joint: jnp.ndarray, n_prim: int, n_met: int, log_scale: float = 0., 
+                  parallel: bool | None = None) -> jnp.ndarray:
     """This computes the log. prob to first observe a MT and later a PT in the same patient
 
     Args:
@@ -361,14 +491,18 @@ def _lp_coupled_2(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nda
         state_joint (jnp.ndarray): Bitstring, genotypes of PT and MT
         n_prim (jnp.ndarray): Number of nonzero bits in PT-part of state_joint
         n_met (jnp.ndarray): Number of nonzero bit in MT-part of state_joint
+        log_scale (float, optional): Log. of the initial probability mass, that keeps small probabilities 
+            in the range of the floating point type. It is subtracted from the result. Defaults to 0.
+        parallel (bool | None, optional): Whether the joint resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
 
     Returns:
         jnp.ndarray: log(P(state_joint|Theta, d_p, d_m))
     """
     joint_size = n_prim + n_met - 1
     p0 = jnp.zeros(2**joint_size)
-    p0 = p0.at[0].set(1.)
-    pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p0, state_joint, joint_size)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
+    pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p0, state_joint, joint_size, parallel=parallel)
     pTh1_joint = diag_scal_m(log_d_m, state_joint, pTh1_joint)
     
     compatible_states = obs_states(joint_size, state_joint, False)
@@ -381,11 +515,11 @@ def _lp_coupled_2(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nda
     theta_pt = log_theta.at[:-1,-1].set(0.)
     theta_pt = diagnosis_theta(theta_pt, log_d_p)
     pTh2 = mhn.R_inv_vec(theta_pt, pTh1_cond_obs, prim)
-    return jnp.log(pTh2[-1])
+    return jnp.log(pTh2[-1]) - log_scale
 
     
 def _lp_prim_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray,
-                 state_pt: jnp.ndarray, n_prim: int) -> jnp.ndarray:
+                 state_pt: jnp.ndarray, n_prim: int, target: int = -1, log_scale: float = 0.) -> jnp.ndarray:
     """This computes the log Prob. to observe an uncoupled primary tumor with genotype state_pt
 
     Args:
@@ -393,6 +527,9 @@ def _lp_prim_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray,
         log_d_p (jnp.ndarray): Logrithmic effects of muts in PT on its rate of diagnosis
         state_pt (jnp.ndarray): Bitstring, genotype of tumor 
         n_prim (int): Number of non-zero entries in state_prim
+        target (int, optional): Index of the observed genotype in the restricted state space. Differs from the last
+            index if state_pt contains padding events. Defaults to -1.
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
 
     Returns:
         jnp.ndarray: log(P(state_pt| \theta))
@@ -400,9 +537,9 @@ def _lp_prim_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray,
     log_theta_pt = log_theta.at[:-1,-1].set(0.)
     log_theta_pt = diagnosis_theta(log_theta_pt, log_d_p)
     p0 = jnp.zeros(2**n_prim)
-    p0 = p0.at[0].set(1.)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
     pTh = mhn.R_inv_vec(log_theta_pt, p0, state_pt, jnp.ones_like(p0))
-    return jnp.log(pTh[-1])
+    return jnp.log(pTh[target]) - log_scale
 
 
 def _lp_prim_obs_az(log_theta) -> jnp.ndarray:
@@ -417,7 +554,7 @@ def _lp_prim_obs_az(log_theta) -> jnp.ndarray:
 
 
 def _lp_met_obs(log_theta: jnp.ndarray, log_d_pt: jnp.ndarray, log_d_mt: jnp.ndarray, 
-                state_mt: jnp.ndarray, n_met: int) -> jnp.ndarray:
+                state_mt: jnp.ndarray, n_met: int, target: int = -1, log_scale: float = 0.) -> jnp.ndarray:
     """This computes the log Prob. to observe an uncoupled metastatis with genotype state_mt
 
     Args:
@@ -426,21 +563,24 @@ def _lp_met_obs(log_theta: jnp.ndarray, log_d_pt: jnp.ndarray, log_d_mt: jnp.nda
         log_d_mt (jnp.ndarray): Effects of muts on diagnosis after seeding
         state_mt (jnp.ndarray): Bitstring, genotype of the met.
         n_met (int): Number of nonzero bits in state_mt
+        target (int, optional): Index of the observed genotype in the restricted state space. Differs from the last
+            index if state_mt contains padding events. Defaults to -1.
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
 
     Returns:
         jnp.ndarray: log(P(state_mt | \theta))
     """
     p0 = jnp.zeros(2**n_met)
-    p0 = p0.at[0].set(1.)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
     d_p, d_m = mhn.scal_d_pt(log_d_pt, log_d_mt, state_mt, jnp.ones(2**n_met))
     d_rates = d_p + d_m
     pTh = mhn.R_inv_vec(log_theta, p0, state_mt, d_rates, False)
-    return jnp.log(pTh[-1] * d_rates[-1])
+    return jnp.log(pTh[target] * d_rates[target]) - log_scale
 
  
 @partial(jit, static_argnames=["n_prim"])
-def _grad_prim_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, 
-                   state_prim: jnp.ndarray, n_prim: int) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+def _grad_prim_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, state_prim: jnp.ndarray, n_prim: int, 
+                   target: int = -1, log_scale: float = 0.) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """This computes log prob to observe a PT and its gradients wrt. theta, d_p if n_prim > 0
 
     Args:
@@ -448,17 +588,19 @@ def _grad_prim_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray,
         log_d_p (jnp.ndarray): Log. effects of muts in PT on PT-diagnosis
         state_prim (jnp.ndarray): Bitstring, genotype of PT
         n_prim (int): Number of nonzero entries in PT
+        target (int, optional): Index of the observed genotype in the restricted state space. Defaults to -1.
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
 
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]: log prob, grad wrt. theta, grad wrt. d_p
     """
     p0 = jnp.zeros(2**n_prim)
-    p0 = p0.at[0].set(1.)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
     log_theta_pt = log_theta.at[:-1, -1].set(0.0)
     log_theta_pt = diagnosis_theta(log_theta_pt, log_d_p)
-    d_th, d_dp, pTh2 = mhn.gradient(log_theta_pt, state_prim, p0)
+    d_th, d_dp, pTh2 = mhn.gradient(log_theta_pt, state_prim, p0, target)
     d_th = d_th.at[:-1, -1].set(0.0)
-    return jnp.log(pTh2[-1]), d_th, d_dp
+    return jnp.log(pTh2[target]) - log_scale, d_th, d_dp
 
 
 @jit
@@ -480,7 +622,7 @@ def _grad_prim_obs_az(log_theta: jnp.ndarray) -> tuple[jnp.ndarray, jnp.ndarray,
 
 @partial(jit, static_argnames=["n_met"])
 def _grad_met_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-                   state_met: jnp.ndarray, n_met: int
+                   state_met: jnp.ndarray, n_met: int, target: int = -1, log_scale: float = 0.
                    ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """This computes the log. prob. to observe an MT and its gradients wrt. theta, d_p and d_m
 
@@ -490,6 +632,8 @@ def _grad_met_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nda
         log_d_m (jnp.ndarray): Log. effects of muts in MT on MT-diagnosis
         state_met (jnp.ndarray): bitstring, genotype of MT
         n_met (int): Number of nonzero bits in state_met
+        target (int, optional): Index of the observed genotype in the restricted state space. Defaults to -1.
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
 
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]: log prob, grad wrt. theta, 
@@ -497,24 +641,25 @@ def _grad_met_obs(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nda
     """
 
     p0 = jnp.zeros(2**n_met)
-    p0 = p0.at[0].set(1.)
+    p0 = p0.at[0].set(jnp.exp(log_scale))
     d_p, d_m = mhn.scal_d_pt(log_d_p, log_d_m, state_met, jnp.ones(2**n_met))
     d_rates = d_p + d_m
 
     pTh = mhn.R_inv_vec(log_theta, p0, state_met, d_rates, False)
-    score = pTh[-1]
+    score = pTh[target]
     q = jnp.zeros(2**n_met)
-    q = q.at[-1].set(1/score)
-    _, d_dm_1 = mhn.x_partial_D_y(log_d_p, log_d_m, state_met, q/d_rates[-1], pTh)
+    q = q.at[target].set(1/score)
+    _, d_dm_1 = mhn.x_partial_D_y(log_d_p, log_d_m, state_met, q/d_rates[target], pTh)
     q = mhn.R_inv_vec(log_theta, q, state_met, d_rates, True)
     d_dp, d_dm_2 = mhn.x_partial_D_y(log_d_p, log_d_m, state_met, q,pTh) 
     d_th, _ = mhn.x_partial_Q_y(log_theta, q, pTh, state_met)
-    return jnp.log(score*d_rates[-1]), d_th, -d_dp, d_dm_1 - d_dm_2
+    return jnp.log(score*d_rates[target]) - log_scale, d_th, -d_dp, d_dm_1 - d_dm_2
 
 
 #@partial(jit, static_argnames=["n_joint"])
 def q_inv_deriv_pth(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, q: jnp.ndarray, p: jnp.ndarray, 
-                    state_joint: jnp.ndarray, n_joint: int) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+                    state_joint: jnp.ndarray, n_joint: int, parallel: bool | None = None
+                    ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """Calculate partial derivatives of z = q^T (D_{PM}-Q)^{-1} p_0 = q^T p wrt. theta, log_d_p and log_d_m
 
     Args:
@@ -525,12 +670,14 @@ def q_inv_deriv_pth(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.n
         p (jnp.ndarray): Vector to multiply from the right
         state_joint (jnp.ndarray): Paired primary tumor and metastases state
         n_joint (int): Number of non zero entries in state_joint
+        parallel (bool | None, optional): Whether the resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
 
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]: Partial derivatives of z wrt. theta, log_d_p, log_d_m
     """
     q = R_i_inv_vec(log_theta, log_d_p, log_d_m, q, state_joint, 
-                    n_joint, transpose = True)
+                    n_joint, transpose = True, parallel = parallel)
     g_2 = x_partial_Q_y(log_theta, q, p, state_joint)
     # Derivative wrt diagnosis effects
     d_dp_2, d_dm_2 = x_partial_D_y(log_d_m, log_d_p, state_joint, q, p)
@@ -621,8 +768,8 @@ def marginal_obs_mt_first(log_theta:jnp.ndarray, log_d_p: jnp.ndarray, log_d_m:
 
 
 def _g_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-               state_joint: jnp.ndarray, n_prim: int, n_met: int
-               ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+               state_joint: jnp.ndarray, n_prim: int, n_met: int, log_scale: float = 0., 
+               parallel: bool | None = None) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """This computes the log. prob. to observe a PT and MT in unknown order in the same patient and 
     its gradients wrt to theta, d_p and d_m
 
@@ -633,6 +780,9 @@ def _g_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
         state_joint (jnp.ndarray): Bitstring, genotypes of coupled PT and MT
         n_prim (int): Number of nonzero entries in PT-part of state_joint
         n_met (int): Number of nonzero entries in MT-part of state_joint
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
+        parallel (bool | None, optional): Whether the joint resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]: log_prob, grad wrt. theta,
             grad wrt. d_p, grad wrt. d_m
@@ -641,11 +791,11 @@ def _g_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
     met = jnp.append(state_joint[1::2], 1)
     n_joint = n_prim + n_met -1
     p = jnp.zeros(2**(n_prim + n_met - 1))
-    p = p.at[0].set(1.)
+    p = p.at[0].set(jnp.exp(log_scale))
     
     # Joint and met-marginal distribution at first sampling
     pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p, state_joint, 
-                             n_joint, transpose = False)
+                             n_joint, transpose = False, parallel = parallel)
     
     pf_exp_score, pf_g_1, pf_d_dp_1, pf_d_dm_1, pf_p = marginal_obs_pt_first(log_theta, log_d_p, log_d_m, pTh1_joint, state_joint, met, n_joint, n_met)
     mf_exp_score, mf_g_1, mf_d_dp_1, mf_d_dm_1, mf_p =  marginal_obs_mt_first(log_theta, log_d_p, log_d_m, pTh1_joint, state_joint, prim, n_joint, n_prim)
@@ -654,17 +804,18 @@ def _g_coupled_0(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
     # Derivative of pth1_cond
     pf_p = diag_scal_p(log_d_p, state_joint, pf_p)*pf_exp_score/full_score
     mf_p = diag_scal_m(log_d_m, state_joint, mf_p)*mf_exp_score/full_score
-    g_2, d_dp_2, d_dm_2 = q_inv_deriv_pth(log_theta, log_d_p, log_d_m, pf_p+mf_p, pTh1_joint, state_joint, n_joint)
+    g_2, d_dp_2, d_dm_2 = q_inv_deriv_pth(log_theta, log_d_p, log_d_m, pf_p+mf_p, pTh1_joint, state_joint, n_joint, 
+                                          parallel)
     
     d_dm = (pf_d_dm_1*pf_exp_score + mf_d_dm_1*mf_exp_score)/full_score - d_dm_2
     d_dp = (pf_d_dp_1*pf_exp_score + mf_d_dp_1*mf_exp_score)/full_score - d_dp_2
     grad_th = (pf_g_1*pf_exp_score + mf_g_1*mf_exp_score)/full_score + g_2
-    return jnp.log(full_score), grad_th, d_dp, d_dm
+    return jnp.log(full_score) - log_scale, grad_th, d_dp, d_dm
 
 
 def _g_coupled_1(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-               state_joint: jnp.ndarray, n_prim: int, n_met: int
-               ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+               state_joint: jnp.ndarray, n_prim: int, n_met: int, log_scale: float = 0., 
+               parallel: bool | None = None) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """This computes the log. prob to first observe a PT and then later a MT in the same patient and 
     its gradients wrt to theta, d_p and d_m
 
@@ -675,6 +826,9 @@ def _g_coupled_1(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
         state_joint (jnp.ndarray): Bitstring, genotypes of coupled PT and MT
         n_prim (int): Number of nonzero entries in PT-part of state_joint
         n_met (int): Number of nonzero entries in MT-part of state_joint
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
+        parallel (bool | None, optional): Whether the joint resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]: log_prob, grad wrt. theta,
             grad wrt. d_p, grad wrt. d_m
@@ -682,24 +836,25 @@ def _g_coupled_1(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
     met = jnp.append(state_joint.at[1::2].get(), 1)
     n_joint = n_prim + n_met - 1
     p = jnp.zeros(2**n_joint)
-    p = p.at[0].set(1.)
+    p = p.at[0].set(jnp.exp(log_scale))
     
     pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p, state_joint, 
-                             n_joint, transpose = False)
+                             n_joint, transpose = False, parallel = parallel)
 
     exp_score, g_1, d_dp_1, d_dm_1, p = marginal_obs_pt_first(log_theta, log_d_p, log_d_m, pTh1_joint, state_joint, met, n_joint, n_met)
     # Derivative of pth1_cond
     p = diag_scal_p(log_d_p, state_joint, p)
-    g_2, d_dp_2, d_dm_2 = q_inv_deriv_pth(log_theta, log_d_p, log_d_m, p, pTh1_joint, state_joint, n_joint)
+    g_2, d_dp_2, d_dm_2 = q_inv_deriv_pth(log_theta, log_d_p, log_d_m, p, pTh1_joint, state_joint, n_joint, 
+                                          parallel)
     d_dm = d_dm_1 - d_dm_2
     d_dp = d_dp_1 - d_dp_2
 
-    return jnp.log(exp_score), g_1 + g_2, d_dp, d_dm
+    return jnp.log(exp_score) - log_scale, g_1 + g_2, d_dp, d_dm
 
 
 def _g_coupled_2(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
-               state_joint: jnp.ndarray, n_prim: int, n_met: int
-               ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+               state_joint: jnp.ndarray, n_prim: int, n_met: int, log_scale: float = 0., 
+               parallel: bool | None = None) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """This computes the log. prob to first observe a MT and later PT in the same patient and 
     its gradients wrt to theta, d_p and d_m
 
@@ -710,6 +865,9 @@ def _g_coupled_2(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
         state_joint (jnp.ndarray): Bitstring, genotypes of coupled PT and MT
         n_prim (int): Number of nonzero entries in PT-part of state_joint
         n_met (int): Number of nonzero entries in MT-part of state_joint
+        log_scale (float, optional): Log. of the initial probability mass, see _lp_coupled_0. Defaults to 0.
+        parallel (bool | None, optional): Whether the joint resolvent evaluates the summands of all events at once, 
+            see R_i_inv_vec. Defaults to None.
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]: log_prob, grad wrt. theta,
             grad wrt. d_p, grad wrt. d_m
@@ -717,15 +875,16 @@ def _g_coupled_2(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndar
     prim = state_joint[::2]
     n_joint = n_prim + n_met - 1
     p = jnp.zeros(2**n_joint)
-    p = p.at[0].set(1.)
+    p = p.at[0].set(jnp.exp(log_scale))
     pTh1_joint = R_i_inv_vec(log_theta, log_d_p, log_d_m, p, state_joint, 
-                             n_joint, transpose = False)
+                             n_joint, transpose = False, parallel = parallel)
     exp_score, g_1, d_dp_1, d_dm_1, p =  marginal_obs_mt_first(log_theta, log_d_p, log_d_m, pTh1_joint, state_joint, prim, n_joint, n_prim)
     
     # Derivative of pth1_cond
     p = diag_scal_m(log_d_m, state_joint, p)
-    g_2, d_dp_2, d_dm_2 = q_inv_deriv_pth(log_theta, log_d_p, log_d_m, p, pTh1_joint, state_joint, n_joint)
+    g_2, d_dp_2, d_dm_2 = q_inv_deriv_pth(log_theta, log_d_p, log_d_m, p, pTh1_joint, state_joint, n_joint, 
+                                          parallel)
     d_dp = d_dp_1 - d_dp_2 
     d_dm = d_dm_1 - d_dm_2
 
-    return jnp.log(exp_score), g_1 + g_2, d_dp, d_dm
\ No newline at end of file
+    return jnp.log(exp_score) - log_scale, g_1 + g_2, d_dp, d_dm
\ No newline at end of file
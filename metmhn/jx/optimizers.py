@@ -0,0 +1,278 @@
+import jax.numpy as jnp
+from jax import jit, lax, debug
+from typing import Callable, NamedTuple
+from functools import partial
+
+
+class LBFGSState(NamedTuple):
+    n_iter: int
+    x: jnp.ndarray
+    f: jnp.ndarray
+    g: jnp.ndarray
+    d: jnp.ndarray
+    t: float
+    n_ls: int
+    s_hist: jnp.ndarray
+    y_hist: jnp.ndarray
+    rho_hist: jnp.ndarray
+    n_hist: int
+    status: int
+    n_fev: int
+
+
+class OptimizeResult(NamedTuple):
+    x: jnp.ndarray
+    fun: jnp.ndarray
+    jac: jnp.ndarray
+    nit: int
+    status: int
+    nfev: int
+
+
+# Status codes of the optimizers
+RUNNING, CONVERGED_F, CONVERGED_G, MAX_ITER, LINE_SEARCH_FAILED = 0, 1, 2, 3, 4
+MESSAGES = {RUNNING: "Running",
+            CONVERGED_F: "Converged: rel. reduction of f <= ftol",
+            CONVERGED_G: "Converged: max. abs. gradient <= gtol",
+            MAX_ITER: "Stopped: maximal number of iterations reached",
+            LINE_SEARCH_FAILED: "Stopped: line search failed"}
+
+
+def _report(callback: Callable | None, old_iter: int, state: NamedTuple, f: jnp.ndarray, g: jnp.ndarray):
+    """Passes iteration number, parameters, objective, gradient and number of function evaluations 
+    to the host, if the iteration counter advanced"""
+    if callback is None:
+        return
+    lax.cond(state.n_iter > old_iter, 
+             lambda: debug.callback(callback, state.n_iter, state.x, f, g, state.n_fev, ordered=True), 
+             lambda: None)
+
+
+def two_loop(g: jnp.ndarray, s_hist: jnp.ndarray, y_hist: jnp.ndarray, rho_hist: jnp.ndarray,
+             n_hist: int) -> jnp.ndarray:
+    """Computes H g with H the L-BFGS approximation of the inverse Hessian
+
+    Args:
+        g (jnp.ndarray): Vector to multiply with
+        s_hist (jnp.ndarray): m x n ring buffer of parameter differences, the newest pair is stored at (n_hist-1) % m
+        y_hist (jnp.ndarray): m x n ring buffer of gradient differences
+        rho_hist (jnp.ndarray): m-dimensional ring buffer of 1/(s^T y)
+        n_hist (int): Number of pairs stored so far
+
+    Returns:
+        jnp.ndarray: H g
+    """
+    m = s_hist.shape[0]
+    # Indices into the ring buffer, from newest to oldest pair
+    inds = (n_hist - 1 - jnp.arange(m)) % m
+    valid = jnp.arange(m) < jnp.minimum(n_hist, m)
+
+    def newest_first(q, k):
+        j = inds[k]
+        a = jnp.where(valid[k], rho_hist[j] * jnp.dot(s_hist[j], q), 0.)
+        return q - a * y_hist[j], a
+
+    q, alpha = lax.scan(newest_first, g, jnp.arange(m))
+    s, y = s_hist[inds[0]], y_hist[inds[0]]
+    gamma = jnp.where(n_hist > 0, jnp.dot(s, y) / jnp.dot(y, y), 1.)
+
+    def oldest_first(r, k):
+        j = inds[k]
+        b = jnp.where(valid[k], rho_hist[j] * jnp.dot(y_hist[j], r), 0.)
+        return r + s_hist[j] * (alpha[k] - b), None
+
+    r, _ = lax.scan(oldest_first, gamma * q, jnp.arange(m)[::-1])
+    return r
+
+
+@partial(jit, static_argnames=["fun", "history", "callback"])
+def _lbfgs_run(fun: Callable, x0: jnp.ndarray, args: tuple, maxiter: int, ftol: float, gtol: float, history: int, 
+               max_ls: int, c1: float, callback: Callable | None) -> LBFGSState:
+
+    def accept(state, f_t, g_t):
+        # The initial state has f = inf, its first trial point is x0 itself
+        first = jnp.isinf(state.f)
+        s = state.t * state.d
+        x, y = state.x + s, g_t - state.g
+        sy = jnp.dot(s, y)
+        update = (sy > 1e-10) & ~first
+        j = state.n_hist % history
+        s_hist = jnp.where(update, state.s_hist.at[j].set(s), state.s_hist)
+        y_hist = jnp.where(update, state.y_hist.at[j].set(y), state.y_hist)
+        rho_hist = jnp.where(update, state.rho_hist.at[j].set(1. / jnp.where(update, sy, 1.)), state.rho_hist)
+        n_hist = state.n_hist + update
+        n_iter = state.n_iter + ~first
+
+        rel_red = (state.f - f_t) / jnp.maximum(jnp.maximum(jnp.abs(state.f), jnp.abs(f_t)), 1.)
+        status = jnp.select([~first & (rel_red <= ftol), jnp.max(jnp.abs(g_t)) <= gtol, n_iter >= maxiter],
+                            [CONVERGED_F, CONVERGED_G, MAX_ITER], RUNNING)
+
+        d = -two_loop(g_t, s_hist, y_hist, rho_hist, n_hist)
+        # Fall back to steepest descent if d is not a descent direction
+        d = jnp.where(jnp.dot(d, g_t) < 0, d, -g_t)
+        t = jnp.where(n_hist == 0, jnp.minimum(1., 1. / jnp.linalg.norm(g_t)), 1.)
+        return LBFGSState(n_iter, x, f_t, g_t, d, t, 0, s_hist, y_hist, rho_hist, n_hist, status, state.n_fev)
+
+    def backtrack(state, f_t, g_t):
+        n_ls = state.n_ls + 1
+        status = jnp.where(n_ls >= max_ls, LINE_SEARCH_FAILED, RUNNING)
+        return state._replace(t=0.5 * state.t, n_ls=n_ls, status=status)
+
+    def cond(state):
+        return state.status == RUNNING
+
+    def body(state):
+        f_t, g_t = fun(state.x + state.t * state.d, *args)
+        armijo = f_t <= state.f + c1 * state.t * jnp.dot(state.g, state.d)
+        new_state = lax.cond(armijo, accept, backtrack, state._replace(n_fev=state.n_fev + 1), f_t, g_t)
+        _report(callback, state.n_iter, new_state, new_state.f, new_state.g)
+        return new_state
+
+    n = x0.shape[0]
+    init = LBFGSState(0, x0, jnp.inf, jnp.zeros(n), jnp.zeros(n), 0., 0, jnp.zeros((history, n)), 
+                      jnp.zeros((history, n)), jnp.zeros(history), 0, RUNNING, 0)
+    return lax.while_loop(cond, body, init)
+
+
+def lbfgs(fun: Callable[..., tuple[jnp.ndarray, jnp.ndarray]], x0: jnp.ndarray, maxiter: int = 15000,
+          ftol: float = 2.2e-09, gtol: float = 1e-05, history: int = 10, max_ls: int = 20,
+          c1: float = 1e-04, callback: Callable | None = None, args: tuple = ()) -> OptimizeResult:
+    """Minimizes fun with L-BFGS. Parameters, the history of the inverse Hessian approximation and the
+    backtracking line search are kept on the device in a single lax.while_loop. Each pass through the loop evaluates 
+    fun exactly once at the current trial point, such that fun is traced and compiled only once. The compiled loop is 
+    cached by fun, callback and history, hence later calls with the same functions only differ in args, x0 and the 
+    tolerances and reuse it. 
+    The stopping criteria follow scipy's L-BFGS-B: (f_k - f_{k+1})/max(|f_k|, |f_{k+1}|, 1) <= ftol or max|g_{k+1}| <= gtol
+
+    Args:
+        fun (Callable[..., tuple[jnp.ndarray, jnp.ndarray]]): Traceable function of the parameters and args returning the 
+            objective and its gradient
+        x0 (jnp.ndarray): Initial parameters
+        maxiter (int, optional): Maximal number of iterations. Defaults to 15000.
+        ftol (float, optional): Tolerance on the relative reduction of the objective. Defaults to 2.2e-09.
+        gtol (float, optional): Tolerance on the maximal absolute entry of the gradient. Defaults to 1e-05.
+        history (int, optional): Number of stored parameter and gradient differences. Defaults to 10.
+        max_ls (int, optional): Maximal number of step halvings in the line search. Defaults to 20.
+        c1 (float, optional): Sufficient decrease parameter of the Armijo condition. Defaults to 1e-04.
+        callback (Callable | None, optional): Called on the host after every iteration with the iteration number, parameters, 
+            objective, gradient and number of function evaluations. Defaults to None.
+        args (tuple, optional): Further arguments of fun, traced as arrays. Defaults to ().
+
+    Returns:
+        OptimizeResult: Minimizer, objective and gradient at the minimizer, number of iterations, status code and
+            number of function evaluations
+    """
+    state = _lbfgs_run(fun, jnp.asarray(x0, dtype=float), args, maxiter, ftol, gtol, history, max_ls, c1, callback)
+    return OptimizeResult(state.x, state.f, state.g, int(state.n_iter), int(state.status), int(state.n_fev))
+
+
+class FISTAState(NamedTuple):
+    n_iter: int
+    x: jnp.ndarray
+    obj_x: jnp.ndarray
+    f_x: jnp.ndarray
+    g_x: jnp.ndarray
+    y: jnp.ndarray
+    f_y: jnp.ndarray
+    g_y: jnp.ndarray
+    z: jnp.ndarray
+    lip: float
+    t: float
+    n_ls: int
+    eval_y: bool
+    status: int
+    n_fev: int
+
+
+@partial(jit, static_argnames=["fun", "prox", "penal", "callback"])
+def _fista_run(fun: Callable, prox: Callable, penal: Callable, x0: jnp.ndarray, args: tuple, maxiter: int, ftol: float, 
+               lip0: float, max_ls: int, callback: Callable | None) -> FISTAState:
+
+    def prox_step(y, g_y, lip):
+        return prox(y - g_y / lip, 1. / lip, *args)
+
+    def at_y(state, f_v, g_v):
+        # Gradient at the extrapolated point is known, propose the next iterate
+        return state._replace(f_y=f_v, g_y=g_v, z=prox_step(state.y, g_v, state.lip), eval_y=False)
+
+    def at_z(state, f_v, g_v):
+        diff = state.z - state.y
+        majorized = f_v <= state.f_y + jnp.dot(state.g_y, diff) + 0.5 * state.lip * jnp.dot(diff, diff)
+        return lax.cond(majorized, accept, increase_lip, state, f_v, g_v)
+
+    def increase_lip(state, f_v, g_v):
+        lip = 2. * state.lip
+        n_ls = state.n_ls + 1
+        status = jnp.where(n_ls >= max_ls, LINE_SEARCH_FAILED, RUNNING)
+        return state._replace(z=prox_step(state.y, state.g_y, lip), lip=lip, n_ls=n_ls, status=status)
+
+    def accept(state, f_v, g_v):
+        obj = f_v + penal(state.z, *args)
+        first = jnp.isinf(state.obj_x)
+        n_iter = state.n_iter + 1
+        rel_red = (state.obj_x - obj) / jnp.maximum(jnp.maximum(jnp.abs(state.obj_x), jnp.abs(obj)), 1.)
+
+        def restart(state):
+            # The objective increased, restart the momentum from the last iterate
+            return state._replace(n_iter=n_iter, y=state.x, f_y=state.f_x, g_y=state.g_x, t=1., n_ls=0,
+                                  z=prox_step(state.x, state.g_x, state.lip),
+                                  status=jnp.where(n_iter >= maxiter, MAX_ITER, RUNNING))
+
+        def advance(state):
+            t = 0.5 * (1. + jnp.sqrt(1. + 4. * state.t**2))
+            beta = (state.t - 1.) / t
+            y = state.z + beta * (state.z - state.x)
+            status = jnp.select([~first & (rel_red <= ftol), n_iter >= maxiter], [CONVERGED_F, MAX_ITER], RUNNING)
+            # Without momentum the gradient at y is already known
+            return FISTAState(n_iter, state.z, obj, f_v, g_v, y, f_v, g_v, prox_step(state.z, g_v, state.lip),
+                              state.lip, t, 0, beta != 0., status, state.n_fev)
+
+        return lax.cond(rel_red < 0., restart, advance, state)
+
+    def cond(state):
+        return state.status == RUNNING
+
+    def body(state):
+        v = jnp.where(state.eval_y, state.y, state.z)
+        f_v, g_v = fun(v, *args)
+        new_state = lax.cond(state.eval_y, at_y, at_z, state._replace(n_fev=state.n_fev + 1), f_v, g_v)
+        _report(callback, state.n_iter, new_state, new_state.obj_x, new_state.g_x)
+        return new_state
+
+    n = x0.shape[0]
+    zeros = jnp.zeros(n)
+    init = FISTAState(0, x0, jnp.inf, jnp.inf, zeros, x0, 0., zeros, x0, jnp.asarray(lip0, dtype=float), 1., 0,
+                      True, RUNNING, 0)
+    return lax.while_loop(cond, body, init)
+
+
+def fista(fun: Callable[..., tuple[jnp.ndarray, jnp.ndarray]], 
+          prox: Callable[..., jnp.ndarray], penal: Callable[..., jnp.ndarray], 
+          x0: jnp.ndarray, maxiter: int = 15000, ftol: float = 2.2e-09, lip0: float = 1., 
+          max_ls: int = 50, callback: Callable | None = None, args: tuple = ()) -> OptimizeResult:
+    """Minimizes fun + penal with the accelerated proximal gradient method FISTA. The smooth part fun is handled by 
+    gradient steps with a backtracking estimate of its Lipschitz constant, the non-smooth part penal exactly by its proximal 
+    operator, hence entries penalized by an L1-type penalty become exactly 0. The momentum is restarted whenever the 
+    objective increases. Like lbfgs, the iteration runs in a single lax.while_loop that evaluates fun once per pass, 
+    which is compiled once per fun, prox, penal and callback.
+
+    Args:
+        fun (Callable[..., tuple[jnp.ndarray, jnp.ndarray]]): Traceable smooth function of the parameters and args 
+            returning its value and gradient
+        prox (Callable[..., jnp.ndarray]): Proximal operator of penal, prox(v, s, *args) = argmin_x 1/2 |x-v|^2 + s penal(x, *args)
+        penal (Callable[..., jnp.ndarray]): Traceable non-smooth penalty of the parameters and args
+        x0 (jnp.ndarray): Initial parameters
+        maxiter (int, optional): Maximal number of iterations. Defaults to 15000.
+        ftol (float, optional): Tolerance on the relative reduction of the objective. Defaults to 2.2e-09.
+        lip0 (float, optional): Initial estimate of the Lipschitz constant of the gradient of fun. Defaults to 1.
+        max_ls (int, optional): Maximal number of consecutive increases of the Lipschitz estimate. Defaults to 50.
+        callback (Callable | None, optional): Called on the host after every iteration with the iteration number, parameters, 
+            objective, gradient of fun and number of function evaluations. Defaults to None.
+        args (tuple, optional): Further arguments of fun, prox and penal, traced as arrays. Defaults to ().
+
+    Returns:
+        OptimizeResult: Minimizer, objective and gradient of fun at the minimizer, number of iterations, status code and
+            number of function evaluations
+    """
+    state = _fista_run(fun, prox, penal, jnp.asarray(x0, dtype=float), args, maxiter, ftol, lip0, max_ls, callback)
+    return OptimizeResult(state.x, state.obj_x, state.g_x, int(state.n_iter), int(state.status), int(state.n_fev))
@@ -2,10 +2,14 @@ from metmhn.jx.kronvec import (k2d1t,
                                k2ntt, 
                                k2dt0,
                                k2d10,
-                               k2d0t
+                               k2d0t,
+                               popcount_levels
                                )
 import jax.numpy as jnp
-from jax import jit, lax, vmap
+import numpy as np
+from jax import jit, lax, vmap, custom_vjp
+from jax.scipy.linalg import solve_triangular
+import jax
 from functools import partial
 
 
@@ -266,25 +270,66 @@ def kron_diag(
     #)
 
 
-@partial(jit, static_argnames=["transpose"])
-def R_inv_vec(log_theta: jnp.ndarray, 
-              x: jnp.ndarray, 
-              state: jnp.ndarray,
-              d_rates: jnp.ndarray = 1,
-              transpose: bool = False,
-              ) -> jnp.ndarray:
-    """This computes R^{-1} x = (I - Q D^{-1})^{-1} x
+# Largest number of events in a restricted state space, whose resolvent is solved densely if method="auto"
+_DENSE_MAX_STATE = 7
 
-    Args:
-        log_theta (np.ndarray): Log values of the theta matrix
-        x (np.ndarray): Vector to multiply with from the right. Length must equal the number of
-            nonzero entries in the state vector.
-        state (np.ndarray): Binary state vector, representing the current sample's events.
-        transpose (bool): Logical flag, if true calculate x^T (I - Q D^{-1})^{-1}
 
-    Returns:
-        np.ndarray: R_i^{-1} x or x^T R_i^{-1}
+def set_dense_max_state(n_state: int) -> None:
+    """Sets the largest restricted state space, that R_inv_vec and likelihood.R_i_inv_vec solve with an explicit 
+    2**n_state x 2**n_state matrix if method="auto". Larger state spaces use the Jacobi sweeps. Clears the caches 
+    of jax, such that kernels traced with the previous threshold are recompiled.
+
+    Args:
+        n_state (int): Number of non zero bits in state, 0 disables the dense solver
     """
+    global _DENSE_MAX_STATE
+    _DENSE_MAX_STATE = n_state
+    jax.clear_caches()
+
+
+def _transitions(log_theta: jnp.ndarray, state: jnp.ndarray, idx: np.ndarray, n_state: int, dtype: jnp.dtype, 
+                 transpose: bool) -> tuple[jnp.ndarray, jnp.ndarray]:
+    # rates[s, i]: Rate of event i between the restricted state idx[s] and nbrs[s, i], that lacks event i 
+    # (or has it, if transposed). Rates of impossible transitions are 0.
+    active = jnp.where(state == 1, size=n_state)[0]
+    lt = log_theta[active][:, active]
+    base = jnp.diagonal(lt)
+    off = lt - jnp.diag(base)
+    bits = 1 << np.arange(n_state, dtype=np.int32)
+    b = (idx[:, None] & bits) > 0
+    # The rate of event i is evaluated in the state without event i
+    rates = jnp.exp(b.astype(dtype) @ off.T + base)
+    if transpose:
+        return jnp.where(b, 0., rates), idx[:, None] | bits
+    return jnp.where(b, rates, 0.), idx[:, None] ^ bits
+
+
+def _r_levels(log_theta: jnp.ndarray, x: jnp.ndarray, state: jnp.ndarray, lidg: jnp.ndarray,
+              transpose: bool) -> jnp.ndarray:
+    # Forward substitution over the levels of the restricted state space, states with l bits only 
+    # receive mass from states with l-1 bits (or send it to states with l+1 bits if transposed)
+    n_state = int(np.log2(x.shape[0]))
+    levels = popcount_levels(n_state)
+    y = jnp.zeros_like(x)
+    for idx in (levels[::-1] if transpose else levels):
+        rates, nbrs = _transitions(log_theta, state, idx, n_state, x.dtype, transpose)
+        y = y.at[idx].set(lidg[idx] * (x[idx] + jnp.sum(rates * y[nbrs], axis=1)))
+    return y
+
+
+def _r_dense(log_theta: jnp.ndarray, x: jnp.ndarray, state: jnp.ndarray, lidg: jnp.ndarray,
+             transpose: bool) -> jnp.ndarray:
+    # Builds D-Q explicitly, it is lower triangular as transitions only add events
+    n_state = int(np.log2(x.shape[0]))
+    idx = np.arange(2**n_state, dtype=np.int32)
+    rates, nbrs = _transitions(log_theta, state, idx, n_state, x.dtype, False)
+    r = jnp.diag(1/lidg).at[idx[:, None], nbrs].add(-rates)
+    return solve_triangular(r, x, lower=True, trans=int(transpose))
+
+
+@partial(custom_vjp, nondiff_argnums=(4, 5))
+def _r_solve(log_theta: jnp.ndarray, x: jnp.ndarray, state: jnp.ndarray, d_rates: jnp.ndarray, 
+             transpose: bool, method: str) -> jnp.ndarray:
 
     def body_fun(j, val):
         return lidg * (kronvec(log_theta, val, state, False, transpose) + x)
@@ -293,6 +338,11 @@ def R_inv_vec(log_theta: jnp.ndarray,
 
     lidg = -1 / (kron_diag(log_theta=log_theta,
                  state=state, diag=jnp.ones_like(x))-d_rates)
+    if method == "levels":
+        return _r_levels(log_theta, x, state, lidg, transpose)
+    if method == "dense":
+        return _r_dense(log_theta, x, state, lidg, transpose)
+    
     y = lidg * x
 
     y = lax.fori_loop(
@@ -305,6 +355,56 @@ def R_inv_vec(log_theta: jnp.ndarray,
     return y
 
 
+def _r_solve_fwd(log_theta, x, state, d_rates, transpose, method):
+    y = _r_solve(log_theta, x, state, d_rates, transpose, method)
+    return y, (log_theta, state, d_rates, y)
+
+
+def _r_solve_bwd(transpose, method, res, y_bar):
+    # One solve with the transposed resolvent, the parameters receive x_bar^T \partial(Q-D) y
+    log_theta, state, d_rates, y = res
+    x_bar = _r_solve(log_theta, y_bar, state, d_rates, not transpose, method)
+    left, right = (y, x_bar) if transpose else (x_bar, y)
+    th_bar, _ = x_partial_Q_y(log_theta, left, right, state)
+    return th_bar, x_bar, None, -x_bar * y
+
+
+_r_solve.defvjp(_r_solve_fwd, _r_solve_bwd)
+
+
+@partial(jit, static_argnames=["transpose", "method"])
+def R_inv_vec(log_theta: jnp.ndarray, 
+              x: jnp.ndarray, 
+              state: jnp.ndarray,
+              d_rates: jnp.ndarray = 1,
+              transpose: bool = False,
+              method: str = "auto"
+              ) -> jnp.ndarray:
+    """This computes R^{-1} x = (I - Q D^{-1})^{-1} x. Its derivative is defined by a custom VJP, 
+    that costs a single solve with the transposed resolvent.
+
+    Args:
+        log_theta (np.ndarray): Log values of the theta matrix
+        x (np.ndarray): Vector to multiply with from the right. Length must equal the number of
+            nonzero entries in the state vector.
+        state (np.ndarray): Binary state vector, representing the current sample's events.
+        transpose (bool): Logical flag, if true calculate x^T (I - Q D^{-1})^{-1}
+        method (str, optional): "jacobi" applies state_size+1 sweeps with the full Kronecker product, 
+            "levels" substitutes once through the states grouped by their number of events, "dense" solves 
+            the explicit triangular matrix. "auto" uses "dense" for state spaces up to the size set by 
+            set_dense_max_state and "jacobi" otherwise. Defaults to "auto".
+
+    Returns:
+        np.ndarray: R_i^{-1} x or x^T R_i^{-1}
+    """
+    if method not in ("auto", "jacobi", "levels", "dense"):
+        raise ValueError(f"Unknown solver method {method}, use 'auto', 'jacobi', 'levels' or 'dense'")
+    if method == "auto":
+        method = "dense" if x.shape[0] <= 2**_DENSE_MAX_STATE else "jacobi"
+    d_rates = jnp.broadcast_to(jnp.asarray(d_rates, dtype=x.dtype), x.shape)
+    return _r_solve(log_theta, x, state, d_rates, transpose, method)
+
+
 def t_x_0(z: jnp.ndarray) -> tuple[jnp.ndarray, float]:
     return (z, 0.)
 
@@ -396,7 +496,8 @@ def x_partial_Q_y(
 @jit
 def gradient(log_theta: jnp.ndarray,
              state: jnp.ndarray, 
-             p_0: jnp.ndarray
+             p_0: jnp.ndarray,
+             target: int = -1
              ) -> jnp.ndarray:
     """This computes the gradient of the score function, which is the log-likelihood of a data vector p_D
     with respect to the log_theta matrix
@@ -405,13 +506,14 @@ def gradient(log_theta: jnp.ndarray,
         log_theta (np.ndarray): Theta matrix with logarithmic entries.
         state (np.ndarray): Binary state vector, representing the current sample's events.
         p_0 (np.ndarray): Starting distribution
+        target (int, optional): Index of the observed state in the restricted state space. Defaults to -1.
 
     Returns:
         jnp.ndarray: \partial_theta (p_D^T log p_theta)
     """
     p_theta = R_inv_vec(log_theta=log_theta, x=p_0, state=state)
     x = jnp.zeros_like(p_theta)
-    x = x.at[-1].set(1/p_theta[-1])
+    x = x.at[target].set(1/p_theta[target])
     x = R_inv_vec(log_theta=log_theta, x=x,
                   state=state, transpose=True)
     d_th, d_diag = x_partial_Q_y(log_theta=log_theta, x=x, y=p_theta, state=state)
@@ -1,11 +1,25 @@
 from metmhn.jx import likelihood as ssr
 import metmhn.jx.one_event as one
+import metmhn.jx.kronvec as kv
+from metmhn.jx import optimizers
 import logging 
+import time
+import warnings
+import os
+import json
+import hashlib
+from collections import OrderedDict
 import jax.numpy as jnp
-from jax import vmap
+from jax import vmap, jit, lax, config, block_until_ready, monitoring, devices, device_put, experimental
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
+from jax.experimental.shard_map import shard_map
+from jax.experimental.compilation_cache import compilation_cache
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
 import numpy as np
 import scipy.optimize as opt
-from typing import Callable
+from scipy.sparse.linalg import LinearOperator
+from typing import Callable, Iterator, NamedTuple, Sequence
 
 
 def L1(theta: jnp.ndarray, eps: float = 1e-05) -> jnp.ndarray:
@@ -47,12 +61,538 @@ def symmetric_penal(params: np.array, n_total: int, eps=1e-05) -> tuple[jnp.ndar
     log_theta = jnp.array(params[0:n_total**2]).reshape((n_total, n_total))
     log_d_p = jnp.array(params[n_total**2:n_total*(n_total + 1)])
     log_d_m = jnp.array(params[n_total*(n_total+1):])
-    penal = np.array(sym_penal(log_theta) + L1(log_d_p) + L1(log_d_m))
-    penal_ = np.concatenate((sym_penal_(log_theta), L1_(log_d_p), L1_(log_d_m)))
+    penal = sym_penal(log_theta) + L1(log_d_p) + L1(log_d_m)
+    penal_ = jnp.concatenate((sym_penal_(log_theta), L1_(log_d_p), L1_(log_d_m)))
     return penal, penal_
 
 
-def score(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, dat: jnp.ndarray, 
+def symmetric_penal_exact(params: jnp.ndarray, n_total: int) -> jnp.ndarray:
+    """
+    Computes the symmetric penalty without smoothing
+    """
+    log_theta = jnp.array(params[0:n_total**2]).reshape((n_total, n_total))
+    log_d_p = jnp.array(params[n_total**2:n_total*(n_total + 1)])
+    log_d_m = jnp.array(params[n_total*(n_total+1):])
+    return sym_penal(log_theta, 0.) + L1(log_d_p, 0.) + L1(log_d_m, 0.)
+
+
+def prox_symmetric_penal(params: jnp.ndarray, n_total: int, step: float, n_bisect: int = 100) -> jnp.ndarray:
+    """Proximal operator of the unsmoothed symmetric penalty, argmin_x 1/2 |x - params|^2 + step * symmetric_penal_exact(x).
+    Each pair (theta_ij, theta_ji) is penalized by its norm |v|_M = sqrt(v^T M v), M = [[1, -1/2], [-1/2, 1]]. Its proximal operator 
+    is 0 if |v|_{M^-1} <= step and (I + mu M)^-1 v otherwise, where mu > 0 solves mu |(I + mu M)^-1 v|_M = step and is found by bisection 
+    in the eigenbasis of M. The diagonal of theta is not penalized, the entries of d_p and d_m are soft-thresholded.
+
+    Args:
+        params (jnp.ndarray): (n+1)*(n+2)-dimensional vecor of parameters
+        n_total (int): Total number of events
+        step (float): Weight of the penalty
+        n_bisect (int, optional): Number of bisection steps. Defaults to 100.
+
+    Returns:
+        jnp.ndarray: Proximal point
+    """
+    log_theta = jnp.array(params[0:n_total**2]).reshape((n_total, n_total))
+    log_d = jnp.array(params[n_total**2:])
+    # Coordinates of the pairs in the eigenbasis of M, with eigenvalues 1/2 and 3/2
+    m_1, m_2 = 0.5, 1.5
+    c_1 = (log_theta + log_theta.T)/jnp.sqrt(2.)
+    c_2 = (log_theta - log_theta.T)/jnp.sqrt(2.)
+    dual_norm = jnp.sqrt(c_1**2/m_1 + c_2**2/m_2)
+    shrink = dual_norm > step
+    # mu |(I + mu M)^-1 v|_M increases from 0 to |v|_{M^-1}, which yields an upper bound for mu
+    rho = jnp.where(shrink, step/jnp.where(shrink, dual_norm, 1.), 0.)
+    mu_hi = rho/(m_1*(1. - rho))
+
+    def bisect(i, val):
+        lo, hi = val
+        mu = 0.5*(lo + hi)
+        phi = mu**2 * (m_1*c_1**2/(1. + mu*m_1)**2 + m_2*c_2**2/(1. + mu*m_2)**2)
+        return jnp.where(phi < step**2, mu, lo), jnp.where(phi < step**2, hi, mu)
+
+    lo, hi = lax.fori_loop(0, n_bisect, bisect, (jnp.zeros_like(mu_hi), mu_hi))
+    mu = 0.5*(lo + hi)
+    x_1, x_2 = c_1/(1. + mu*m_1), c_2/(1. + mu*m_2)
+    theta_ = jnp.where(shrink, (x_1 + x_2)/jnp.sqrt(2.), 0.)
+    theta_ = theta_.at[jnp.diag_indices(n_total)].set(jnp.diagonal(log_theta))
+    d_ = jnp.sign(log_d)*jnp.maximum(jnp.abs(log_d) - step, 0.)
+    return jnp.concatenate((theta_.flatten(), d_))
+
+
+def unique_patterns(dat: jnp.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Collapses the rows of dat into unique (genotype, diagnosis order, type) patterns. The diagnosis order is only
+    relevant for paired datapoints and ignored for all other datatypes
+
+    Args:
+        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+            The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
+            (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
+            (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Unique patterns, number of occurences of each pattern in dat, 
+            index of the pattern of each row in dat
+    """
+    dat = np.array(dat)
+    dat[dat[:, -1] != 3, -2] = 0
+    patterns, inverse, counts = np.unique(dat, axis=0, return_inverse=True, return_counts=True)
+    return patterns, counts, inverse.reshape(-1)
+
+
+def _group_rows(dat: np.ndarray) -> dict[tuple[int, int, int, int], np.ndarray]:
+    """Groups the rows of dat by datatype, number of active events and diagnosis order, such that all rows 
+    in a group can be handled by the same compiled kernel
+
+    Args:
+        dat (np.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+            The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
+            (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
+            (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
+
+    Returns:
+        dict[tuple[int, int, int, int], np.ndarray]: Maps (type, n_prim, n_met, order) to the row indices of the group.
+            Entries that are not used by a datatype are set to 0
+    """
+    n_prim = dat[:, :-2:2].sum(axis=1)
+    n_met = dat[:, 1:-2:2].sum(axis=1) + 1
+    order = dat[:, -2]
+    d_type = dat[:, -1]
+    keys = np.zeros((dat.shape[0], 4), dtype=np.int64)
+    keys[:, 0] = d_type
+    keys[:, 1] = np.where(d_type == 2, 0, n_prim)
+    keys[:, 2] = np.where(d_type >= 2, n_met, 0)
+    keys[:, 3] = np.where(d_type == 3, order, 0)
+    groups = {}
+    for key in np.unique(keys, axis=0):
+        rows = np.flatnonzero((keys == key).all(axis=1))
+        groups[tuple(int(k) for k in key)] = rows
+    return groups
+
+
+def _pad_states(states: np.ndarray, size: int, n_free: int) -> tuple[np.ndarray, np.ndarray]:
+    """Activates inactive events among the first n_free events of each state until size events are active. The restricted 
+    state space of the padded state contains all subsets of the observed state and their probabilities do not 
+    depend on the padding events, hence only the index of the observed state changes
+
+    Args:
+        states (np.ndarray): Binary matrix of observed states, one per row, with equal numbers of active events
+        size (int): Number of active events after padding
+        n_free (int): Number of leading events that may be used for padding
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Padded states, index of the observed state in the padded restricted state space
+    """
+    padded = states.copy()
+    targets = np.zeros(states.shape[0], dtype=np.int64)
+    for r in range(states.shape[0]):
+        n_pad = size - states[r].sum()
+        padded[r, np.flatnonzero(states[r, :n_free] == 0)[:n_pad]] = 1
+        active = np.flatnonzero(padded[r])
+        targets[r] = np.sum(2**np.flatnonzero(states[r, active]))
+    return padded, targets
+
+
+# Upper bound of the log. initial probability mass in single precision, exp(40) is far from the float32 maximum
+_MAX_LOG_SCALE = 40.
+
+
+class Bucket(NamedTuple):
+    """Unique datapoints that are evaluated by the same compiled kernel"""
+    d_type: int
+    n_prim: int
+    n_met: int
+    order: int
+    states: jnp.ndarray
+    targets: jnp.ndarray
+    counts: jnp.ndarray
+    rows: np.ndarray
+
+
+class DatasetPlan:
+    """Evaluation plan of a dataset. Unique patterns, their multiplicities and their grouping into kernel buckets 
+    are computed once and the observed states of each bucket are transferred to the device, such that repeated 
+    evaluations of the likelihood only dispatch the precompiled kernels
+
+    If size_classes are given, states of uncoupled datapoints are padded with additional events up to the next size class 
+    and the number of datapoints in each bucket is padded to the next power of two with datapoints of multiplicity zero. 
+    This merges buckets of neighbouring sizes and caps the number of compiled kernels at the cost of larger state spaces.
+
+    If n_devices is given, the datapoints of each bucket are split evenly across the first n_devices XLA devices, 
+    again padded with datapoints of multiplicity zero. Each device evaluates its share and the weighted sums of the 
+    log. likelihoods and gradients are reduced across devices. On CPU multiple host devices are configured by setting 
+    XLA_FLAGS="--xla_force_host_platform_device_count=n" before jax is imported.
+
+    Args:
+        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+            The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
+            (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
+            (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
+        size_classes (Sequence[int] | None, optional): Allowed numbers of active events of uncoupled datapoints. 
+            Defaults to None, no padding.
+        n_devices (int | None, optional): Number of devices to shard the buckets across. Defaults to None, no sharding.
+        dtype (np.dtype, optional): Floating point type of the kernels, np.float64 or np.float32. In single precision 
+            the kernels start from a rescaled initial distribution to avoid underflow and the log. likelihoods and 
+            gradients are summed in double precision. Defaults to np.float64.
+    """
+    def __init__(self, dat: jnp.ndarray, size_classes: Sequence[int] | None = None, n_devices: int | None = None, 
+                 dtype: np.dtype = np.float64):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError(f"Unsupported dtype {self.dtype}, use np.float32 or np.float64")
+        if self.dtype == np.float32 and n_devices is not None:
+            raise ValueError("Sharded plans are evaluated in double precision only")
+        self.mesh = None
+        if n_devices is not None:
+            if not 0 < n_devices <= len(devices()):
+                raise ValueError(f"Cannot shard across {n_devices} devices, {len(devices())} devices are available")
+            self.mesh = Mesh(np.array(devices()[:n_devices]), ("data",))
+        self.dat = np.array(dat)
+        self.n_dat = self.dat.shape[0]
+        self.n_mut = (self.dat.shape[1]-3)//2
+        self.n_total = self.n_mut + 1
+        self.size_classes = None if size_classes is None else sorted(size_classes)
+        self.patterns, self.counts, self.inverse = unique_patterns(self.dat)
+        self.n_em = int(np.dot(self.patterns[:, -3], self.counts))
+        self.n_nm = int(self.counts.sum()) - self.n_em
+
+        groups = {}
+        for (d_type, n_prim, n_met, order), rows in _group_rows(self.patterns).items():
+            if d_type == 3:
+                # The joint state spaces of coupled datapoints are not padded
+                key = (d_type, n_prim, n_met, order)
+            else:
+                key = (d_type, self._size_class(n_prim), self._size_class(n_met), order)
+            groups[key] = groups.get(key, []) + [(n_prim, n_met, rows)]
+        self.buckets = []
+        for key, members in groups.items():
+            states, targets = [], []
+            for n_prim, n_met, rows in members:
+                s, t = self._states(key, n_prim, n_met, rows)
+                states.append(s)
+                targets.append(t)
+            rows = np.concatenate([m[2] for m in members])
+            self.buckets.append(self._bucket(key, np.concatenate(states), np.concatenate(targets), rows))
+
+    def _size_class(self, size: int) -> int:
+        """Returns the smallest size class that is at least size, or size itself if padding is not possible"""
+        if self.size_classes is None or size == 0:
+            return size
+        return min([c for c in self.size_classes if size <= c <= self.n_total], default=size)
+
+    def _states(self, key: tuple[int, int, int, int], n_prim: int, n_met: int, 
+                rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Extracts the observed states of the patterns in rows in the layout expected by the kernel of the bucket key 
+        and pads them to the size of the bucket"""
+        d_type, size_prim, size_met, _ = key
+        n_mut = self.n_mut
+        if d_type < 2:
+            states = self.patterns[rows, 0:2*n_mut+1:2]
+            return _pad_states(states, size_prim, self.n_total)
+        elif d_type == 2:
+            states = np.hstack((self.patterns[rows, 1:2*n_mut+1:2], np.ones((rows.size, 1), dtype=self.patterns.dtype)))
+            return _pad_states(states, size_met, n_mut)
+        states = self.patterns[rows, 0:2*n_mut+1]
+        return states, np.full(rows.size, 2**(n_prim + n_met - 1) - 1)
+
+    def _bucket(self, key: tuple[int, int, int, int], states: np.ndarray, targets: np.ndarray, 
+                rows: np.ndarray) -> Bucket:
+        """Transfers a bucket to the device, if padding is enabled after appending copies of its first datapoint 
+        with multiplicity 0 until the number of datapoints is a power of two. If sharding is enabled, 
+        the datapoints are padded to a multiple of the number of devices and split across them"""
+        counts = self.counts[rows]
+        n_pad = 0
+        az = key[0] == 0 and key[1] == 0
+        if self.size_classes is not None and not az:
+            n_pad = (1 << int(rows.size - 1).bit_length()) - rows.size
+        if self.mesh is not None and not az:
+            n_pad += -(rows.size + n_pad) % self.mesh.size
+        states = np.concatenate((states, np.repeat(states[:1], n_pad, axis=0)))
+        targets = np.concatenate((targets, np.repeat(targets[:1], n_pad)))
+        counts = np.concatenate((counts, np.zeros(n_pad, dtype=counts.dtype)))
+        arrays = [jnp.array(states), jnp.array(targets), jnp.array(counts)]
+        if self.mesh is not None and not az:
+            arrays = [device_put(a, NamedSharding(self.mesh, PartitionSpec("data"))) for a in arrays]
+        return Bucket(*key, *arrays, rows)
+
+    @property
+    def work(self) -> int:
+        """Total size of all restricted state spaces processed in one evaluation of the likelihood"""
+        work = 0
+        for b in self.buckets:
+            size = [b.n_prim, b.n_prim, b.n_met, b.n_prim + b.n_met - 1][b.d_type]
+            work += b.states.shape[0] * 2**size
+        return work
+
+    def met_weight(self, perc_met: float) -> tuple[float, float]:
+        """Calculates the weight of metastasized datapoints and the effective size of the dataset
+
+        Args:
+            perc_met (float): Expected percentage of metastasizing tumor in the Dataset
+
+        Returns:
+            tuple[float, float]: Weight of metastasized datapoints, effective number of datapoints
+        """
+        # Weight MTs relative to PTs to achieve the prespecified ratio perc_met 
+        if self.n_em*self.n_nm != 0:
+            w = perc_met * self.n_nm/((1-perc_met)*self.n_em)
+        else:
+            w = 1
+        return w, w*self.n_em + self.n_nm
+
+    def __len__(self) -> int:
+        return self.n_dat
+
+
+class BatchStream:
+    """Stratified mini-batches of a dataset, which is read row by row from disk. Each batch contains metastasized 
+    and never metastasizing datapoints in the proportions of the full dataset. Since the likelihood of a batch 
+    reweights both groups to perc_met, see DatasetPlan.met_weight, its value and gradient are unbiased estimates 
+    of those of the full dataset.
+
+    Buckets are padded to powers of two datapoints, see DatasetPlan, such that all batches share the same 
+    few compiled kernels.
+
+    Args:
+        source (str | np.ndarray): Path to a .npy file, which is memory mapped, or matrix of observations dimension (n_dat x (2n+3)). 
+            The columns are expected as for DatasetPlan
+        batch_size (int): Approximate number of datapoints per batch
+        seed (int, optional): Seed of the random number generator shuffling the datapoints. Defaults to 0.
+        size_classes (Sequence[int] | None, optional): Size classes of the batches, see DatasetPlan. 
+            Defaults to None, the states are not padded.
+    """
+    def __init__(self, source: str | np.ndarray, batch_size: int, seed: int = 0, 
+                 size_classes: Sequence[int] | None = None):
+        self.dat = np.load(source, mmap_mode="r") if isinstance(source, str) else np.asarray(source)
+        self.n_dat = self.dat.shape[0]
+        self.n_total = (self.dat.shape[1]-3)//2 + 1
+        self.size_classes = list(range(1, self.n_total+1)) if size_classes is None else size_classes
+        self.rng = np.random.default_rng(seed)
+        seeding = np.asarray(self.dat[:, -3])
+        self.strata = [s for s in (np.flatnonzero(seeding == 1), np.flatnonzero(seeding != 1)) if s.size > 0]
+        # Every batch needs members of both groups, else its reweighting would be biased
+        self.n_batches = max(1, min([int(np.ceil(self.n_dat/batch_size))] + [s.size for s in self.strata]))
+
+    def epoch(self) -> Iterator[DatasetPlan]:
+        """Shuffles the dataset and yields its plans batch by batch"""
+        parts = [np.array_split(self.rng.permutation(s), self.n_batches) for s in self.strata]
+        for batch in zip(*parts):
+            # Sorted rows are read sequentially from a memory mapped file
+            rows = np.sort(np.concatenate(batch))
+            yield DatasetPlan(self.dat[rows], size_classes=self.size_classes)
+
+    def __len__(self) -> int:
+        return self.n_batches
+
+
+def make_plan(dat: jnp.ndarray | DatasetPlan) -> DatasetPlan:
+    """Returns dat if it already is a DatasetPlan, else builds the plan of dat"""
+    if isinstance(dat, DatasetPlan):
+        return dat
+    return DatasetPlan(dat)
+
+
+@partial(jit, static_argnames=["n_prim"])
+def _lp_prim_batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, states: jnp.ndarray, 
+                   targets: jnp.ndarray, n_prim: int, log_scale: float = 0.) -> jnp.ndarray:
+    return vmap(ssr._lp_prim_obs, (None, None, 0, None, 0, None))(log_theta, log_d_p, states, n_prim, targets, log_scale)
+
+
+@partial(jit, static_argnames=["n_met"])
+def _lp_met_batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
+                  states: jnp.ndarray, targets: jnp.ndarray, n_met: int, log_scale: float = 0.) -> jnp.ndarray:
+    return vmap(ssr._lp_met_obs, (None, None, None, 0, None, 0, None))(log_theta, log_d_p, log_d_m, states, n_met, targets, 
+                                                                       log_scale)
+
+
+@partial(jit, static_argnames=["n_prim", "n_met", "order"])
+def _lp_coupled_batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
+                      states: jnp.ndarray, n_prim: int, n_met: int, order: int, log_scale: float = 0.) -> jnp.ndarray:
+    if n_prim + n_met - 1 == 1:
+        lp = [one._lp_coupled_0, one._lp_coupled_1, one._lp_coupled_2][order]
+        return vmap(lp, (None, None, None, 0))(log_theta, log_d_p, log_d_m, states)
+    # The summands of the events are evaluated at once only if the whole batch fits below the threshold
+    parallel = kv._use_parallel(None, log_theta.shape[0] - 1, n_prim + n_met - 1, states.shape[0])
+    lp = partial([ssr._lp_coupled_0, ssr._lp_coupled_1, ssr._lp_coupled_2][order], parallel=parallel)
+    return vmap(lp, (None, None, None, 0, None, None, None))(log_theta, log_d_p, log_d_m, states, n_prim, n_met, log_scale)
+
+
+@partial(jit, static_argnames=["n_prim"])
+def _g_prim_batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, states: jnp.ndarray, 
+                  targets: jnp.ndarray, n_prim: int, log_scale: float = 0.) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    return vmap(ssr._grad_prim_obs, (None, None, 0, None, 0, None))(log_theta, log_d_p, states, n_prim, targets, log_scale)
+
+
+@partial(jit, static_argnames=["n_met"])
+def _g_met_batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, states: jnp.ndarray, 
+                 targets: jnp.ndarray, n_met: int, log_scale: float = 0.
+                 ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    return vmap(ssr._grad_met_obs, (None, None, None, 0, None, 0, None))(log_theta, log_d_p, log_d_m, states, n_met, targets, 
+                                                                         log_scale)
+
+
+@partial(jit, static_argnames=["n_prim", "n_met", "order"])
+def _g_coupled_batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, states: jnp.ndarray, 
+                     n_prim: int, n_met: int, order: int, log_scale: float = 0.
+                     ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    if n_prim + n_met - 1 == 1:
+        g = [one._g_coupled_0, one._g_coupled_1, one._g_coupled_2][order]
+        return vmap(g, (None, None, None, 0))(log_theta, log_d_p, log_d_m, states)
+    # The summands of the events are evaluated at once only if the whole batch fits below the threshold
+    parallel = kv._use_parallel(None, log_theta.shape[0] - 1, n_prim + n_met - 1, states.shape[0])
+    g = partial([ssr._g_coupled_0, ssr._g_coupled_1, ssr._g_coupled_2][order], parallel=parallel)
+    return vmap(g, (None, None, None, 0, None, None, None))(log_theta, log_d_p, log_d_m, states, n_prim, n_met, log_scale)
+
+
+def _batch(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, states: jnp.ndarray, 
+           targets: jnp.ndarray, key: tuple[int, int, int, int], grad: bool, log_scale: float = 0.) -> tuple[jnp.ndarray, ...]:
+    """Evaluates the datapoints of a bucket with key (d_type, n_prim, n_met, order) with its batched kernel"""
+    d_type, n_prim, n_met, order = key
+    if d_type < 2:
+        res = (_g_prim_batch if grad else _lp_prim_batch)(log_theta, log_d_p, states, targets, n_prim, log_scale)
+    elif d_type == 2:
+        res = (_g_met_batch if grad else _lp_met_batch)(log_theta, log_d_p, log_d_m, states, targets, n_met, log_scale)
+    else:
+        res = (_g_coupled_batch if grad else _lp_coupled_batch)(log_theta, log_d_p, log_d_m, states, n_prim, n_met, order, 
+                                                                log_scale)
+    return res if grad else (res,)
+
+
+def _weighted_sums(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, states: jnp.ndarray, 
+                   targets: jnp.ndarray, counts: jnp.ndarray, key: tuple[int, int, int, int], 
+                   grad: bool) -> tuple[jnp.ndarray, ...]:
+    """Sums the log. likelihoods (and gradients) of the datapoints of a bucket weighted by their multiplicities"""
+    res = _batch(log_theta, log_d_p, log_d_m, states, targets, key, grad)
+    return tuple(jnp.tensordot(counts, r, axes=1) for r in res)
+
+
+@partial(jit, static_argnames=["key", "grad", "mesh"])
+def _sharded_sums(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, states: jnp.ndarray, 
+                  targets: jnp.ndarray, counts: jnp.ndarray, key: tuple[int, int, int, int], grad: bool, 
+                  mesh: Mesh) -> tuple[jnp.ndarray, ...]:
+    """Like _weighted_sums for a bucket split across the devices of mesh. Each device sums over its own share 
+    and the partial sums are reduced across devices"""
+    def local(log_theta, log_d_p, log_d_m, states, targets, counts):
+        return lax.psum(_weighted_sums(log_theta, log_d_p, log_d_m, states, targets, counts, key, grad), "data")
+    rep, split = PartitionSpec(), PartitionSpec("data")
+    # The replication checker does not support the while loops of the kernels, the psum makes the outputs replicated
+    return shard_map(local, mesh, in_specs=(rep, rep, rep, split, split, split), 
+                     out_specs=rep, check_rep=False)(log_theta, log_d_p, log_d_m, states, targets, counts)
+
+
+def _log_scale(log_theta: jnp.ndarray, key: tuple[int, int, int, int]) -> jnp.ndarray:
+    """Log. of the initial probability mass of the kernels of bucket key in single precision. Each event on the way 
+    to the observed state costs roughly a factor 1/(1 + sum_i Theta_ii) of probability, half of the expected loss 
+    is compensated, which balances the forward and the transposed solves of the gradient"""
+    d_type, n_prim, n_met, _ = key
+    n_active = [n_prim, n_prim, n_met, n_prim + n_met - 1][d_type]
+    return jnp.minimum(0.5 * n_active * jnp.log1p(jnp.sum(jnp.exp(jnp.diag(log_theta)))), _MAX_LOG_SCALE)
+
+
+def _bucket_values(plan: DatasetPlan, b: Bucket, log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
+                   grad: bool) -> tuple[jnp.ndarray, ...]:
+    """Log. likelihoods (and gradients) of the datapoints of a bucket, including datapoints added as padding"""
+    key = (b.d_type, b.n_prim, b.n_met, b.order)
+    if plan.dtype == np.float32:
+        log_scale = _log_scale(log_theta, key).astype(np.float32)
+        params = [jnp.asarray(x, dtype=np.float32) for x in (log_theta, log_d_p, log_d_m)]
+        targets = jnp.asarray(b.targets, dtype=np.int32)
+        # The kernels are traced with 32 bit defaults, their results are converted to double precision
+        with experimental.disable_x64(), warnings.catch_warnings():
+            # Index arrays requested as int are silently truncated to int32
+            warnings.filterwarnings("ignore", "Explicitly requested dtype", UserWarning)
+            res = _batch(*params, b.states, targets, key, grad, log_scale)
+        return tuple(r.astype(np.float64) for r in res)
+    return _batch(log_theta, log_d_p, log_d_m, b.states, b.targets, key, grad)
+
+
+def _bucket_sums(plan: DatasetPlan, b: Bucket, log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, 
+                 grad: bool) -> tuple[jnp.ndarray, ...]:
+    """Weighted sums of the log. likelihoods (and gradients) of a bucket, on all devices of the plan"""
+    key = (b.d_type, b.n_prim, b.n_met, b.order)
+    if plan.dtype == np.float32:
+        # The weighted sums are accumulated in double precision
+        return tuple(jnp.tensordot(b.counts, r, axes=1) for r in _bucket_values(plan, b, log_theta, log_d_p, log_d_m, grad))
+    if plan.mesh is None:
+        return _weighted_sums(log_theta, log_d_p, log_d_m, b.states, b.targets, b.counts, key, grad)
+    return _sharded_sums(log_theta, log_d_p, log_d_m, b.states, b.targets, b.counts, key, grad, plan.mesh)
+
+
+def enable_compilation_cache(cache_dir: str) -> None:
+    """Stores all compiled kernels in a persistent on-disk cache, such that later processes 
+    load them from disk instead of recompiling them
+
+    Args:
+        cache_dir (str): Path to the cache directory
+    """
+    config.update("jax_compilation_cache_dir", cache_dir)
+    # Cache every kernel, not only those that took longer than a second to compile
+    config.update("jax_persistent_cache_min_compile_time_secs", 0.)
+    # The cache is set up lazily on the first compilation, which may already have happened without it
+    compilation_cache.reset_cache()
+
+
+def warm_up(dat: jnp.ndarray | DatasetPlan, lik: bool = True, grad: bool = True, n_threads: int = 1) -> float:
+    """Compiles the kernels of all buckets of a dataset ahead of the first likelihood evaluation
+
+    Args:
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan
+        lik (bool, optional): Compile the kernels used by score. Defaults to True.
+        grad (bool, optional): Compile the kernels used by score_and_grad. Defaults to True.
+        n_threads (int, optional): Number of threads compiling kernels in parallel. Defaults to 1.
+
+    Returns:
+        float: Wall time in seconds spent on the warm up
+    """
+    plan = make_plan(dat)
+    log_theta = jnp.zeros((plan.n_total, plan.n_total))
+    log_d = jnp.zeros(plan.n_total)
+
+    def compile_bucket(b: Bucket) -> None:
+        out = []
+        if b.d_type == 0 and b.n_prim == 0:
+            if grad:
+                out.append(ssr._grad_prim_obs_az(log_theta))
+        else:
+            if lik:
+                out.append(_bucket_sums(plan, b, log_theta, log_d, log_d, grad=False))
+            if grad:
+                out.append(_bucket_sums(plan, b, log_theta, log_d, log_d, grad=True))
+        block_until_ready(out)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(compile_bucket, plan.buckets))
+    elapsed = time.perf_counter() - start
+    logging.info(f"Compiled kernels for {len(plan.buckets)} buckets in {elapsed:.2f}s")
+    return elapsed
+
+
+def padding_report(dat: jnp.ndarray, size_classes: Sequence[int], n_threads: int = 1) -> dict[str, float]:
+    """Compares the plans of a dataset with and without padding to size_classes. Reports the number of compiled kernels, 
+    the work overhead, i.e. the ratio of the total sizes of all state spaces, and the time spent compiling the gradient kernels
+
+    Args:
+        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3))
+        size_classes (Sequence[int]): Allowed numbers of active events of uncoupled datapoints
+        n_threads (int, optional): Number of threads compiling kernels in parallel. Defaults to 1.
+
+    Returns:
+        dict[str, float]: Padding report
+    """
+    plain = DatasetPlan(dat)
+    padded = DatasetPlan(dat, size_classes)
+    report = {"kernels": len(padded.buckets), 
+              "kernels_unpadded": len(plain.buckets), 
+              "work_overhead": padded.work/plain.work,
+              "compile_time": warm_up(padded, lik=False, n_threads=n_threads), 
+              "compile_time_unpadded": warm_up(plain, lik=False, n_threads=n_threads)
+              }
+    logging.info(f"Padding to {list(size_classes)}: {report['kernels']} instead of {report['kernels_unpadded']} kernels, " 
+                 f"{report['work_overhead']:.2f}x work, compile time {report['compile_time']:.2f}s " 
+                 f"instead of {report['compile_time_unpadded']:.2f}s")
+    return report
+
+
+def score(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, dat: jnp.ndarray | DatasetPlan, 
           perc_met: float)-> jnp.ndarray:
     """Calculates the log. likelihood of the dataset dat
 
@@ -60,7 +600,7 @@ def score(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, da
         log_theta (jnp.ndarray): (n+1)x(n+1)-dimensional Theta matrix with logarithmic entries
         log_d_p (jnp.ndarray): (n+1)-dimensional vector with logarithmic effects of events in the PT on the rate of its observation event
         log_d_m (jnp.ndarray): (n+1)-dimensional vector with logarithmic effects of events in the MT on the rate of its observation event
-        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, rows correspond to patients and columns to events.
             The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
             (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
             (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
@@ -69,75 +609,33 @@ def score(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, da
     Returns:
         jnp.ndarray: Log. likelihood
     """
-    n_mut = (dat.shape[1]-3)//2
-    n_total = n_mut + 1
+    plan = make_plan(dat)
     score, score_pt = 0., 0.
-    for i in range(dat.shape[0]):
-        if dat[i,-1] == 0:
+    for b in plan.buckets:
+        if b.d_type == 0 and b.n_prim == 0:
+            # Never metastasizing primary tumors without any active events
+            score_pt += b.counts.sum() * ssr._lp_prim_obs_az(log_theta)
+        elif b.d_type == 0:
             # Never metastasizing primary tumors
-            state_obs = dat[i, 0:2*n_total-1:2]
-            n_prim = int(state_obs.sum())
-            if n_prim == 0:
-                score_pt += ssr._lp_prim_obs_az(log_theta)
-            else:
-                score_pt += ssr._lp_prim_obs(log_theta, log_d_p, state_obs, n_prim)
+            score_pt += _bucket_sums(plan, b, log_theta, log_d_p, log_d_m, grad=False)[0]
         else:
-            if dat[i,-1] == 1:
-            # Metastasized primary tumors without sequenced metastasis
-                state_obs = dat[i, 0:2*n_total-1:2]
-                n_prim = int(state_obs.sum())      
-                score += ssr._lp_prim_obs(log_theta, log_d_p, state_obs, n_prim)
-            elif dat[i, -1] == 2:
-                # Metastates without sequenced primary tumor
-                state_obs = dat[i, 0:2*n_total-1]
-                state_met = jnp.append(state_obs[1:2*n_total-1:2], 1)
-                n_met = int(state_met.sum())
-                score += ssr._lp_met_obs(log_theta, log_d_p, log_d_m, state_met, n_met)
-            elif dat[i, -1] == 3:
-                # Paired primary tumor and metastasis observation
-                state_obs = dat[i, 0:2*n_mut+1]
-                n_prim = int(state_obs[::2].sum())
-                n_met = int(state_obs[1::2].sum() + 1)
-                order = dat[i,-2]
-                if order == 0:
-                    if (n_prim + n_met-1) == 1:
-                        score += one._lp_coupled_0(log_theta, log_d_p, log_d_m, state_obs)
-                    else:
-                        score += ssr._lp_coupled_0(log_theta, log_d_p, log_d_m, state_obs,
-                                                           n_prim, n_met)
-                elif order == 1:
-                    if (n_prim + n_met-1) == 1:
-                        score += one._lp_coupled_1(log_theta, log_d_p, log_d_m, state_obs)
-                    else:
-                        score += ssr._lp_coupled_1(log_theta, log_d_p, log_d_m, state_obs,
-                                                           n_prim, n_met)
-                else:
-                    if (n_prim + n_met-1) == 1:
-                        score += one._lp_coupled_2(log_theta, log_d_p, log_d_m, state_obs)
-                    else:
-                        score += ssr._lp_coupled_2(log_theta, log_d_p, log_d_m, state_obs,
-                                                           n_prim, n_met)
-
-    n_em = jnp.sum(dat[:,-3])
-    n_nm = dat.shape[0] - n_em
-    # Weight MTs relative to PTs to achieve the prespecified ratio perc_met 
-    if n_em*n_nm != 0:
-        w = perc_met * n_nm/((1-perc_met)*n_em)
-    else:
-        w = 1
-    n_full = w*n_em + n_nm
+            # Metastasized primary tumors without sequenced metastasis, metastases without sequenced primary tumor 
+            # and paired primary tumor and metastasis observations
+            score += _bucket_sums(plan, b, log_theta, log_d_p, log_d_m, grad=False)[0]
+
+    w, n_full = plan.met_weight(perc_met)
     score = (w*score + score_pt)/n_full
     return score
 
 
-def score_reg(params: np.ndarray, dat: jnp.ndarray, perc_met: float, penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], 
+def score_reg(params: np.ndarray, dat: jnp.ndarray | DatasetPlan, perc_met: float, penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], 
               w_penal: float) -> np.ndarray:
     """Calculates the negative log. likelihood and its gradient of the dataset dat with regularization penal
 
     Args:
         params (np.ndarray): (n+1)*(n+2)-dimensional vecor of parameters, the first (n+1)**2 entries correspond to log. Theta, 
             the next (n+1) to log_d_p and the last (n+1)-entries to log_d_m
-        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, rows correspond to patients and columns to events.
             The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
             (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
             (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
@@ -149,8 +647,7 @@ def score_reg(params: np.ndarray, dat: jnp.ndarray, perc_met: float, penal: Call
     Returns:
         tuple[np.ndarray, np.ndarray]: Negative penalized log. likelihood, grad wrt. to all model parameters
     """
-    n_mut = (dat.shape[1]-3)//2
-    n_total = n_mut + 1
+    n_total = make_plan(dat).n_total
     # Transfer parameters to the device
     log_theta = jnp.array(params[0:n_total**2]).reshape((n_total, n_total))
     log_d_p = jnp.array(params[n_total**2:n_total*(n_total + 1)])
@@ -160,7 +657,7 @@ def score_reg(params: np.ndarray, dat: jnp.ndarray, perc_met: float, penal: Call
     return np.array(-sc + w_penal*pen)
 
 
-def score_and_grad(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, dat: jnp.ndarray, 
+def score_and_grad(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.ndarray, dat: jnp.ndarray | DatasetPlan, 
                    perc_met: float)->tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """Calculates the log. likelihood and its gradient of the dataset dat
 
@@ -168,7 +665,7 @@ def score_and_grad(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nd
         log_theta (jnp.ndarray): (n+1)x(n+1)-dimensional Theta matrix with logarithmic entries
         log_d_p (jnp.ndarray): (n+1)-dimensional vector with logarithmic effects of events in the PT on the rate of its observation event
         log_d_m (jnp.ndarray): (n+1)-dimensional vector with logarithmic effects of events in the MT on the rate of its observation event
-        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, rows correspond to patients and columns to events.
             The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
             (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
             (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
@@ -177,89 +674,42 @@ def score_and_grad(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nd
     Returns:
         tuple[np.array, jnp.ndarray, jnp.ndarray, jnp.ndarray]: Log. likelihood, grad wrt. theta, grad wrt. log_d_p, grad wrt. log_d_m
     """
-    n_mut = (dat.shape[1]-3)//2
-    n_total = n_mut + 1
+    plan = make_plan(dat)
+    n_total = plan.n_total
     score, score_pt = 0., 0.
     d_th, d_th_pt = jnp.zeros((n_total, n_total)), jnp.zeros((n_total, n_total))
     d_d_p, d_d_p_pt = jnp.zeros(n_total), jnp.zeros(n_total) 
     d_d_m = jnp.zeros(n_total)
 
-    # Never metastasizing primary tumors
-    dat_po = dat[dat[:,-1]==0,:]
-    n_active = jnp.unique(dat_po[:,:-2:2].sum(axis=1))
-    for i in n_active:
-        tmp = dat_po[dat_po[:,:-2:2].sum(axis=1)==i, :-2:2]
-        if i == 0:
-            n_az = tmp.shape[0]
+    for b in plan.buckets:
+        if b.d_type == 0 and b.n_prim == 0:
+            # Never metastasizing primary tumors without any active events
             lik, th_, dp_ = ssr._grad_prim_obs_az(log_theta)
-            score_pt += n_az * lik
+            n_az = b.counts.sum()
+            score_pt += n_az * lik[0]
             d_th_pt += n_az * th_
             d_d_p_pt += n_az * dp_
+        elif b.d_type == 0:
+            # Never metastasizing primary tumors
+            lik, th_, dp_ = _bucket_sums(plan, b, log_theta, log_d_p, log_d_m, grad=True)
+            score_pt += lik
+            d_th_pt += th_
+            d_d_p_pt += dp_
+        elif b.d_type == 1:
+            # Metastasized primary tumors
+            lik, th_, dp_ = _bucket_sums(plan, b, log_theta, log_d_p, log_d_m, grad=True)
+            score += lik
+            d_th += th_
+            d_d_p += dp_
         else:
-            lik, th_, dp_ = vmap(ssr._grad_prim_obs, (None, None, 0, None), out_axes=(0))(log_theta, log_d_p, tmp, int(i))
-            score_pt += lik.sum()
-            d_th_pt += th_.sum(axis=0)
-            d_d_p_pt += dp_.sum(axis=0)
-
-    # Metastasized primary tumors
-    dat_pm = dat[dat[:,-1]==1,:]
-    n_active = jnp.unique(dat_pm[:,:-2:2].sum(axis=1))
-    for i in n_active:
-        tmp = dat_pm[dat_pm[:,:-2:2].sum(axis=1)==i, :-2:2]
-        lik, th_, dp_ = vmap(ssr._grad_prim_obs, (None, None, 0, None), out_axes=(0))(log_theta, log_d_p, tmp, int(i))
-        score += lik.sum()
-        d_th += th_.sum(axis=0)
-        d_d_p += dp_.sum(axis=0)
-    
-    # Metastases
-    dat_m = dat[dat[:,-1]==2,:]
-    n_active = jnp.unique(dat_m[:,1:-2:2].sum(axis=1)) + 1
-    for i in n_active:
-        tmp = dat_m[dat_m[:,1:-2:2].sum(axis=1)+1==i, 1:-2:2]
-        tmp = jnp.hstack((tmp, jnp.ones(tmp.shape[0], dtype=jnp.int8).reshape(-1,1)))
-        lik, th_, dp_, dm_ = vmap(ssr._grad_met_obs, (None, None, None, 0, None), out_axes=(0))(log_theta, log_d_p, log_d_m, tmp, int(i))
-        score += lik.sum()
-        d_th += th_.sum(axis=0)
-        d_d_p += dp_.sum(axis=0)
-        d_d_m += dm_.sum(axis=0)
-    
-    # Paired primary tumors and metastases
-    dat_c = dat[dat[:,-1]==3,:]
-    for i in range(dat_c.shape[0]):
-        state_obs = dat_c[i, 0:2*n_mut+1]
-        n_prim = int(state_obs[::2].sum())
-        n_met = int(state_obs[1::2].sum() + 1)
-        order = dat_c[i,-2]
-        if order == 0:
-            if (n_prim + n_met-1) == 1:
-                s, th_, d_p_, d_m_ = one._g_coupled_0(log_theta, log_d_p, log_d_m, state_obs)
-            else:
-                s, th_, d_p_, d_m_ = ssr._g_coupled_0(log_theta, log_d_p, log_d_m, state_obs,
-                                                        n_prim, n_met)
-        elif order == 1:
-            if (n_prim + n_met-1) == 1:
-                s, th_, d_p_, d_m_ = one._g_coupled_1(log_theta, log_d_p, log_d_m, state_obs)
-            else:
-                s, th_, d_p_, d_m_ = ssr._g_coupled_1(log_theta, log_d_p, log_d_m, state_obs,
-                                                        n_prim, n_met)
-        else:
-            if (n_prim + n_met-1) == 1:
-                s, th_, d_p_, d_m_ = one._g_coupled_2(log_theta, log_d_p, log_d_m, state_obs)
-            else:
-                s, th_, d_p_, d_m_ = ssr._g_coupled_2(log_theta, log_d_p, log_d_m, state_obs,
-                                                      n_prim, n_met)
-        score += s
-        d_th += th_
-        d_d_p += d_p_
-        d_d_m += d_m_
-
-    n_em = jnp.sum(dat[:,-3])
-    n_nm = dat.shape[0] - n_em
-    if n_em*n_nm != 0:
-        w = perc_met * n_nm/((1-perc_met)*n_em)
-    else:
-        w = 1
-    n_full = w*n_em + n_nm
+            # Metastases and paired primary tumors and metastases
+            lik, th_, dp_, dm_ = _bucket_sums(plan, b, log_theta, log_d_p, log_d_m, grad=True)
+            score += lik
+            d_th += th_
+            d_d_p += dp_
+            d_d_m += dm_
+
+    w, n_full = plan.met_weight(perc_met)
     score = (w*score + score_pt)/n_full
     d_th = (w*d_th + d_th_pt)/n_full
     d_d_p = (w*d_d_p + d_d_p_pt)/n_full
@@ -267,14 +717,14 @@ def score_and_grad(log_theta: jnp.ndarray, log_d_p: jnp.ndarray, log_d_m: jnp.nd
     return score, d_th, d_d_p, d_d_m
 
 
-def score_and_grad_reg(params: np.ndarray, dat: jnp.ndarray, perc_met: float, penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], 
+def score_and_grad_reg(params: np.ndarray, dat: jnp.ndarray | DatasetPlan, perc_met: float, penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], 
                        w_penal: float) -> tuple[np.ndarray, np.ndarray]:
     """Calculates the negative log. likelihood and its gradient of the dataset dat with regularization penal
 
     Args:
         params (np.ndarray): (n+1)*(n+2)-dimensional vecor of parameters, the first (n+1)**2 entries correspond to log. Theta, 
             the next (n+1) to log_d_p and the last (n+1)-entries to log_d_m
-        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, rows correspond to patients and columns to events.
             The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
             (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
             (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
@@ -286,49 +736,547 @@ def score_and_grad_reg(params: np.ndarray, dat: jnp.ndarray, perc_met: float, pe
     Returns:
         tuple[np.ndarray, np.ndarray]: Negative penalized log. likelihood, grad wrt. to all model parameters
     """
-    n_mut = (dat.shape[1]-3)//2
-    n_total = n_mut + 1
-    # Transfer parameters to the device
+    score, grad = _score_and_grad_reg(params, make_plan(dat), perc_met, penal, w_penal)
+    return np.array(score), np.array(grad)
+
+
+def per_sample_scores(params: np.ndarray, dat: jnp.ndarray | DatasetPlan, 
+                      grad: bool = False) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+    """Calculates the log. likelihood (and its gradient) of every datapoint of dat. Each bucket of unique datapoints is 
+    evaluated by one call of its batched kernel and the results are scattered back to the rows of dat. 
+    score is (w * sum of the values of rows of type 1, 2 and 3 + sum of the values of rows of type 0)/n_full, 
+    see DatasetPlan.met_weight
+
+    Args:
+        params (np.ndarray): (n+1)*(n+2)-dimensional vecor of parameters, see score_and_grad_reg
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, see score
+        grad (bool, optional): Additionally return the gradients. Defaults to False.
+
+    Returns:
+        np.ndarray | tuple[np.ndarray, np.ndarray]: n_dat log. likelihoods, aligned to the rows of dat, and if grad is set 
+            the n_dat x (n+1)*(n+2) matrix of their gradients wrt. to all model parameters in the layout of params
+    """
+    plan = make_plan(dat)
+    n_total = plan.n_total
     log_theta = jnp.array(params[0:n_total**2]).reshape((n_total, n_total))
     log_d_p = jnp.array(params[n_total**2:n_total*(n_total + 1)])
     log_d_m = jnp.array(params[n_total*(n_total+1):])
-    score, d_th, d_d_p, d_d_m = score_and_grad(log_theta, log_d_p, log_d_m, dat, perc_met)
-    grad_vec = np.concatenate((d_th.flatten(), d_d_p, d_d_m))
+    n_patterns = plan.patterns.shape[0]
+    lik = np.zeros(n_patterns)
+    d_params = np.zeros((n_patterns, n_total*(n_total + 2))) if grad else None
+
+    for b in plan.buckets:
+        n = b.rows.size
+        if b.d_type == 0 and b.n_prim == 0:
+            # Never metastasizing primary tumors without any active events
+            if grad:
+                lik_, th_, dp_ = ssr._grad_prim_obs_az(log_theta)
+                lik[b.rows] = lik_[0]
+                d_params[b.rows, :n_total**2] = np.asarray(th_).flatten()
+                d_params[b.rows, n_total**2:n_total*(n_total+1)] = np.asarray(dp_)
+            else:
+                lik[b.rows] = ssr._lp_prim_obs_az(log_theta)
+            continue
+        # Datapoints added as padding are dropped
+        res = [np.asarray(r)[:n] for r in _bucket_values(plan, b, log_theta, log_d_p, log_d_m, grad)]
+        lik[b.rows] = res[0]
+        if grad:
+            d_params[b.rows, :n_total**2] = res[1].reshape((n, -1))
+            d_params[b.rows, n_total**2:n_total*(n_total+1)] = res[2]
+            if b.d_type >= 2:
+                d_params[b.rows, n_total*(n_total+1):] = res[3]
+
+    if not grad:
+        return lik[plan.inverse]
+    return lik[plan.inverse], d_params[plan.inverse]
+
+
+def _zero_penal(params: jnp.ndarray, n_total: int) -> tuple[float, float]:
+    return 0., 0.
+
+
+def _score_and_grad_reg(params: jnp.ndarray, plan: DatasetPlan, perc_met: float, 
+                        penal: Callable[[jnp.ndarray, int], tuple[jnp.ndarray, jnp.ndarray]], 
+                        w_penal: float) -> tuple[jnp.ndarray, jnp.ndarray]:
+    """Traceable version of score_and_grad_reg, that keeps its results on the device. 
+    It can be traced as a whole if penal is traceable"""
+    n_total = plan.n_total
+    log_theta = jnp.array(params[0:n_total**2]).reshape((n_total, n_total))
+    log_d_p = jnp.array(params[n_total**2:n_total*(n_total + 1)])
+    log_d_m = jnp.array(params[n_total*(n_total+1):])
+    score, d_th, d_d_p, d_d_m = score_and_grad(log_theta, log_d_p, log_d_m, plan, perc_met)
+    grad_vec = jnp.concatenate((d_th.flatten(), d_d_p, d_d_m))
     pen, pen_ = penal(params, n_total)
-    return np.array(-score + w_penal*pen), -grad_vec + w_penal*pen_ 
+    return -score + w_penal*pen, -grad_vec + w_penal*pen_
+
+
+@lru_cache(maxsize=8)
+def _device_objective(plan: DatasetPlan, 
+                      penal: Callable[[jnp.ndarray, int], tuple[jnp.ndarray, jnp.ndarray]]) -> Callable:
+    """_score_and_grad_reg as a function of the parameters, perc_met and w_penal. The same function is returned for 
+    the same plan and penalty, such that the optimizers in jx.optimizers reuse their compiled loops across fits"""
+    def fun(params, perc_met, w_penal):
+        return _score_and_grad_reg(params, plan, perc_met, penal, w_penal)
+    return fun
+
+
+@lru_cache(maxsize=8)
+def _device_prox(n_total: int) -> tuple[Callable, Callable]:
+    """Proximal operator and value of the weighted unsmoothed symmetric penalty with the signature of _device_objective"""
+    def prox(params, step, perc_met, w_penal):
+        return prox_symmetric_penal(params, n_total, step*w_penal)
+    
+    def penal(params, perc_met, w_penal):
+        return w_penal*symmetric_penal_exact(params, n_total)
+    return prox, penal
 
 
-def learn_mhn(th_init: jnp.ndarray, dp_init: jnp.ndarray, dm_init: jnp.ndarray, dat: jnp.ndarray, perc_met: float, 
+def hessian_operator(params: np.ndarray, dat: jnp.ndarray | DatasetPlan, perc_met: float, 
+                     penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], w_penal: float) -> LinearOperator:
+    """Hessian of score_and_grad_reg at params as a linear operator. Each product with a vector v is computed 
+    by a central difference of the analytic gradient along v, which costs two gradient evaluations. 
+    The solvers are wrapped in custom vjps, so forward-over-reverse differentiation is not available
+
+    Args:
+        params (np.ndarray): (n+1)*(n+2)-dimensional vecor of parameters, see score_and_grad_reg
+        dat (jnp.ndarray | DatasetPlan): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, see score_and_grad_reg
+        perc_met (float): Expected percentage of metastasizing tumor in the Dataset
+        penal (Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]]): Penalty function, see score_and_grad_reg
+        w_penal (float): weight of the penalization
+
+    Returns:
+        LinearOperator: Symmetric operator v -> H v, with H the Hessian of the negative penalized log. likelihood
+    """
+    plan = make_plan(dat)
+    params = np.asarray(params, dtype=np.float64)
+    # Step size balancing truncation and rounding error of central differences
+    h = np.finfo(np.float64).eps**(1/3) * (1. + np.linalg.norm(params))
+
+    def matvec(v: np.ndarray) -> np.ndarray:
+        v = np.asarray(v, dtype=np.float64).ravel()
+        norm = np.linalg.norm(v)
+        if norm == 0.:
+            return np.zeros_like(v)
+        step = h/norm
+        _, g_plus = score_and_grad_reg(params + step*v, plan, perc_met, penal, w_penal)
+        _, g_minus = score_and_grad_reg(params - step*v, plan, perc_met, penal, w_penal)
+        return (g_plus - g_minus)/(2*step)
+
+    n_params = params.shape[0]
+    return LinearOperator((n_params, n_params), matvec=matvec, rmatvec=matvec, dtype=np.float64)
+
+
+class ObjectiveCache:
+    """Bounded LRU cache of score_and_grad_reg and score_reg. Entries are keyed by a hash of the bytes of the parameter 
+    vector and the identity of the DatasetPlan, the penalty and the other arguments. A value stored by score_and_grad_reg 
+    is also returned by score_reg at the same point. Pass a DatasetPlan, a raw matrix is planned anew on every call 
+    and never hits the cache
+
+    Args:
+        maxsize (int, optional): Maximal number of cached points. Defaults to 32.
+    """
+    def __init__(self, maxsize: int = 32):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be positive, got {maxsize}")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _key(self, params: np.ndarray, plan: DatasetPlan, perc_met: float, penal: Callable, w_penal: float) -> tuple:
+        params = np.ascontiguousarray(params, dtype=np.float64)
+        return (hashlib.blake2b(params.tobytes(), digest_size=16).digest(), params.shape, id(plan), 
+                float(perc_met), penal, float(w_penal))
+
+    def _lookup(self, key: tuple, grad: bool) -> tuple[np.ndarray, np.ndarray | None] | None:
+        entry = self._entries.get(key)
+        if entry is None or (grad and entry[2] is None):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def _store(self, key: tuple, plan: DatasetPlan, value: np.ndarray, grad: np.ndarray | None) -> None:
+        # The plan is kept alive by its entry, such that its id is not reused while the entry exists
+        self._entries[key] = (plan, value, grad)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def score_and_grad_reg(self, params: np.ndarray, dat: jnp.ndarray | DatasetPlan, perc_met: float, 
+                           penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], 
+                           w_penal: float) -> tuple[np.ndarray, np.ndarray]:
+        """Cached score_and_grad_reg, see score_and_grad_reg"""
+        plan = make_plan(dat)
+        key = self._key(params, plan, perc_met, penal, w_penal)
+        cached = self._lookup(key, grad=True)
+        if cached is None:
+            cached = score_and_grad_reg(params, plan, perc_met, penal, w_penal)
+            self._store(key, plan, *cached)
+        return np.copy(cached[0]), np.copy(cached[1])
+
+    def score_reg(self, params: np.ndarray, dat: jnp.ndarray | DatasetPlan, perc_met: float, 
+                  penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], w_penal: float) -> np.ndarray:
+        """Cached score_reg, see score_reg"""
+        plan = make_plan(dat)
+        key = self._key(params, plan, perc_met, penal, w_penal)
+        cached = self._lookup(key, grad=False)
+        if cached is None:
+            cached = (score_reg(params, plan, perc_met, penal, w_penal), None)
+            self._store(key, plan, *cached)
+        return np.copy(cached[0])
+
+    def info(self) -> dict[str, int]:
+        """Numbers of hits, misses and cached points"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+    def clear(self) -> None:
+        """Removes all entries and resets the counters"""
+        self._entries.clear()
+        self.hits, self.misses = 0, 0
+
+
+# Seconds spent on tracing, lowering and compiling since the first _OptimizationMonitor was created
+_compile_time = [0.]
+_listening = [False]
+
+
+def _record_compile_time(event: str, duration: float, **kwargs) -> None:
+    if event.startswith("/jax/core/compile/"):
+        _compile_time[0] += duration
+
+
+def load_checkpoint(checkpoint: str) -> tuple[np.ndarray, int, int]:
+    """Loads a snapshot written by learn_mhn
+
+    Args:
+        checkpoint (str): Path to the snapshot
+
+    Returns:
+        tuple[np.ndarray, int, int]: Parameter vector, number of iterations and number of function evaluations performed so far
+    """
+    with np.load(checkpoint) as snap:
+        return snap["params"], int(snap["nit"]), int(snap["nfev"])
+
+
+class _OptimizationMonitor:
+    """Writes a JSONL record per iteration of an optimization and periodic snapshots of its parameters
+
+    Args:
+        penalty (Callable[[np.ndarray], float]): Weighted penalty of a parameter vector
+        checkpoint (str | None): Path of the snapshot file
+        checkpoint_every (int): Number of iterations between two snapshots
+        telemetry (str | None): Path of the JSONL file, records are appended
+        nit (int, optional): Number of iterations performed before, e.g. by a resumed run. Defaults to 0.
+        nfev (int, optional): Number of function evaluations performed before. Defaults to 0.
+    """
+    def __init__(self, penalty: Callable[[np.ndarray], float], checkpoint: str | None, checkpoint_every: int, 
+                 telemetry: str | None, nit: int = 0, nfev: int = 0):
+        if not _listening[0]:
+            monitoring.register_event_duration_secs_listener(_record_compile_time)
+            _listening[0] = True
+        self.penalty = penalty
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.sink = None if telemetry is None else open(telemetry, "a")
+        self.nit0, self.nfev0 = nit, nfev
+        self.nit, self.nfev = nit, nfev
+        self.t_last = time.perf_counter()
+        self.compile_last = _compile_time[0]
+
+    def record(self, nit: int, params: np.ndarray, f: float, g: np.ndarray, nfev: int) -> None:
+        """Records an iteration, nit and nfev count from the start of this run"""
+        now, compile_now = time.perf_counter(), _compile_time[0]
+        wall, compile_t = now - self.t_last, compile_now - self.compile_last
+        self.nit, self.nfev = self.nit0 + int(nit), self.nfev0 + int(nfev)
+        params = np.asarray(params)
+        if self.sink is not None:
+            rec = {"iteration": self.nit, "objective": float(f), "grad_norm": float(np.linalg.norm(g)), 
+                   "penalty": float(self.penalty(params)), "nfev": self.nfev, "wall_time": wall, 
+                   "compile_time": compile_t, "execute_time": max(wall - compile_t, 0.)}
+            self.sink.write(json.dumps(rec) + "\n")
+            self.sink.flush()
+        if self.checkpoint is not None and self.nit % self.checkpoint_every == 0:
+            self.save(params)
+        # Time spent on bookkeeping is attributed to the next iteration
+        self.t_last, self.compile_last = now, compile_now
+
+    def save(self, params: np.ndarray) -> None:
+        """Atomically replaces the snapshot"""
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, params=np.asarray(params), nit=self.nit, nfev=self.nfev)
+        os.replace(tmp, self.checkpoint)
+
+    def close(self) -> None:
+        if self.sink is not None:
+            self.sink.close()
+
+
+def _learn_stochastic(params: np.ndarray, stream: BatchStream, perc_met: float, 
+                      penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], w_penal: float, method: str, 
+                      learning_rate: float, n_epochs: int, ftol: float, opt_v: bool, 
+                      callback: Callable | None = None) -> np.ndarray:
+    """Minimizes the penalized negative log. likelihood with Adam or SGD on the mini-batches of stream. 
+    The step size decays with the inverse square root of the epoch. The optimization stops after n_epochs or once 
+    the relative reduction of the mean objective of an epoch is at most ftol"""
+    beta_1, beta_2, eps = 0.9, 0.999, 1e-08
+    m, v = np.zeros_like(params), np.zeros_like(params)
+    t, nfev, f_last = 0, 0, np.inf
+    for epoch in range(n_epochs):
+        step = learning_rate/np.sqrt(1. + epoch)
+        f_mean, g_mean = 0., np.zeros_like(params)
+        for batch in stream.epoch():
+            f, g = score_and_grad_reg(params, batch, perc_met, penal, w_penal)
+            nfev += 1
+            f_mean += f/len(stream)
+            g_mean += g/len(stream)
+            if method == "adam":
+                t += 1
+                m = beta_1*m + (1-beta_1)*g
+                v = beta_2*v + (1-beta_2)*g**2
+                params = params - step * (m/(1-beta_1**t)) / (np.sqrt(v/(1-beta_2**t)) + eps)
+            else:
+                params = params - step*g
+        if callback is not None:
+            callback(epoch + 1, params, f_mean, g_mean, nfev)
+        if opt_v:
+            print(f"Epoch {epoch + 1}, mean f: {f_mean}")
+        if epoch > 0 and f_last - f_mean <= ftol * max(abs(f_last), abs(f_mean), 1.):
+            break
+        f_last = f_mean
+    return params
+
+
+def _optimal_at_zero(params: np.ndarray, g: np.ndarray, penalized: np.ndarray, n_total: int, w_penal: float, 
+                     active_tol: float) -> np.ndarray:
+    """Marks the penalized parameters within active_tol of 0, that satisfy the optimality conditions of the exact 
+    penalty at 0 given the unpenalized gradient g"""
+    small = penalized & (np.abs(params) <= active_tol)
+    at_zero = small & (np.abs(g) < w_penal)
+    # The pairs (theta_ij, theta_ji) are penalized jointly by their norm |v|_M, see prox_symmetric_penal. A pair 
+    # is optimal at 0 if the dual norm |g|_{M^-1} of its gradient is below w_penal, which implies the L1 condition
+    g_th = g[:n_total**2].reshape((n_total, n_total))
+    s_th = small[:n_total**2].reshape((n_total, n_total))
+    pair_ok = 4/3*(g_th**2 + g_th*g_th.T + g_th.T**2) < w_penal**2
+    at_zero[:n_total**2] = (s_th & s_th.T & pair_ok).flatten()
+    return at_zero
+
+
+def _learn_active_set(params: np.ndarray, plan: DatasetPlan, perc_met: float, 
+                      penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], w_penal: float, max_iter: int, 
+                      ftol: float, opt_v: bool, kkt_every: int, active_tol: float, 
+                      callback: Callable | None = None) -> np.ndarray:
+    """Minimizes the penalized negative log. likelihood with L-BFGS-B over the free parameters only. Penalized parameters 
+    within active_tol of 0, whose unpenalized gradient is smaller than w_penal (in the dual norm of the pair for 
+    theta_ij and theta_ji), satisfy the optimality conditions of the exact penalty at 0. They are frozen at 0 and 
+    the conditions are rechecked for all parameters every kkt_every iterations. The optimization stops, once L-BFGS-B converged and the recheck does not change the frozen set"""
+    n_total = plan.n_total
+    penalized = np.ones(params.shape[0], dtype=bool)
+    penalized[np.arange(n_total)*(n_total + 1)] = False
+    frozen = np.zeros_like(penalized)
+    params = np.array(params, dtype=np.float64)
+    nit, nfev, converged = 0, 0, False
+    last = {"x": None}
+
+    def fun(free_params: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        nonlocal nfev
+        full = params.copy()
+        full[~frozen] = free_params
+        last["f"], g = score_and_grad_reg(full, plan, perc_met, penal, w_penal)
+        last["g"] = np.where(frozen, 0., g)
+        last["x"] = np.copy(free_params)
+        nfev += 1
+        return last["f"], last["g"][~frozen]
+
+    def record(xk: np.ndarray) -> None:
+        nonlocal nit
+        nit += 1
+        if not np.array_equal(last["x"], xk):
+            fun(xk)
+        full = params.copy()
+        full[~frozen] = xk
+        callback(nit, full, last["f"], last["g"], nfev)
+
+    while nit < max_iter:
+        _, g = score_and_grad_reg(params, plan, perc_met, _zero_penal, 0.)
+        nfev += 1
+        at_zero = _optimal_at_zero(params, g, penalized, n_total, w_penal, active_tol)
+        if converged and np.array_equal(at_zero, frozen):
+            break
+        frozen = at_zero
+        params[frozen] = 0.
+        logging.info(f"Active set: {int((~frozen).sum())} free, {int(frozen.sum())} frozen parameters")
+        nit_before = nit
+        x = opt.minimize(fun=fun, jac=True, x0=params[~frozen], method="L-BFGS-B", 
+                         callback=None if callback is None else record, 
+                         options={"maxiter": min(kkt_every, max_iter - nit), "disp": opt_v, "ftol": ftol})
+        params[~frozen] = x.x
+        if callback is None:
+            nit += x.nit
+        # An unchanged point after a changed frozen set would otherwise not advance the iteration count
+        nit = max(nit, nit_before + 1)
+        converged = x.status == 0
+    return params
+
+
+def learn_mhn(th_init: jnp.ndarray, dp_init: jnp.ndarray, dm_init: jnp.ndarray, dat: jnp.ndarray | DatasetPlan | str, perc_met: float, 
               penal: Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]], w_penal: float, opt_iter: int=1e05, opt_ftol: float=1e-04, 
-              opt_v: bool=True) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+              opt_v: bool=True, cache_dir: str | None = None, optimizer: str = "scipy", checkpoint: str | None = None, 
+              checkpoint_every: int = 100, telemetry: str | None = None, batch_size: int = 256, 
+              learning_rate: float = 1e-02, polish: bool = False, seed: int = 0, active_set: bool = False, 
+              kkt_every: int = 100, active_tol: float = 1e-03, cache: ObjectiveCache | None = None
+              ) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """ Infer a metMHN from data
 
     Args:
         th_init (jnp.ndarray): Initial estimate for the log-theta matrix. Matrix of dimension (n_muts+1) x (n_muts+1)
         dp_init (jnp.ndarray): Initial estimate for the effects of muts on PT-observation. Vector of size n_muts+1
         dm_init (jnp.ndarray): Inital estimate for the effects of muts on MT-observation. Vector of size n_muts+1 
-        dat (jnp.ndarray): Matrix of observations dimension (n_dat x (2n+3)), rows correspond to patients and columns to events.
+        dat (jnp.ndarray | DatasetPlan | str): Matrix of observations dimension (n_dat x (2n+3)) or its DatasetPlan, rows correspond to patients and columns to events.
             The first 2n+1 colummns are expected to be binary and inidacte the status of events of the tumors, the next column contains the observation order 
             (0: unknown, 1: First PT then MT, 2: First MT then PT) and the last column indicates the type of the datapoint 
-            (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced)
+            (0: PT only, no MT observed, 1: PT only, MT recorded but not sequenced, 2: MT, No PT sequenced, 3: PT and MT sequenced). 
+            The stochastic optimizers also accept the path to a .npy file of the matrix, which is streamed from disk
         perc_met (float):  Expected percentage of metastasizing tumor in the Dataset
         penal (Callable[[np.ndarray, int], tuple[np.ndarray, np.ndarray]]): Penalty function, should take parametervector params and totoal number of events as input and 
             return the value of the penality and the gradient of it wrt. to all model parameters
         penal (float): Weight of the penalty
-        opt_iter (int): Maximal number of iterations for optimizer. Defaults to 1e05
+        opt_iter (int): Maximal number of iterations for optimizer, of epochs for the stochastic optimizers. Defaults to 1e05
         opt_ftol (float): Tolerance for optimizer. Defaults to 1e-04
         opt_v (bool):  Print out optimizer progress. Defaults to TRUE
-        
+        cache_dir (str | None): Directory of a persistent compilation cache, see enable_compilation_cache. Defaults to None
+        optimizer (str): "scipy" for scipy's L-BFGS-B, "jax" for an L-BFGS, that runs entirely on the device, "trust-ncg" for 
+            scipy's trust-region Newton-CG driven by the Hessian-vector products of hessian_operator, or "proximal" 
+            for the proximal gradient method FISTA. "trust-ncg" stops, once the norm of the gradient drops below opt_ftol. "jax" requires a traceable penalty function, such as symmetric_penal. 
+            "proximal" supports symmetric_penal only, which it handles without smoothing, such that small effects become exactly 0. 
+            "adam" and "sgd" take steps on stratified mini-batches, see BatchStream, with a step size decaying with the 
+            inverse square root of the epoch. Defaults to "scipy"
+        checkpoint (str | None): Path of a snapshot of the parameters, which is written every checkpoint_every iterations 
+            and at the end of the optimization. If the file exists, the optimization resumes from it. The history of the 
+            quasi-Newton approximation is not stored, it is rebuilt after resuming. Defaults to None
+        checkpoint_every (int): Number of iterations between two snapshots. Defaults to 100
+        telemetry (str | None): Path of a JSONL file, to which a record with the objective, norm of the gradient, weighted penalty, 
+            cumulative number of function evaluations and the wall time of the iteration, split into compile and execute time, 
+            is appended per iteration. Defaults to None
+        batch_size (int): Approximate number of datapoints per mini-batch of the stochastic optimizers. Defaults to 256
+        learning_rate (float): Initial step size of the stochastic optimizers. Defaults to 1e-02
+        polish (bool): Refine the result of a stochastic optimizer with a full-batch L-BFGS-B, which runs until it meets opt_ftol 
+            or takes opt_iter iterations. It evaluates dat, if it is a DatasetPlan, and takes the remaining options of this call. Its snapshot is written to 
+            checkpoint with the suffix "_polish" and its records are appended to telemetry. Defaults to False
+        seed (int): Seed for drawing the mini-batches. Defaults to 0
+        active_set (bool): Freeze penalized parameters at 0, that satisfy the optimality conditions of an L1 penalty, and 
+            optimize over the remaining ones only. Supported by the "scipy" optimizer and by the polish of the stochastic 
+            optimizers. Defaults to False
+        kkt_every (int): Number of iterations between two rechecks of the frozen parameters. Defaults to 100
+        active_tol (float): Parameters with smaller absolute value are candidates for freezing. Defaults to 1e-03
+        cache (ObjectiveCache | None): Cache of the objective, used by the "scipy" and "trust-ncg" optimizers. Points revisited 
+            by the line search or the telemetry are not evaluated again. Defaults to None
 
     Returns:
         tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]: Estimated log. theta, log. d_p, log. d_m
     """
     n_total = th_init.shape[0]
+    if optimizer not in ("scipy", "trust-ncg", "jax", "proximal", "adam", "sgd"):
+        raise ValueError(f"Unknown optimizer {optimizer}")
+    stochastic = optimizer in ("adam", "sgd")
+    if optimizer == "proximal" and penal is not symmetric_penal:
+        raise ValueError("The proximal optimizer supports symmetric_penal only")
+    if active_set and optimizer != "scipy" and not (stochastic and polish):
+        raise ValueError("The active set strategy is supported by the scipy optimizer and the polish of the stochastic ones only")
+    if cache_dir is not None:
+        enable_compilation_cache(cache_dir)
+    if stochastic:
+        stream = BatchStream(dat.dat if isinstance(dat, DatasetPlan) else dat, batch_size, seed)
+    else:
+        plan = make_plan(dat)
     start_params = np.concatenate((th_init.flatten(), dp_init, dm_init))
-    x = opt.minimize(fun=score_and_grad_reg, jac=True, x0=start_params, method="L-BFGS-B",  
-                     args=(dat, perc_met, penal, w_penal), 
-                     options={"maxiter":opt_iter, "disp": opt_v, "ftol": opt_ftol})
-    theta = jnp.array(x.x[:n_total**2]).reshape((n_total, n_total))
-    d_p = jnp.array(x.x[n_total**2:n_total*(n_total+1)])
-    d_m = jnp.array(x.x[n_total*(n_total+1):])
+    nit, nfev = 0, 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        start_params, nit, nfev = load_checkpoint(checkpoint)
+        if start_params.shape[0] != n_total*(n_total+2):
+            raise ValueError(f"Checkpoint {checkpoint} does not match a model with {n_total} events")
+        logging.info(f"Resuming from {checkpoint} after {nit} iterations")
+
+    monitor = None
+    if checkpoint is not None or telemetry is not None:
+        if optimizer == "proximal":
+            penalty = lambda params: w_penal*symmetric_penal_exact(params, n_total)
+        else:
+            penalty = lambda params: w_penal*penal(params, n_total)[0]
+        monitor = _OptimizationMonitor(penalty, checkpoint, checkpoint_every, telemetry, nit, nfev)
+    max_iter = int(opt_iter) - nit
+    try:
+        if max_iter <= 0:
+            params = start_params
+        elif stochastic:
+            params = _learn_stochastic(start_params, stream, perc_met, penal, w_penal, optimizer, learning_rate, 
+                                       max_iter, opt_ftol, opt_v, None if monitor is None else monitor.record)
+        elif active_set:
+            params = _learn_active_set(start_params, plan, perc_met, penal, w_penal, max_iter, opt_ftol, opt_v, 
+                                       kkt_every, active_tol, None if monitor is None else monitor.record)
+        elif optimizer in ("scipy", "trust-ncg"):
+            objective = score_and_grad_reg if cache is None else cache.score_and_grad_reg
+            # The records reuse the value and gradient of the last evaluated point, if it is the accepted one
+            last = {"nfev": 0, "nit": 0, "x": None}
+
+            def monitored_fun(params, *args):
+                last["f"], last["g"] = objective(params, *args)
+                last["x"] = np.copy(params)
+                last["nfev"] += 1
+                return last["f"], last["g"]
+
+            def monitored_callback(xk):
+                last["nit"] += 1
+                if not np.array_equal(last["x"], xk):
+                    monitored_fun(xk, plan, perc_met, penal, w_penal)
+                monitor.record(last["nit"], xk, last["f"], last["g"], last["nfev"])
+
+            def hessp(params, v, *args):
+                last["nfev"] += 2
+                return hessian_operator(params, *args).matvec(v)
+
+            if optimizer == "trust-ncg":
+                options = {"maxiter":max_iter, "disp": opt_v, "gtol": opt_ftol}
+            else:
+                options = {"maxiter":max_iter, "disp": opt_v, "ftol": opt_ftol}
+            fun = objective if monitor is None else monitored_fun
+            callback = None if monitor is None else monitored_callback
+            x = opt.minimize(fun=fun, jac=True, hessp=hessp if optimizer == "trust-ncg" else None, x0=start_params, 
+                             method="L-BFGS-B" if optimizer == "scipy" else "trust-ncg", callback=callback, 
+                             args=(plan, perc_met, penal, w_penal), options=options)
+            params = x.x
+            if cache is not None:
+                logging.info(f"Objective cache: {cache.info()}")
+        else:
+            callback = None if monitor is None else monitor.record
+            if optimizer == "jax":
+                x = optimizers.lbfgs(_device_objective(plan, penal), start_params, maxiter=max_iter, ftol=opt_ftol, 
+                                     callback=callback, args=(perc_met, w_penal))
+            else:
+                x = optimizers.fista(_device_objective(plan, _zero_penal), *_device_prox(n_total), start_params, 
+                                     maxiter=max_iter, ftol=opt_ftol, callback=callback, args=(perc_met, w_penal))
+            if opt_v:
+                print(f"{optimizers.MESSAGES[x.status]}, iterations: {x.nit}, f: {x.fun}")
+            params = np.asarray(x.x)
+        if monitor is not None and checkpoint is not None:
+            monitor.save(params)
+    finally:
+        if monitor is not None:
+            monitor.close()
+    if stochastic and polish:
+        # The polish keeps the options of the caller, its snapshot is kept apart from the one of the stochastic run
+        polish_checkpoint = None
+        if checkpoint is not None:
+            root, ext = os.path.splitext(checkpoint)
+            polish_checkpoint = root + "_polish" + ext
+        return learn_mhn(jnp.array(params[:n_total**2]).reshape((n_total, n_total)), params[n_total**2:n_total*(n_total+1)], 
+                         params[n_total*(n_total+1):], dat if isinstance(dat, DatasetPlan) else DatasetPlan(stream.dat), 
+                         perc_met, penal, w_penal, opt_iter=opt_iter, opt_ftol=opt_ftol, opt_v=opt_v, cache_dir=cache_dir, 
+                         checkpoint=polish_checkpoint, checkpoint_every=checkpoint_every, telemetry=telemetry, 
+                         active_set=active_set, kkt_every=kkt_every, active_tol=active_tol, cache=cache)
+    theta = jnp.array(params[:n_total**2]).reshape((n_total, n_total))
+    d_p = jnp.array(params[n_total**2:n_total*(n_total+1)])
+    d_m = jnp.array(params[n_total*(n_total+1):])
     return theta, d_p, d_m
\ No newline at end of file
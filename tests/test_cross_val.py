@@ -0,0 +1,78 @@
+import metmhn.regularized_optimization as regopt
+import metmhn.Utilityfunctions as utils
+import jax.numpy as jnp
+import numpy as np
+import unittest
+import jax as jax
+jax.config.update("jax_enable_x64", True)
+
+
+class CrossValTestCase(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.n_mut = 2
+        rng = np.random.default_rng(seed=42)
+        rows = []
+        for d_type, seeding in [(0, 0), (1, 1), (2, 1)]:
+            for _ in range(10):
+                geno = rng.binomial(1, 0.4, 2*self.n_mut)
+                if d_type < 2:
+                    geno[1::2] = 0
+                else:
+                    geno[0::2] = 0
+                rows.append(np.append(geno, [seeding, -99, d_type]))
+        self.dat = jnp.array(rows, dtype=jnp.int8)
+        self.perc_met = 0.5
+        self.splits = jnp.array([1e-03, 1e-01])
+
+    def test_path(self):
+        runs = utils.cross_val(self.dat, regopt.symmetric_penal, self.splits, 2, self.perc_met)
+        runs_path, fits = utils.cross_val(self.dat, regopt.symmetric_penal, self.splits, 2, self.perc_met, path=True)
+        self.assertEqual(runs_path.shape, runs.shape)
+        # Warm and cold starts end in the same optimum up to the tolerance of the optimizer
+        np.testing.assert_allclose(runs_path.to_numpy(), runs.to_numpy(), rtol=5e-02)
+        self.assertEqual(set(fits.keys()), set(float(l) for l in self.splits))
+        # The weaker penalization is warm-started from the solution of the stronger one
+        th, dp, dm = regopt.learn_mhn(*fits[float(self.splits[1])], self.dat, self.perc_met, regopt.symmetric_penal, 
+                                      float(self.splits[0]), opt_v=False)
+        np.testing.assert_allclose(fits[float(self.splits[0])][0], th, rtol=1e-10)
+
+    def test_n_jobs(self):
+        runs, fits = utils.cross_val(self.dat, regopt.symmetric_penal, self.splits, 2, self.perc_met, path=True)
+        runs_pool, fits_pool = utils.cross_val(self.dat, regopt.symmetric_penal, self.splits, 2, self.perc_met, 
+                                               path=True, n_jobs=2)
+        np.testing.assert_allclose(runs_pool.to_numpy(), runs.to_numpy(), rtol=1e-10)
+        for l, params in fits.items():
+            for p_pool, p in zip(fits_pool[l], params):
+                np.testing.assert_allclose(p_pool, p, rtol=1e-10)
+
+    def test_successive_halving(self):
+        splits = jnp.array([1e-03, 1e-02, 1e-01, 1.])
+        runs, best = utils.successive_halving(self.dat, regopt.symmetric_penal, splits, 2, self.perc_met, 
+                                              min_iter=5, eta=2)
+        self.assertEqual(runs.shape, (2, splits.shape[0]))
+        self.assertIn(best, [float(l) for l in splits])
+        self.assertTrue(np.all(np.isfinite(runs.to_numpy())))
+        with self.assertRaises(ValueError):
+            utils.successive_halving(self.dat, regopt.symmetric_penal, splits, 2, self.perc_met, eta=1)
+
+    def test_multi_start(self):
+        w_penal = float(self.splits[0])
+        (th, dp, dm), scores = utils.multi_start(self.dat, regopt.symmetric_penal, w_penal, self.perc_met, 3, 
+                                                 stage_iter=5, margin=1e-02)
+        self.assertEqual(scores.shape[0], 3)
+        params = np.concatenate((th.flatten(), dp, dm))
+        obj = regopt.score_reg(params, self.dat, self.perc_met, regopt.symmetric_penal, w_penal)
+        np.testing.assert_allclose(obj, scores["objective"].min(), rtol=1e-10)
+        self.assertTrue(all(scores["n_stages"] > 0))
+        # Hopeless starts are outside the margin of the leader
+        leader = scores["objective"].min()
+        self.assertTrue(all(scores.loc[scores["terminated"], "objective"] > leader))
+        (th_pool, _, _), scores_pool = utils.multi_start(self.dat, regopt.symmetric_penal, w_penal, self.perc_met, 3, 
+                                                         stage_iter=5, margin=1e-02, n_jobs=2)
+        np.testing.assert_allclose(scores_pool["objective"].to_numpy(), scores["objective"].to_numpy(), rtol=1e-10)
+        np.testing.assert_allclose(th_pool, th, rtol=1e-10)
+
+
+if __name__ == "__main__":
+    unittest.main()
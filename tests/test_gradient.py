@@ -1,8 +1,12 @@
 import metmhn.regularized_optimization as regopt
 import metmhn.Utilityfunctions as utils
+import metmhn.jx.likelihood as ssr
+import metmhn.jx.vanilla as mhn
+import metmhn.jx.kronvec as kv
 import jax.numpy as jnp
 import numpy as np
 import unittest
+from unittest import mock
 import jax as jax
 jax.config.update("jax_enable_x64", True)
 
@@ -156,6 +160,134 @@ class DerivativeTestCase(unittest.TestCase):
                                    rtol=self.tol,
                                    atol=self.tol)
 
+    def test_autodiff(self):
+        # jax.grad differentiates through the solvers with their custom VJPs and matches the handwritten gradient
+        dat = jnp.vstack((self.state_prim_met, self.state_prim_only, self.state_met, 
+                          self.state_coupled_0, self.state_coupled_1, self.state_coupled_2, 
+                          self.empty_0, self.empty_1, self.empty_2,
+                          jnp.array([0]*(2*self.n_mut)+[0, -99, 0]).reshape((1, -1)),
+                          jnp.array([0]*(2*self.n_mut)+[1, -99, 1]).reshape((1, -1)),
+                          jnp.array([0]*(2*self.n_mut)+[1, -99, 2]).reshape((1, -1))))
+        plan = regopt.DatasetPlan(dat)
+        g_auto = jax.grad(regopt.score, argnums=(0, 1, 2))(self.theta, self.d_p, self.d_m, plan, 0.8)
+        _, dth_ana, dp_ana, dm_ana = regopt.score_and_grad(self.theta, self.d_p, self.d_m, plan, 0.8)
+        for auto, ana in zip(g_auto, (dth_ana, dp_ana, dm_ana)):
+            np.testing.assert_allclose(auto, ana, rtol=1e-10, atol=1e-12)
+
+
+class SolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.n_mut = 5
+        rng = np.random.default_rng(seed=7)
+        self.theta = jnp.array(rng.normal(-1, 1, size=(self.n_mut+1, self.n_mut+1)))
+        self.d_p = jnp.array(rng.normal(0, 1, size=self.n_mut+1))
+        self.d_m = jnp.array(rng.normal(0, 1, size=self.n_mut+1))
+        self.x = lambda k: jnp.array(rng.random(2**k))
+        self.states = [jnp.array([1,1, 1,0, 0,1, 0,0, 1,1, 1]),
+                       jnp.array([1,1, 1,0, 0,1, 0,0, 1,1, 0]),
+                       jnp.array([1,0, 0,1, 1,1, 0,0, 0,0, 1])]
+    
+    def test_solvers_joint(self):
+        for state in self.states:
+            k = int(state.sum())
+            x = self.x(k)
+            for transpose in (False, True):
+                y_jac = ssr.R_i_inv_vec(self.theta, self.d_p, self.d_m, x, state, k, transpose, "jacobi")
+                for method in ("levels", "dense"):
+                    y = ssr.R_i_inv_vec(self.theta, self.d_p, self.d_m, x, state, k, transpose, method)
+                    np.testing.assert_allclose(y, y_jac, rtol=1e-12)
+    
+    def test_solvers_vanilla(self):
+        state = jnp.array([1, 0, 1, 1, 0, 1])
+        x, d_rates = self.x(4), self.x(4) + 0.5
+        for transpose in (False, True):
+            y_jac = mhn.R_inv_vec(self.theta, x, state, d_rates, transpose, "jacobi")
+            for method in ("levels", "dense"):
+                y = mhn.R_inv_vec(self.theta, x, state, d_rates, transpose, method)
+                np.testing.assert_allclose(y, y_jac, rtol=1e-12)
+    
+    def test_solvers_vjp(self):
+        state = self.states[0]
+        k = int(state.sum())
+        x = self.x(k)
+        def f(theta, d_p, d_m, method):
+            return jnp.sum(jnp.log(ssr.R_i_inv_vec(theta, d_p, d_m, x, state, k, False, method)))
+        g_jac = jax.grad(f, argnums=(0, 1, 2))(self.theta, self.d_p, self.d_m, "jacobi")
+        for method in ("levels", "dense"):
+            g = jax.grad(f, argnums=(0, 1, 2))(self.theta, self.d_p, self.d_m, method)
+            for g_m, jac in zip(g, g_jac):
+                np.testing.assert_allclose(g_m, jac, rtol=1e-10, atol=1e-12)
+    
+    def test_kronvec_fused(self):
+        for state in self.states + [jnp.array([1,1, 1,1, 0,0, 0,0, 0,0, 0])]:
+            x = self.x(int(state.sum()))
+            for diag in (True, False):
+                for transpose in (False, True):
+                    np.testing.assert_allclose(kv.kronvec_fused(self.theta, x, state, diag, transpose), 
+                                               kv.kronvec(self.theta, x, state, diag, transpose, False), 
+                                               rtol=1e-12, atol=1e-14)
+
+    def test_kronvec_fused_float32(self):
+        # The rates of the lower bits alone exceed the range of float32, the rates of the states do not
+        n = 4
+        theta = np.full((n+1, n+1), 45.)
+        theta[:, 2:] = 0.
+        np.fill_diagonal(theta, -60.)
+        state = jnp.ones(2*n+1, dtype=int)
+        x = self.x(2*n+1)
+        for diag in (True, False):
+            for transpose in (False, True):
+                ref = kv.kronvec_fused(jnp.array(theta), x, state, diag, transpose)
+                single = kv.kronvec_fused(jnp.array(theta, dtype=np.float32), jnp.array(x, dtype=np.float32),
+                                          state, diag, transpose)
+                np.testing.assert_allclose(single, ref, rtol=1e-04, atol=1e-06*float(jnp.max(jnp.abs(ref))))
+
+    def test_parallel_summands(self):
+        for state in self.states + [jnp.array([1,1, 1,1, 0,0, 0,0, 0,0, 0])]:
+            n_state = int(state.sum())
+            x = self.x(n_state)
+            np.testing.assert_allclose(kv.kron_diag(self.theta, state, n_state, True),
+                                       kv.kron_diag(self.theta, state, n_state, False),
+                                       rtol=1e-12, atol=1e-14)
+            for diag in (True, False):
+                for transpose in (False, True):
+                    seq = kv.kronvec(self.theta, x, state, diag, transpose, False)
+                    for f in (kv.kronvec, kv.kronvec_fused):
+                        np.testing.assert_allclose(f(self.theta, x, state, diag, transpose, True), seq,
+                                                   rtol=1e-12, atol=1e-14)
+
+    def test_parallel_batch(self):
+        # Coupled datapoints with 2 events in each tumor share a bucket, a single one fits below the threshold
+        rows = [[1,1, 1,0, 0,1, 0,0, 0,0, 1, 1, 3], [1,0, 1,1, 0,1, 0,0, 0,0, 1, 1, 3], [0,1, 1,1, 1,0, 0,0, 0,0, 1, 1, 3]]
+        n_state = 5
+        self.addCleanup(kv.set_parallel_max_entries, kv._PARALLEL_MAX_ENTRIES)
+        kv.set_parallel_max_entries(self.n_mut * 2**n_state)
+        use_parallel = kv._use_parallel
+        for dat, expected in ((rows, False), (rows[:1], True)):
+            decisions = []
+            def spy(*args):
+                decisions.append(use_parallel(*args))
+                return decisions[-1]
+            with mock.patch.object(kv, "_use_parallel", spy):
+                jax.clear_caches()
+                regopt.score_and_grad(self.theta, self.d_p, self.d_m, regopt.DatasetPlan(jnp.array(dat)), 0.5)
+            self.assertTrue(decisions)
+            self.assertTrue(all(d == expected for d in decisions))
+    
+    def test_dense_scores(self):
+        # The likelihood and its gradient do not depend on the solver chosen for small state spaces
+        dat = jnp.array([[1,1, 1,0, 0,1, 0,0, 1,1, 1, 0, 3],
+                         [1,1, 0,1, 1,1, 0,0, 0,0, 1, 1, 3],
+                         [1,0, 1,0, 0,0, 1,0, 1,0, 1, -99, 1]])
+        self.addCleanup(mhn.set_dense_max_state, mhn._DENSE_MAX_STATE)
+        res = []
+        for n_state in (0, 7):
+            mhn.set_dense_max_state(n_state)
+            res.append(regopt.score_and_grad(self.theta, self.d_p, self.d_m, dat, 0.5))
+        for jac, dense in zip(*res):
+            np.testing.assert_allclose(dense, jac, rtol=1e-10, atol=1e-12)
+
+
 if __name__ == "__main__":
     unittest.main()
 
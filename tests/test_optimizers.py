@@ -0,0 +1,216 @@
+import metmhn.regularized_optimization as regopt
+import metmhn.Utilityfunctions as utils
+from metmhn.jx import optimizers
+import jax.numpy as jnp
+import numpy as np
+import unittest
+import tempfile
+import json
+import os
+import jax as jax
+jax.config.update("jax_enable_x64", True)
+
+
+def rosenbrock(x):
+    f = lambda x: jnp.sum(100*(x[1:] - x[:-1]**2)**2 + (1 - x[:-1])**2)
+    return f(x), jax.grad(f)(x)
+
+
+class OptimizerTestCase(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.n_mut = 2
+        rng = np.random.default_rng(seed=42)
+        rows = []
+        for d_type, seeding, order in [(0, 0, -99), (1, 1, -99), (2, 1, -99)]:
+            for _ in range(10):
+                geno = rng.binomial(1, 0.4, 2*self.n_mut)
+                if d_type < 2:
+                    geno[1::2] = 0
+                elif d_type == 2:
+                    geno[0::2] = 0
+                rows.append(np.append(geno, [seeding, order, d_type]))
+        # Coupled datapoints with one active event only, their kernels compile quickly
+        rows += [np.array([0]*(2*self.n_mut) + [1, order, 3]) for order in range(3)]
+        self.dat = np.array(rows, dtype=np.int8)
+        self.perc_met = 0.5
+
+    def test_lbfgs_rosenbrock(self):
+        res = optimizers.lbfgs(rosenbrock, jnp.zeros(5), ftol=1e-14)
+        self.assertIn(res.status, (optimizers.CONVERGED_F, optimizers.CONVERGED_G))
+        np.testing.assert_allclose(res.x, np.ones(5), atol=1e-04)
+
+    def test_learn_mhn_jax(self):
+        plan = regopt.DatasetPlan(self.dat)
+        th_init, dp_init, dm_init = utils.indep(self.dat)
+        args = (th_init, dp_init, dm_init, plan, self.perc_met, regopt.symmetric_penal, 1e-03)
+        res_scipy = regopt.learn_mhn(*args, opt_ftol=1e-08, opt_v=False)
+        res_jax = regopt.learn_mhn(*args, opt_ftol=1e-08, opt_v=False, optimizer="jax")
+        scores = [regopt.score_reg(np.concatenate([np.array(r).flatten() for r in res]), plan, self.perc_met,
+                                   regopt.symmetric_penal, 1e-03) for res in (res_scipy, res_jax)]
+        np.testing.assert_allclose(scores[1], scores[0], rtol=1e-04)
+        # A fit with another weight of the penalty reuses the compiled loop
+        n_compiled = optimizers._lbfgs_run._cache_size()
+        regopt.learn_mhn(*args[:-1], 2e-03, opt_ftol=1e-08, opt_v=False, optimizer="jax")
+        self.assertEqual(optimizers._lbfgs_run._cache_size(), n_compiled)
+
+    def test_prox_symmetric_penal(self):
+        rng = np.random.default_rng(seed=0)
+        n_total = self.n_mut + 1
+        params = rng.normal(0, 1, size=n_total*(n_total+2))
+        step = 0.7
+        prox = regopt.prox_symmetric_penal(jnp.array(params), n_total, step)
+        obj = lambda x: 0.5*np.sum((x - params)**2) + step*float(regopt.symmetric_penal_exact(jnp.array(x), n_total))
+        for _ in range(20):
+            x = np.array(prox) + rng.normal(0, 1e-03, size=params.size)
+            self.assertLessEqual(obj(np.array(prox)), obj(x) + 1e-12)
+        self.assertTrue(np.any(np.array(prox) == 0.))
+
+    def test_learn_mhn_proximal(self):
+        plan = regopt.DatasetPlan(self.dat)
+        n_total = self.n_mut + 1
+        th_init, dp_init, dm_init = utils.indep(self.dat)
+        w_penal = 0.05
+        args = (th_init, dp_init, dm_init, plan, self.perc_met, regopt.symmetric_penal, w_penal)
+        res = [regopt.learn_mhn(*args, opt_ftol=1e-10, opt_v=False, optimizer=o) for o in ("scipy", "proximal")]
+        params = [np.concatenate([np.array(r).flatten() for r in res_]) for res_ in res]
+        objs = [regopt.score_reg(p, plan, self.perc_met, lambda p, n: (regopt.symmetric_penal_exact(p, n), 0.), w_penal) 
+                for p in params]
+        self.assertLessEqual(objs[1], objs[0] + 1e-06)
+        # Small effects are exactly 0 instead of being shrunk to approximately 0
+        self.assertTrue(np.any(params[1][n_total**2:] == 0.))
+        self.assertFalse(np.any(params[0][n_total**2:] == 0.))
+
+    def test_learn_mhn_active_set(self):
+        plan = regopt.DatasetPlan(self.dat)
+        th_init, dp_init, dm_init = utils.indep(self.dat)
+        w_penal = 0.05
+        args = (th_init, dp_init, dm_init, plan, self.perc_met, regopt.symmetric_penal, w_penal)
+        res = [regopt.learn_mhn(*args, opt_ftol=1e-10, opt_v=False, active_set=a, kkt_every=10) for a in (False, True)]
+        params = [np.concatenate([np.array(r).flatten() for r in res_]) for res_ in res]
+        objs = [regopt.score_reg(p, plan, self.perc_met, regopt.symmetric_penal, w_penal) for p in params]
+        np.testing.assert_allclose(objs[1], objs[0], rtol=1e-04)
+        # Frozen parameters are exactly 0, the diagonal of theta is never frozen
+        self.assertTrue(np.any(params[1] == 0.))
+        self.assertFalse(np.any(np.diag(np.array(res[1][0])) == 0.))
+        with self.assertRaises(ValueError):
+            regopt.learn_mhn(*args, opt_v=False, optimizer="jax", active_set=True)
+
+    def test_optimal_at_zero(self):
+        n_total = self.n_mut + 1
+        w_penal = 1.
+        params = np.zeros(n_total*(n_total+2))
+        params[1*n_total + 2] = 0.5
+        penalized = np.ones_like(params, dtype=bool)
+        penalized[np.arange(n_total)*(n_total + 1)] = False
+        g = np.zeros_like(params)
+        g_th = np.array([[3., 0.8, 0.8],
+                         [0.8, 3., 0.3],
+                         [-0.8, 0., 3.]])
+        g[:n_total**2] = g_th.flatten()
+        g[n_total**2:] = [0.5, 1.5, 0., 0.5, 1.5, 0.]
+        at_zero = regopt._optimal_at_zero(params, g, penalized, n_total, w_penal, 1e-03)
+        # Both entries of the pair (0, 1) are below w_penal, but the pair is not optimal at 0
+        expected_th = np.array([[False, False, True],
+                                [False, False, False],
+                                [True, False, False]])
+        np.testing.assert_array_equal(at_zero[:n_total**2], expected_th.flatten())
+        np.testing.assert_array_equal(at_zero[n_total**2:], [True, False, True, True, False, True])
+        # A proximal gradient step from 0 keeps the same pairs at 0, and the pair (1, 2), which is not small
+        prox = np.array(regopt.prox_symmetric_penal(jnp.array(-g), n_total, w_penal)[:n_total**2]).reshape((n_total, n_total))
+        expected_th[1, 2] = expected_th[2, 1] = True
+        np.testing.assert_array_equal((prox == 0.) & ~np.eye(n_total, dtype=bool), expected_th)
+
+    def test_checkpoint_telemetry(self):
+        plan = regopt.DatasetPlan(self.dat)
+        th_init, dp_init, dm_init = utils.indep(self.dat)
+        args = (th_init, dp_init, dm_init, plan, self.perc_met, regopt.symmetric_penal, 1e-03)
+        score = lambda res: regopt.score_reg(np.concatenate([np.array(r).flatten() for r in res]), plan, self.perc_met,
+                                             regopt.symmetric_penal, 1e-03)
+        ref = regopt.learn_mhn(*args, opt_ftol=1e-08, opt_v=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint, telemetry = os.path.join(tmp, "snap.npz"), os.path.join(tmp, "log.jsonl")
+            # Interrupted after 3 iterations
+            regopt.learn_mhn(*args, opt_iter=3, opt_ftol=1e-08, opt_v=False, checkpoint=checkpoint, 
+                             checkpoint_every=2, telemetry=telemetry)
+            _, nit, nfev = regopt.load_checkpoint(checkpoint)
+            self.assertEqual(nit, 3)
+            res = regopt.learn_mhn(*args, opt_ftol=1e-08, opt_v=False, checkpoint=checkpoint, telemetry=telemetry)
+            np.testing.assert_allclose(score(res), score(ref), rtol=1e-04)
+            with open(telemetry) as f:
+                records = [json.loads(l) for l in f]
+            self.assertEqual([r["iteration"] for r in records], list(range(1, len(records) + 1)))
+            self.assertEqual(records[2]["nfev"], nfev)
+            self.assertGreater(records[0]["compile_time"] + records[0]["execute_time"], 0.)
+            self.assertTrue(all(r["penalty"] > 0. for r in records))
+
+            os.remove(telemetry)
+            regopt.learn_mhn(*args, opt_iter=5, opt_v=False, optimizer="jax", telemetry=telemetry)
+            with open(telemetry) as f:
+                records = [json.loads(l) for l in f]
+            self.assertEqual([r["iteration"] for r in records], list(range(1, 6)))
+
+    def test_batch_stream(self):
+        params = np.concatenate([np.array(p).flatten() for p in utils.indep(self.dat)])
+        full = regopt.score_reg(params, self.dat, self.perc_met, regopt.symmetric_penal, 1e-03)
+        single = next(regopt.BatchStream(self.dat, self.dat.shape[0]).epoch())
+        np.testing.assert_allclose(regopt.score_reg(params, single, self.perc_met, regopt.symmetric_penal, 1e-03), 
+                                   full, rtol=1e-10)
+        stream = regopt.BatchStream(self.dat, 8)
+        batches = list(stream.epoch())
+        self.assertEqual(len(batches), len(stream))
+        self.assertEqual(sum(len(b) for b in batches), self.dat.shape[0])
+        # Both groups are present in every batch, such that the reweighting to perc_met is unbiased
+        self.assertTrue(all(0 < b.n_em < len(b) for b in batches))
+
+    def test_learn_mhn_stochastic(self):
+        plan = regopt.DatasetPlan(self.dat)
+        th_init, dp_init, dm_init = utils.indep(self.dat)
+        score = lambda res: regopt.score_reg(np.concatenate([np.array(r).flatten() for r in res]), plan, self.perc_met,
+                                             regopt.symmetric_penal, 1e-03)
+        ref = regopt.learn_mhn(th_init, dp_init, dm_init, plan, self.perc_met, regopt.symmetric_penal, 1e-03, 
+                               opt_ftol=1e-08, opt_v=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "dat.npy")
+            np.save(source, self.dat)
+            args = (th_init, dp_init, dm_init, source, self.perc_met, regopt.symmetric_penal, 1e-03)
+            res = regopt.learn_mhn(*args, opt_iter=20, opt_v=False, optimizer="adam", batch_size=8, learning_rate=0.05)
+            self.assertLess(score(res), score((th_init, dp_init, dm_init)))
+            checkpoint, telemetry = os.path.join(tmp, "snap.npz"), os.path.join(tmp, "log.jsonl")
+            res = regopt.learn_mhn(*args, opt_iter=100, opt_ftol=1e-08, opt_v=False, optimizer="sgd", batch_size=8, 
+                                   polish=True, checkpoint=checkpoint, telemetry=telemetry)
+            np.testing.assert_allclose(score(res), score(ref), rtol=1e-04)
+            # The polish keeps the checkpoint and telemetry of the call, next to the ones of the stochastic run
+            _, n_epochs, _ = regopt.load_checkpoint(checkpoint)
+            _, n_polish, _ = regopt.load_checkpoint(os.path.join(tmp, "snap_polish.npz"))
+            with open(telemetry) as f:
+                self.assertEqual(len(f.readlines()), n_epochs + n_polish)
+
+    def test_learn_mhn_trust_ncg(self):
+        plan = regopt.DatasetPlan(self.dat)
+        th_init, dp_init, dm_init = utils.indep(self.dat)
+        args = (th_init, dp_init, dm_init, plan, self.perc_met, regopt.symmetric_penal, 1e-03)
+        score = lambda res: regopt.score_reg(np.concatenate([np.array(r).flatten() for r in res]), plan, self.perc_met,
+                                             regopt.symmetric_penal, 1e-03)
+        with tempfile.TemporaryDirectory() as tmp:
+            n_iter = []
+            results = []
+            for optimizer in ("scipy", "trust-ncg"):
+                telemetry = os.path.join(tmp, f"{optimizer}.jsonl")
+                results.append(regopt.learn_mhn(*args, opt_ftol=1e-08, opt_v=False, optimizer=optimizer, telemetry=telemetry))
+                with open(telemetry) as f:
+                    n_iter.append(len(f.readlines()))
+        np.testing.assert_allclose(score(results[1]), score(results[0]), rtol=1e-06)
+        self.assertLess(n_iter[1], n_iter[0])
+
+        params = np.concatenate([np.array(r).flatten() for r in results[1]])
+        hess = regopt.hessian_operator(params, plan, self.perc_met, regopt.symmetric_penal, 1e-03)
+        rng = np.random.default_rng(seed=0)
+        u, v = rng.normal(size=(2, params.shape[0]))
+        np.testing.assert_allclose(u @ hess.matvec(v), v @ hess.matvec(u), rtol=1e-05)
+        # Positive curvature at the minimum
+        self.assertGreater(u @ hess.matvec(u), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
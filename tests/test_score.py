@@ -0,0 +1,180 @@
+import metmhn.regularized_optimization as regopt
+import metmhn.Utilityfunctions as utils
+import metmhn.jx.likelihood as ssr
+import metmhn.jx.one_event as one
+import jax.numpy as jnp
+import numpy as np
+import unittest
+import jax as jax
+jax.config.update("jax_enable_x64", True)
+
+
+def reference_score(log_theta, log_d_p, log_d_m, dat, perc_met):
+    """Row by row evaluation of the log. likelihood of dat"""
+    n_mut = (dat.shape[1]-3)//2
+    n_total = n_mut + 1
+    score, score_pt = 0., 0.
+    for i in range(dat.shape[0]):
+        if dat[i,-1] < 2:
+            state_obs = dat[i, 0:2*n_total-1:2]
+            n_prim = int(state_obs.sum())
+            if n_prim == 0:
+                lp = ssr._lp_prim_obs_az(log_theta)
+            else:
+                lp = ssr._lp_prim_obs(log_theta, log_d_p, state_obs, n_prim)
+            if dat[i,-1] == 0:
+                score_pt += lp
+            else:
+                score += lp
+        elif dat[i,-1] == 2:
+            state_met = jnp.append(dat[i, 1:2*n_total-1:2], 1)
+            score += ssr._lp_met_obs(log_theta, log_d_p, log_d_m, state_met, int(state_met.sum()))
+        else:
+            state_obs = dat[i, 0:2*n_mut+1]
+            n_prim = int(state_obs[::2].sum())
+            n_met = int(state_obs[1::2].sum() + 1)
+            order = int(dat[i,-2])
+            if (n_prim + n_met - 1) == 1:
+                lp = [one._lp_coupled_0, one._lp_coupled_1, one._lp_coupled_2][order]
+                score += lp(log_theta, log_d_p, log_d_m, state_obs)
+            else:
+                lp = [ssr._lp_coupled_0, ssr._lp_coupled_1, ssr._lp_coupled_2][order]
+                score += lp(log_theta, log_d_p, log_d_m, state_obs, n_prim, n_met)
+    n_em = dat[:,-3].sum()
+    n_nm = dat.shape[0] - n_em
+    w = perc_met * n_nm/((1-perc_met)*n_em)
+    return (w*score + score_pt)/(w*n_em + n_nm)
+
+
+class ScoreTestCase(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.n_mut = 2
+        rng = np.random.default_rng(seed=42)
+        self.theta = jnp.array(utils.random_theta(self.n_mut, 0.2))
+        self.d_p = jnp.array(rng.normal(0, 1, size=self.n_mut+1))
+        self.d_m = jnp.array(rng.normal(0, 1, size=self.n_mut+1))
+
+        rows = []
+        for d_type, seeding, order in [(0, 0, -99), (1, 1, -99), (2, 1, -99),
+                                       (3, 1, 0), (3, 1, 1), (3, 1, 2)]:
+            for _ in range(4):
+                geno = rng.binomial(1, 0.4, 2*self.n_mut)
+                if d_type < 2:
+                    geno[1::2] = 0
+                elif d_type == 2:
+                    geno[0::2] = 0
+                rows.append(np.append(geno, [seeding, order, d_type]))
+        # Duplicated and empty genotypes
+        rows.append(rows[0])
+        rows.append(rows[13])
+        rows.append(np.array([0]*(2*self.n_mut) + [0, -99, 0]))
+        rows.append(np.array([0]*(2*self.n_mut) + [1, 0, 3]))
+        self.dat = np.array(rows, dtype=np.int8)
+        self.perc_met = 0.6
+
+    def test_score(self):
+        ref = reference_score(self.theta, self.d_p, self.d_m, self.dat, self.perc_met)
+        sc = regopt.score(self.theta, self.d_p, self.d_m, jnp.array(self.dat), self.perc_met)
+        np.testing.assert_allclose(sc, ref, rtol=1e-10)
+
+    def test_score_and_grad_score(self):
+        sc = regopt.score(self.theta, self.d_p, self.d_m, jnp.array(self.dat), self.perc_met)
+        sc_2, _, _, _ = regopt.score_and_grad(self.theta, self.d_p, self.d_m, jnp.array(self.dat), self.perc_met)
+        np.testing.assert_allclose(sc_2, sc, rtol=1e-10)
+
+    def test_unique_patterns(self):
+        patterns, counts, inverse = regopt.unique_patterns(jnp.array(self.dat))
+        self.assertEqual(counts.sum(), self.dat.shape[0])
+        self.assertLess(patterns.shape[0], self.dat.shape[0])
+        np.testing.assert_array_equal(patterns[inverse, :-2], self.dat[:, :-2])
+        np.testing.assert_array_equal(patterns[inverse, -1], self.dat[:, -1])
+
+    def test_plan(self):
+        plan = regopt.DatasetPlan(self.dat)
+        self.assertEqual(sum(int(b.counts.sum()) for b in plan.buckets), self.dat.shape[0])
+        sc = regopt.score(self.theta, self.d_p, self.d_m, jnp.array(self.dat), self.perc_met)
+        sc_plan = regopt.score(self.theta, self.d_p, self.d_m, plan, self.perc_met)
+        np.testing.assert_allclose(sc_plan, sc, rtol=1e-10)
+        params = np.concatenate((self.theta.flatten(), self.d_p, self.d_m))
+        val, grad = regopt.score_and_grad_reg(params, jnp.array(self.dat), self.perc_met, regopt.symmetric_penal, 0.1)
+        val_plan, grad_plan = regopt.score_and_grad_reg(params, plan, self.perc_met, regopt.symmetric_penal, 0.1)
+        np.testing.assert_allclose(val_plan, val, rtol=1e-10)
+        np.testing.assert_allclose(grad_plan, grad, rtol=1e-10)
+
+    def test_warm_up(self):
+        plan = regopt.DatasetPlan(self.dat)
+        self.assertGreaterEqual(regopt.warm_up(plan, n_threads=2), 0.)
+        sc = regopt.score(self.theta, self.d_p, self.d_m, plan, self.perc_met)
+        ref = reference_score(self.theta, self.d_p, self.d_m, self.dat, self.perc_met)
+        np.testing.assert_allclose(sc, ref, rtol=1e-10)
+
+    def test_padded_plan(self):
+        plan = regopt.DatasetPlan(self.dat)
+        padded = regopt.DatasetPlan(self.dat, size_classes=[3])
+        self.assertLess(len(padded.buckets), len(plan.buckets))
+        ref = regopt.score_and_grad(self.theta, self.d_p, self.d_m, plan, self.perc_met)
+        res = regopt.score_and_grad(self.theta, self.d_p, self.d_m, padded, self.perc_met)
+        for r, e in zip(res, ref):
+            np.testing.assert_allclose(r, e, rtol=1e-10, atol=1e-12)
+
+    def test_sharded_plan(self):
+        # Uses all available devices, e.g. XLA_FLAGS="--xla_force_host_platform_device_count=4" on CPU
+        sharded = regopt.DatasetPlan(self.dat, n_devices=len(jax.devices()))
+        ref = regopt.score_and_grad(self.theta, self.d_p, self.d_m, self.dat, self.perc_met)
+        res = regopt.score_and_grad(self.theta, self.d_p, self.d_m, sharded, self.perc_met)
+        for r, e in zip(res, ref):
+            np.testing.assert_allclose(r, e, rtol=1e-10, atol=1e-12)
+        with self.assertRaises(ValueError):
+            regopt.DatasetPlan(self.dat, n_devices=len(jax.devices()) + 1)
+
+    def test_per_sample_scores(self):
+        params = np.concatenate((self.theta.flatten(), self.d_p, self.d_m))
+        lik, grad = regopt.per_sample_scores(params, self.dat, grad=True)
+        self.assertEqual(lik.shape, (self.dat.shape[0],))
+        self.assertEqual(grad.shape, (self.dat.shape[0], params.shape[0]))
+        np.testing.assert_allclose(regopt.per_sample_scores(params, self.dat), lik, rtol=1e-10)
+        # Identical rows have identical values
+        np.testing.assert_allclose(lik[-4], lik[0], rtol=1e-10)
+        plan = regopt.DatasetPlan(self.dat)
+        w, n_full = plan.met_weight(self.perc_met)
+        weights = np.where(self.dat[:, -1] > 0, w, 1.)/n_full
+        sc, d_th, d_dp, d_dm = regopt.score_and_grad(self.theta, self.d_p, self.d_m, plan, self.perc_met)
+        np.testing.assert_allclose(weights @ lik, sc, rtol=1e-10)
+        np.testing.assert_allclose(weights @ grad, np.concatenate((d_th.flatten(), d_dp, d_dm)), rtol=1e-10, atol=1e-12)
+        padded = regopt.DatasetPlan(self.dat, size_classes=[3])
+        np.testing.assert_allclose(regopt.per_sample_scores(params, padded), lik, rtol=1e-10)
+
+    def test_objective_cache(self):
+        plan = regopt.DatasetPlan(self.dat)
+        cache = regopt.ObjectiveCache(maxsize=2)
+        params = np.concatenate((self.theta.flatten(), self.d_p, self.d_m))
+        args = (plan, self.perc_met, regopt.symmetric_penal, 0.1)
+        val, grad = regopt.score_and_grad_reg(params, *args)
+        val_c, grad_c = cache.score_and_grad_reg(params, *args)
+        np.testing.assert_allclose(val_c, val, rtol=1e-10)
+        np.testing.assert_allclose(grad_c, grad, rtol=1e-10)
+        # Cached values are returned for an equal copy of the parameters and by score_reg
+        cache.score_and_grad_reg(np.copy(params), *args)
+        np.testing.assert_allclose(cache.score_reg(params, *args), val, rtol=1e-10)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # A different plan or weight is a miss, the least recently used point is evicted
+        cache.score_reg(params, regopt.DatasetPlan(self.dat), self.perc_met, regopt.symmetric_penal, 0.1)
+        cache.score_reg(params, plan, self.perc_met, regopt.symmetric_penal, 0.2)
+        self.assertEqual(cache.info()["size"], 2)
+        cache.score_and_grad_reg(params, *args)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_single_precision_plan(self):
+        single = regopt.DatasetPlan(self.dat, dtype=np.float32)
+        ref = regopt.score_and_grad(self.theta, self.d_p, self.d_m, self.dat, self.perc_met)
+        res = regopt.score_and_grad(self.theta, self.d_p, self.d_m, single, self.perc_met)
+        for r, e in zip(res, ref):
+            self.assertEqual(r.dtype, np.float64)
+            np.testing.assert_allclose(r, e, rtol=1e-4, atol=1e-5)
+        with self.assertRaises(ValueError):
+            regopt.DatasetPlan(self.dat, dtype=np.float16)
+
+
+if __name__ == "__main__":
+    unittest.main()